@@ -0,0 +1,236 @@
+"""Read the texes tree straight from arXiv's source archives."""
+
+# arXiv distributes sources as monthly bundles
+#
+#      arXiv_src_0801_001.tar, arXiv_src_0801_002.tar, ...
+#
+# containing one gzipped file per paper
+#
+#      0801/0801.0001.gz, ..., 0801/math0801001.gz, ...
+#
+# which is either a tar file (for papers with several files) or a
+# single .tex file. The texes/ tree is what we get by unpacking all of
+# these into texes/<yymm>/<paper id>/.
+#
+# Once use_archives has been called with a directory holding the
+# monthly bundles (or holding <yymm>/<paper id>.gz files, if the
+# bundles have already been unpacked), open_file, listdir and is_file
+# treat texes/... paths as naming files inside the archives. A paper's
+# .gz is decompressed the first time one of its files is needed, and
+# its members are read as they are opened. Other paths are passed
+# through to the real file system.
+#
+# Separately, files whose contents were read ahead of time (by naive.py
+# --prefetch) can be handed to preload, and open_file and is_file will
+# then use those copies rather than reading the files again.
+
+import functools
+import gzip
+import io
+import os
+from pathlib import Path
+import re
+import tarfile
+from typing import Dict, List, Optional, Tuple
+
+# Directory of archives, or None to use the real texes/ tree
+archive_root: Optional[Path] = None
+
+# Contents of files read ahead of time, by normalized path
+preloaded: Dict[str, bytes] = {}
+
+# texes/<yymm>/<paper id>/<file within the paper>
+TEXES_PATH = re.compile(r"(?:.*/)?texes/(\d{4})/([^/]+)(?:/(.*))?$")
+
+
+def use_archives(directory: Optional[str]):
+    """Read texes/ paths from the archives in directory (if not None)."""
+    global archive_root
+    archive_root = Path(directory) if directory else None
+
+
+def preload(files: Optional[Dict[str, bytes]]):
+    """Use these contents for these files (until the next call)."""
+    global preloaded
+    preloaded = {
+        os.path.normpath(name): data for name, data in (files or {}).items()
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def month_index(month: str) -> Dict[str, Tuple[Path, int, int]]:
+    """
+    Find the papers for one month.
+
+    Maps each paper id to the file containing its .gz, the offset
+    of the .gz within that file, and its size (-1 for the whole file).
+    """
+    index: Dict[str, Tuple[Path, int, int]] = {}
+    for bundle in sorted(archive_root.glob(f"arXiv_src_{month}_*.tar")):
+        with tarfile.open(bundle) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(".gz"):
+                    paper_id = os.path.basename(member.name)[:-3]
+                    offset, size = member.offset_data, member.size
+                    index[paper_id] = (bundle, offset, size)
+    month_dir = archive_root / month
+    if month_dir.is_dir():
+        for gz_path in month_dir.glob("*.gz"):
+            index[gz_path.name[:-3]] = (gz_path, 0, -1)
+    return index
+
+
+def gzip_filename(compressed: bytes) -> Optional[str]:
+    """Get the original file name recorded in a gzip header, if any."""
+    flags = compressed[3]
+    position = 10
+    if flags & 0x04:  # FEXTRA
+        position += 2 + int.from_bytes(compressed[10:12], "little")
+    if flags & 0x08:  # FNAME
+        end = compressed.index(b"\0", position)
+        return os.path.basename(compressed[position:end].decode("latin-1"))
+    return None
+
+
+class Paper:
+    """The source files of one paper, read lazily from its .gz."""
+
+    def __init__(self, paper_id: str, compressed: bytes):
+        data = gzip.decompress(compressed)
+        self.tar: Optional[tarfile.TarFile] = None
+        self.members: Dict[str, object] = {}
+        try:
+            self.tar = tarfile.open(fileobj=io.BytesIO(data))
+            for member in self.tar:
+                name = os.path.normpath(member.name)
+                if member.isfile():
+                    self.members[name] = member
+        except tarfile.ReadError:
+            # A single (usually .tex) file
+            name = gzip_filename(compressed) or f"{paper_id}.tex"
+            self.members[name] = data
+        # Directories (within the paper) and their entries, in order
+        self.entries: Dict[str, Dict[str, None]] = {".": {}}
+        for name in self.members:
+            while True:
+                parent, child = os.path.split(name)
+                parent = parent or "."
+                self.entries.setdefault(parent, {})[child] = None
+                if parent == ".":
+                    break
+                name = parent
+
+    def read(self, name: str) -> bytes:
+        """Get the contents of a file in the paper."""
+        member = self.members.get(os.path.normpath(name))
+        if member is None:
+            if os.path.normpath(name) in self.entries:
+                raise IsADirectoryError(name)
+            raise FileNotFoundError(name)
+        if isinstance(member, bytes):
+            return member
+        return self.tar.extractfile(member).read()
+
+
+@functools.lru_cache(maxsize=4)
+def get_paper(month: str, paper_id: str) -> Paper:
+    """Read the .gz for a paper from the archives."""
+    try:
+        path, offset, size = month_index(month)[paper_id]
+    except KeyError:
+        raise FileNotFoundError(f"texes/{month}/{paper_id}")
+    with open(path, "rb") as fd:
+        fd.seek(offset)
+        return Paper(paper_id, fd.read(size))
+
+
+def locate(filename) -> Optional[Tuple[Paper, str]]:
+    """
+    Find the paper holding a texes/ path, and the path within the paper.
+
+    Returns None if the path should come from the real file system.
+    """
+    if archive_root is None:
+        return None
+    match = TEXES_PATH.match(os.fspath(filename))
+    if match is None:
+        return None
+    month, paper_id, name = match.groups()
+    return get_paper(month, paper_id), name or "."
+
+
+def open_file(filename, mode: str = "r"):
+    """Open a file for reading ("r" or "rb"), like the built-in open."""
+    contents = preloaded.get(os.path.normpath(filename))
+    if contents is None:
+        location = locate(filename)
+        if location is None:
+            return open(filename, mode)
+        paper, name = location
+        contents = paper.read(name)
+    data = io.BytesIO(contents)
+    if mode == "rb":
+        return data
+    # Decode (and translate newlines) just as open would
+    return io.TextIOWrapper(data)
+
+
+def listdir(directory) -> List[str]:
+    """List a directory, like os.listdir."""
+    location = locate(directory)
+    if location is None:
+        return os.listdir(directory)
+    paper, name = location
+    name = os.path.normpath(name)
+    if name not in paper.entries:
+        if name in paper.members:
+            raise NotADirectoryError(directory)
+        raise FileNotFoundError(directory)
+    return list(paper.entries[name])
+
+
+# Files whose sizes say how much TeX a paper has (see source_size)
+SOURCE_SUFFIXES = {".tex", ".ltx", ".sty", ".cls", ".def"}
+
+
+def source_size(filename) -> int:
+    """
+    Estimate how much source a paper has, without reading any of it.
+
+    For a texes/ path, this is the total size of the TeX files in
+    its paper's directory (or, if the paper comes from the archives,
+    the size of its .gz); for anything else, the size of the file.
+    """
+    path = os.fspath(filename)
+    match = TEXES_PATH.match(path)
+    try:
+        if match is None:
+            return os.path.getsize(path)
+        month, paper_id, name = match.groups()
+        if archive_root is not None:
+            gz_path, _, size = month_index(month)[paper_id]
+            return size if size >= 0 else os.path.getsize(gz_path)
+        paper_dir = path[: len(path) - len(name)] if name else path
+        return sum(
+            os.path.getsize(os.path.join(parent, entry))
+            for parent, _, entries in os.walk(paper_dir)
+            for entry in entries
+            if os.path.splitext(entry)[1].lower() in SOURCE_SUFFIXES
+        )
+    except (OSError, KeyError):
+        # Let the extractor report the problem
+        return 0
+
+
+def is_file(filename) -> bool:
+    """Check whether a file exists, like os.path.isfile."""
+    if os.path.normpath(filename) in preloaded:
+        return True
+    try:
+        location = locate(filename)
+    except FileNotFoundError:
+        return False
+    if location is None:
+        return os.path.isfile(filename)
+    paper, name = location
+    return os.path.normpath(name) in paper.members
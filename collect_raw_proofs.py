@@ -1,15 +1,67 @@
 #!/usr/bin/env python
 
+import argparse
 from pathlib import Path
 import sys
 
+import shards
+
 """ a quick script to run through every proof text file and compile them all into a proofs file for the given year """
 
+# Proofs written with naive.py --shards are copied straight out of the
+# shards (using their indexes) rather than being re-read line by line.
+# After naive.py --clean, "--kind clean" and "--kind sent" give what
+# cleanup.py and sentize2.py would have produced from the raw proofs.
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "-i",
+    "--ids",
+    help="List the ids of papers with output, not the proofs",
+    action="store_true",
+)
+parser.add_argument(
+    "-k",
+    "--kind",
+    help="Which output to collect (default: raw)",
+    choices=sorted(shards.KINDS),
+    default="raw",
+)
+parser.add_argument("year", nargs="?", default="", help="e.g., 92 or 08")
+args = parser.parse_args()
 
 p = Path("proofs")
 
-for filename in sorted(p.glob(sys.argv[1] + "*/**/*.txt")):
-    with open(filename, "r") as fd:
-        id = "/".join(filename.parts[1:3])
-        for line in fd:
-            print(f"{id}\t{line.strip()}")
+# Where to find the proofs for each .txt file (named relative to proofs/)
+sources = {}
+if args.kind == "raw":
+    sources.update(
+        ("/".join(filename.parts[1:]), filename)
+        for filename in p.glob(args.year + "*/**/*.txt")
+    )
+sources.update(shards.read_index(args.year, args.kind))
+
+out = sys.stdout.buffer
+open_shards = {}
+for name in sorted(sources, key=lambda name: name.split("/")):
+    source = sources[name]
+    id = "/".join(name.split("/")[:2])
+    if isinstance(source, Path):
+        if args.ids:
+            if source.stat().st_size > 0:
+                out.write(f"{id}\n".encode())
+            continue
+        with open(source, "r") as fd:
+            for line in fd:
+                out.write(f"{id}\t{line.strip()}\n".encode())
+    else:
+        shard, offset, length = source
+        if args.ids:
+            if length > 0:
+                out.write(f"{id}\n".encode())
+            continue
+        if shard not in open_shards:
+            open_shards[shard] = open(shard, "rb")
+        fd = open_shards[shard]
+        fd.seek(offset)
+        out.write(fd.read(length))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""Check that two versions of naive.py extract identical proofs."""
+
+# Runs the naive.py from a git revision (by default, the last commit)
+# and the naive.py in the working directory over the same random sample
+# of papers, each in its own scratch directory, and reports every paper
+# whose .txt output (or .err status) differs.
+#
+# Typical use, after changing the interpreter:
+#      ./compare_extractors.py -n 200 matches/eng-matches
+
+import argparse
+import filecmp
+import os
+from pathlib import Path
+import random
+import subprocess  # nosec
+import sys
+import tempfile
+from typing import List
+
+HERE = Path(__file__).resolve().parent
+
+# Modules naive.py needs alongside it
+SOURCES = [
+    "naive.py",
+    "kpse.py",
+    "nicer.py",
+    "prescan.py",
+    "archives.py",
+    "shards.py",
+    "manifest.py",
+]
+
+
+def checkout(revision: str, directory: Path):
+    """Write the extractor sources from the given revision to directory."""
+    directory.mkdir()
+    for source in SOURCES:
+        result = subprocess.run(  # nosec
+            ["git", "show", f"{revision}:{source}"],
+            cwd=HERE,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            # Older revisions don't have every module
+            if source == "naive.py":
+                result.check_returncode()
+            continue
+        (directory / source).write_text(result.stdout)
+    # kpse.py looks for its list of standard files beside itself
+    (directory / "texmf-dist.txt").symlink_to(HERE / "texmf-dist.txt")
+
+
+def run_extractor(code_dir: Path, run_dir: Path, matches: Path, cores: int):
+    """Run code_dir/naive.py on the matches file, with outputs in run_dir."""
+    run_dir.mkdir()
+    # (Older versions of kpse.py look in the current directory instead)
+    (run_dir / "texmf-dist.txt").symlink_to(HERE / "texmf-dist.txt")
+    with (run_dir / "log.txt").open("w") as log:
+        subprocess.run(  # nosec
+            [
+                sys.executable,
+                str(code_dir / "naive.py"),
+                f"-p{cores}",
+                "-m",
+                str(matches),
+            ],
+            cwd=run_dir,
+            stdout=log,
+            stderr=log,
+        )
+
+
+def compare_outputs(old_dir: Path, new_dir: Path) -> List[str]:
+    """Return the (relative) names of output files that differ."""
+    old_files = {str(p.relative_to(old_dir)) for p in old_dir.glob("**/*.*")}
+    new_files = {str(p.relative_to(new_dir)) for p in new_dir.glob("**/*.*")}
+    differences = sorted(old_files ^ new_files)
+    for name in sorted(old_files & new_files):
+        # .err files contain tracebacks (with line numbers), so
+        # we only check that both versions failed.
+        if name.endswith(".txt") and not filecmp.cmp(
+            old_dir / name, new_dir / name, shallow=False
+        ):
+            differences.append(name)
+    return differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-r",
+        "--revision",
+        help="Git revision to compare against",
+        default="HEAD",
+    )
+    parser.add_argument(
+        "-n", "--sample", help="Number of papers to try", type=int, default=100
+    )
+    parser.add_argument(
+        "-s", "--seed", help="Random seed for the sample", type=int, default=0
+    )
+    parser.add_argument(
+        "-p", "--cores", help="Number of cores to use", type=int, default=4
+    )
+    parser.add_argument("files", nargs="+", help="Lists of .tex files")
+    args = parser.parse_args()
+
+    tex_files: List[str] = []
+    for match_file in args.files:
+        with open(match_file) as f:
+            tex_files.extend(
+                s.strip() for s in f.readlines() if not s.startswith("#")
+            )
+    random.seed(args.seed)
+    sample = random.sample(tex_files, min(args.sample, len(tex_files)))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        scratch = Path(tmp)
+        matches = scratch / "matches"
+        with matches.open("w") as fd:
+            for filename in sample:
+                print(os.path.abspath(filename), file=fd)
+
+        checkout(args.revision, scratch / "old")
+        # Always run in parallel, so that a crash in one paper
+        # leaves an .err file rather than stopping the run.
+        cores = max(args.cores, 2)
+        print(f"running {args.revision} on {len(sample)} files")
+        run_extractor(scratch / "old", scratch / "old-run", matches, cores)
+        print(f"running working copy on {len(sample)} files")
+        run_extractor(HERE, scratch / "new-run", matches, cores)
+
+        differences = compare_outputs(
+            scratch / "old-run" / "proofs", scratch / "new-run" / "proofs"
+        )
+
+    for name in differences:
+        print("DIFFERS:", name)
+    print(f"{len(differences)} differences in {len(sample)} files")
+    sys.exit(1 if differences else 0)
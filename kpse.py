@@ -1,3 +1,4 @@
+#!/usr/bin/env python
 """Check if an input normally comes from texlive."""
 
 # database file was created via the command
@@ -5,49 +6,370 @@
 # egrep '\.sty$|.cls$|\.tex$'
 #        /usr/local/texlive/2021/texmf-dist/ls-R > texmf-dist.txt
 #
+# (or see make-texmf-dist.sh).
+#
+# Rather than reading the whole list into a set in every process, we
+# look names up in a sorted index built from it, texmf-dist.idx:
+#
+#      b"kpse"      magic number
+#      n            number of names (4 bytes, little-endian)
+#      offsets      n + 1 offsets (4 bytes each) of the names in the data
+#      data         the names (UTF-8), sorted, with no separators
+#
+# The index is memory-mapped the first time it's needed, so all the
+# workers share one copy (the OS's), and a lookup is a binary search.
+# If the index is missing or older than the list, it is rebuilt; to
+# build it (or a new list) by hand, e.g., from a TeX Live ls-R file,
+#
+#      ./kpse.py /usr/local/texlive/2021/texmf-dist/ls-R
+#
+# (which writes the index only), or ./kpse.py -l texmf-dist.txt LS-R
+# to regenerate the list as well. From an ls-R, only the files under
+# tex/ with the suffixes of inputs (.tex, .sty, .cls, ...) are kept,
+# since those are all \input, \usepackage, etc. can find.
+#
+# Packages newer than texmf-dist.txt aren't in the index. Given a local
+# TeX tree (naive.py --texmf DIR, e.g., /usr/local/texlive/2023/texmf-dist),
+# names the index lacks are also looked for there. (Running kpsewhich
+# for each name was too slow.) A process scans the tree once, using its
+# ls-R if it has one, and keeps just the inputs under tex/ (as above)
+# that the index doesn't have; that one scan answers every unknown name
+# the process meets. Answers, positive and negative, are saved in an
+# SQLite cache shared by all the workers (and later runs),
+# texmf-cache.sqlite beside this file, so usually no scan is needed at
+# all. The cache's answers for a tree are dropped when the tree (or its
+# ls-R) changes.
 
-import subprocess
+import argparse
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Union
 
-standard_files = set()
-with open("texmf-dist.txt") as fd:
-    for filename in fd.readlines():
-        filename = filename.strip()
-        standard_files.add(filename.strip())
-        if filename.endswith(".tex"):
-            standard_files.add(filename[:-4])
+HERE = Path(__file__).resolve().parent
 
+# The list of standard files, and the index built from it
+NAMES = HERE / "texmf-dist.txt"
+INDEX = HERE / "texmf-dist.idx"
 
-def in_TeX_path(filename: str) -> bool:
-    """Check if filename is a standard package."""
-    answer1: bool = filename in standard_files
-    # try:
-    #     subprocess.check_call(  # nosec
-    #         ["/Library/TeX/texbin/kpsewhich", filename],
-    #         stdout=subprocess.DEVNULL,
-    #     )
-    #     answer2: bool = True
-    # except subprocess.CalledProcessError:
-    #     answer2 = False
+MAGIC = b"kpse"
+HEADER = struct.Struct("<4sI")
+OFFSET = struct.Struct("<I")
 
-    # if answer1 != answer2:
-    #     print(f"Error: kpsewhich answer mismatch for {filename}")
-    #     print(f"texmf-dist.txt: {answer1}")
-    #     print(f"kpsewhich:      {answer2}")
-    #     exit(-1)
-
-    return answer1
+# The index (mapped, or in memory if it couldn't be written), once loaded
+index: Optional[Union[mmap.mmap, bytes]] = None
 
+# Answers for names missing from the index, from a local TeX tree
+CACHE = HERE / "texmf-cache.sqlite"
 
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trees (
+    tree TEXT PRIMARY KEY,
+    stamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS names (
+    tree TEXT NOT NULL,
+    name TEXT NOT NULL,
+    found INTEGER NOT NULL,
+    PRIMARY KEY (tree, name)
+);
 """
-@functools.lru_cache
-def in_TeX_path(filename: str) -> bool:
-    "Check if filename is a standard package."
+# Bumped when scan_tree changes which names count, to drop old answers
+CACHE_VERSION = 1
+
+# The local TeX tree to consult (see use_tree), or None
+tree: Optional[str] = None
+
+# This process's connection to the cache, and answers it has seen
+cache_db: Optional[sqlite3.Connection] = None
+cache_pid: Optional[int] = None
+tree_answers: Dict[str, bool] = {}
+
+# Names in the tree but not the index, once the tree has been scanned
+extra_names: Optional[Set[str]] = None
+
+# What \input, \usepackage, etc. can read from a TeX tree (all of which
+# kpsewhich looks for under its tex/ directory)
+INPUT_SUFFIXES = {
+    ".tex",
+    ".ltx",
+    ".sty",
+    ".cls",
+    ".clo",
+    ".def",
+    ".cfg",
+    ".fd",
+    ".ldf",
+}
+
+
+def is_input(name: str) -> bool:
+    """Check if a file in a TeX tree's tex/ could be an input."""
+    return Path(name).suffix.lower() in INPUT_SUFFIXES
+
+
+def read_names(filename: Union[str, Path]) -> List[str]:
+    """
+    Read the file names in a list like texmf-dist.txt, or an ls-R file.
+
+    From an ls-R, only the possible inputs under tex/ are kept (not
+    documentation, sources, fonts, or the directories themselves).
+    """
+    names = set()
+    # Whether we're in an ls-R, and in its tex/ subtree
+    ls_r = in_tex = False
+    with open(filename, encoding="utf-8", errors="surrogateescape") as fd:
+        for line in fd:
+            name = line.strip()
+            if not name or name.startswith("%"):
+                continue
+            if name.endswith(":"):
+                ls_r = True
+                parts = Path(name[:-1]).parts
+                in_tex = parts[:1] == ("tex",)
+            elif not ls_r or (in_tex and is_input(name)):
+                names.add(name)
+    return sorted(names)
+
+
+def with_stems(names: Iterable[str]) -> Set[str]:
+    r"""Add the names of .tex files without the .tex (as \input allows)."""
+    keys = set()
+    for name in names:
+        keys.add(name)
+        if name.endswith(".tex"):
+            keys.add(name[:-4])
+    return keys
+
+
+def make_index(names: Iterable[str]) -> bytes:
+    """Build an index of the given file names (and .tex files sans .tex)."""
+    encoded = sorted(
+        key.encode("utf-8", "surrogateescape") for key in with_stems(names)
+    )
+    offsets = [0]
+    for key in encoded:
+        offsets.append(offsets[-1] + len(key))
+    return b"".join(
+        [
+            HEADER.pack(MAGIC, len(encoded)),
+            struct.pack(f"<{len(offsets)}I", *offsets),
+        ]
+        + encoded
+    )
+
+
+def write_index(data: bytes, filename: Path = INDEX):
+    """Save an index (atomically, in case other processes are reading)."""
+    temp = filename.with_name(f"{filename.name}.{os.getpid()}")
+    with open(temp, "wb") as fd:
+        fd.write(data)
+    os.replace(temp, filename)
+
+
+def load_index() -> Union[mmap.mmap, bytes]:
+    """Map the index into memory, (re)building it first if necessary."""
     try:
-        subprocess.check_call(  # nosec
-            ["/Library/TeX/texbin/kpsewhich", filename],
-            stdout=subprocess.DEVNULL,
+        if INDEX.stat().st_mtime >= NAMES.stat().st_mtime:
+            with open(INDEX, "rb") as fd:
+                mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            if HEADER.unpack_from(mapped)[0] == MAGIC:
+                return mapped
+    except (OSError, ValueError, struct.error):
+        pass
+    data = make_index(read_names(NAMES))
+    try:
+        write_index(data)
+    except OSError as e:
+        print(
+            f"Can't save {INDEX} ({e}), keeping it in memory", file=sys.stderr
         )
-        return True
-    except subprocess.CalledProcessError:
+    return data
+
+
+def indexed_name(index: Union[mmap.mmap, bytes], count: int, i: int) -> bytes:
+    """Get the i-th name (of count) in an index."""
+    start, end = struct.unpack_from(
+        "<2I", index, HEADER.size + OFFSET.size * i
+    )
+    data = HEADER.size + OFFSET.size * (count + 1)
+    return index[data + start : data + end]
+
+
+def indexed_names() -> Iterator[str]:
+    """Get all the names in the index, in order."""
+    global index
+    if index is None:
+        index = load_index()
+    count = HEADER.unpack_from(index)[1]
+    for i in range(count):
+        yield indexed_name(index, count, i).decode("utf-8", "surrogateescape")
+
+
+def in_index(filename: str) -> bool:
+    """Check if filename is in the index of texmf-dist.txt."""
+    global index
+    if index is None:
+        index = load_index()
+    try:
+        key = filename.encode("utf-8", "surrogateescape")
+    except UnicodeEncodeError:
         return False
-"""
+    count = HEADER.unpack_from(index)[1]
+
+    # Binary search for the first name >= key
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if indexed_name(index, count, mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo < count and indexed_name(index, count, lo) == key
+
+
+def use_tree(directory: Optional[str]):
+    """Also look for names missing from the index in this TeX tree."""
+    global tree, extra_names, cache_db, cache_pid
+    tree = os.path.abspath(directory) if directory else None
+    extra_names = None
+    tree_answers.clear()
+    if cache_db is not None and cache_pid == os.getpid():
+        cache_db.close()
+    cache_db = cache_pid = None
+
+
+def tree_stamp(directory: str) -> float:
+    """Get the modification time of a tree's ls-R (or the tree itself)."""
+    ls_r = Path(directory) / "ls-R"
+    return (ls_r if ls_r.exists() else Path(directory)).stat().st_mtime
+
+
+def tree_version() -> str:
+    """Describe the tree in use (if any), for naive.py's result cache."""
+    return f"{tree}\t{tree_stamp(tree)}" if tree else ""
+
+
+def open_cache() -> Optional[sqlite3.Connection]:
+    """Open this process's connection to the cache (None if we can't)."""
+    global cache_db, cache_pid
+    if cache_pid == os.getpid():
+        return cache_db
+    cache_pid = os.getpid()
+    try:
+        cache_db = sqlite3.connect(CACHE, timeout=60)
+        cache_db.execute("PRAGMA journal_mode=WAL")
+        cache_db.executescript(CACHE_SCHEMA)
+        stamp = tree_stamp(tree)
+        with cache_db:
+            (version,) = cache_db.execute("PRAGMA user_version").fetchone()
+            if version < CACHE_VERSION:
+                cache_db.execute("DELETE FROM names")
+                cache_db.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+            row = cache_db.execute(
+                "SELECT stamp FROM trees WHERE tree = ?", (tree,)
+            ).fetchone()
+            if row is None or row[0] != stamp:
+                # The tree has changed since these answers were saved
+                cache_db.execute("DELETE FROM names WHERE tree = ?", (tree,))
+                cache_db.execute(
+                    "INSERT OR REPLACE INTO trees VALUES (?, ?)",
+                    (tree, stamp),
+                )
+    except (OSError, sqlite3.Error) as e:
+        print(f"Can't use {CACHE} ({e})", file=sys.stderr)
+        cache_db = None
+    return cache_db
+
+
+def scan_tree(directory: str) -> Set[str]:
+    """Find the inputs in a TeX tree that aren't in the index."""
+    ls_r = Path(directory) / "ls-R"
+    if ls_r.exists():
+        names: Iterable[str] = read_names(ls_r)
+    else:
+        # As read_names does for an ls-R
+        names = (
+            name
+            for _, _, files in os.walk(Path(directory) / "tex")
+            for name in files
+            if is_input(name)
+        )
+    return with_stems(names).difference(indexed_names())
+
+
+def in_tree(filename: str) -> bool:
+    """Check if filename is in the local TeX tree (see use_tree)."""
+    global extra_names
+    if filename in tree_answers:
+        return tree_answers[filename]
+    db = open_cache()
+    row = None
+    try:
+        if db is not None:
+            row = db.execute(
+                "SELECT found FROM names WHERE tree = ? AND name = ?",
+                (tree, filename),
+            ).fetchone()
+    except (sqlite3.Error, UnicodeEncodeError):
+        pass
+    if row is not None:
+        answer = bool(row[0])
+    else:
+        if extra_names is None:
+            extra_names = scan_tree(tree)
+        answer = filename in extra_names
+        try:
+            if db is not None:
+                with db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO names VALUES (?, ?, ?)",
+                        (tree, filename, answer),
+                    )
+        except (sqlite3.Error, UnicodeEncodeError):
+            pass
+    tree_answers[filename] = answer
+    return answer
+
+
+def in_TeX_path(filename: str) -> bool:
+    """Check if filename is a standard package."""
+    return in_index(filename) or (tree is not None and in_tree(filename))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build the index of standard TeX files"
+    )
+    parser.add_argument(
+        "source",
+        nargs="?",
+        default=str(NAMES),
+        help="A list of file names, or a TeX Live ls-R file"
+        " (default: texmf-dist.txt)",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        metavar="FILE",
+        help="Also write the (sorted) names to FILE, e.g., texmf-dist.txt",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=str(INDEX),
+        help="Where to write the index (default: texmf-dist.idx)",
+    )
+    args = parser.parse_args()
+
+    names = read_names(args.source)
+    if args.list:
+        with open(
+            args.list, "w", encoding="utf-8", errors="surrogateescape"
+        ) as fd:
+            fd.writelines(f"{name}\n" for name in names)
+    write_index(make_index(names), Path(args.output))
+    print(f"{len(names)} names indexed in {args.output}", file=sys.stderr)
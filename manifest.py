@@ -0,0 +1,87 @@
+"""A record of the files naive.py has processed, and how each went."""
+
+# With --manifest FILE, naive.py keeps an SQLite database with a row
+# for each input file, written as soon as that file is finished:
+#
+#      filename   the .tex file
+#      status     "ok", "error", "timeout", or "memory" (see --max-memory)
+#      output     where its proofs (or its .err file) went
+#      seconds    how long it took
+#      tokens     how many tokens it had (unknown for cache hits)
+#      hash       SHA-256 of its contents
+#      peak_rss   the most memory (in bytes) the worker used on it
+#      finished   when it was done (seconds since the epoch)
+#
+# Each row is committed right away, so -n can resume an interrupted
+# run exactly where it stopped, without looking for output files, and
+# --failed can retry just the files that didn't work.
+
+import sqlite3
+import time
+from typing import Dict, Set
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    output TEXT,
+    seconds REAL,
+    tokens INTEGER,
+    hash TEXT,
+    finished REAL,
+    peak_rss INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_by_status ON files (status);
+"""
+
+
+def open_manifest(filename: str) -> sqlite3.Connection:
+    """Open (creating, if necessary) a manifest."""
+    db = sqlite3.connect(filename, timeout=60)
+    # Let several runs (e.g., different years) share one manifest
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    # Manifests from before --max-memory have no peak_rss column
+    columns = {row[1] for row in db.execute("PRAGMA table_info(files)")}
+    if "peak_rss" not in columns:
+        with db:
+            db.execute("ALTER TABLE files ADD COLUMN peak_rss INTEGER")
+    return db
+
+
+def record(db: sqlite3.Connection, result: dict):
+    """Save what process_file reported about one file."""
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO files"
+            " (filename, status, output, seconds, tokens, hash, finished,"
+            " peak_rss) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                result["filename"],
+                result["status"],
+                result["output"],
+                result["seconds"],
+                result["tokens"],
+                result["hash"],
+                time.time(),
+                result["peak_rss"],
+            ),
+        )
+
+
+def finished_files(db: sqlite3.Connection) -> Set[str]:
+    """Get the names of all the files with results (good or bad)."""
+    return {
+        filename for (filename,) in db.execute("SELECT filename FROM files")
+    }
+
+
+def failed_files(db: sqlite3.Connection) -> Dict[str, str]:
+    """Map the files that failed (for whatever reason) to their .err files."""
+    return dict(
+        db.execute(
+            "SELECT filename, output FROM files"
+            " WHERE status IN ('error', 'timeout', 'memory')"
+        )
+    )
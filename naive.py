@@ -3,21 +3,36 @@
 """Extracts proofs from .tex files, naively."""
 
 import argparse
-from itertools import repeat
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+from itertools import islice, repeat
+import json
 from multiprocessing import Pool
 import os
+import pickle
 from pathlib import Path
 import random
 import re
+import resource
+import signal
 import sys
+import threading
+import time
 import traceback
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional, Pattern, Set, Tuple, Union
 
 import bs4
 import more_itertools
 
+import archives
 import kpse
+import manifest
 import nicer
+import prescan
+import shards
 
 """
 Typical usage:
@@ -26,6 +41,10 @@ Typical usage:
  or for a single file,
    ./naive.py t.tex
 
+ To see which commands (and papers) take the most time:
+   ./naive.py -p16 --profile profile.tsv -m matches/matches08
+   less profile.tsv
+
  Merge commands:
    find proofs -type f -name "*.naive.txt" -print0 \
           | sort -z | xargs -0 ./en_cat.py >! proofs.txt
@@ -43,7 +62,173 @@ class SkipThisProof(Exception):
     pass
 
 
+class FileTimeout(Exception):
+    """Exception if a file takes longer than the --timeout budget."""
+
+    pass
+
+
+def raise_file_timeout(signum, frame):
+    """Signal handler that abandons the current file when time runs out."""
+    raise FileTimeout()
+
+
+# Files abandoned because of --timeout are listed here,
+# along with the number of seconds they ran.
+QUARANTINE_FILE = "quarantine.txt"
+
+
+#
+# Memory use (--max-memory)
+#
+
+
+def limit_memory(megabytes: float):
+    """
+    Make allocations beyond the given size raise MemoryError.
+
+    This limits the process's address space, which is always at least
+    its resident size, so a paper that needs too much fails on its own
+    rather than getting the whole pool OOM-killed.
+    """
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = int(megabytes * 1_000_000)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def reset_peak_rss():
+    """Start measuring peak memory use afresh (where the OS allows)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fd:
+            fd.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """
+    Get the peak resident size of this process, in bytes.
+
+    On Linux, this is the peak since reset_peak_rss; elsewhere it's
+    the peak since the process started.
+    """
+    try:
+        with open("/proc/self/status") as fd:
+            for line in fd:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # (Reported in bytes on macOS, but kilobytes elsewhere.)
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+#
+# Optional profiling (--profile)
+#
+
+# While profiling the current paper, maps (kind, name) pairs
+# to [number of calls, cumulative seconds]. None when not profiling.
+profile_counts: Optional[Dict[Tuple[str, str], list]] = None
+
+
+def add_profile_time(kind: str, name: str, start: float):
+    """Charge one call, started at time start, to (kind, name)."""
+    entry = profile_counts.setdefault((kind, name), [0, 0.0])
+    entry[0] += 1
+    entry[1] += time.perf_counter() - start
+
+
+def profiled(kind: str, name: Optional[str] = None):
+    """
+    Charge calls of the decorated function to (kind, name) when profiling.
+
+    If no name is given, calls are charged to the function's first
+    argument (e.g., the command being executed).
+    """
+
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if profile_counts is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_profile_time(kind, name or args[0], start)
+
+        return wrapper
+
+    return decorate
+
+
+def save_profile(profile: str, filename: str):
+    """Append the current paper's profile to this worker's profile file."""
+    with open(f"{profile}.{os.getpid()}", "a") as fd:
+        for (kind, name), (calls, seconds) in profile_counts.items():
+            name = name.replace("\t", "\\t").replace("\n", "\\n")
+            print(
+                filename,
+                kind,
+                name,
+                calls,
+                f"{seconds:.6f}",
+                sep="\t",
+                file=fd,
+            )
+
+
+def profile_worker_files(profile: str) -> List[Path]:
+    """Find the per-worker files (profile.<pid>) for this profile."""
+    return [
+        path
+        for path in Path(profile).parent.glob(Path(profile).name + ".*")
+        if path.suffix[1:].isdigit()
+    ]
+
+
+def merge_profiles(profile: str):
+    """
+    Combine the per-worker profile files into one table.
+
+    The merged table starts with totals over all papers (with
+    paper "*"), followed by the rows for individual papers;
+    each part is sorted by decreasing time.
+    """
+    worker_files = profile_worker_files(profile)
+    rows = []
+    totals: Dict[Tuple[str, str], list] = {}
+    for path in worker_files:
+        with path.open() as fd:
+            for line in fd:
+                paper, kind, name, calls, seconds = line.rstrip("\n").split(
+                    "\t"
+                )
+                rows.append((paper, kind, name, int(calls), float(seconds)))
+                entry = totals.setdefault((kind, name), [0, 0.0])
+                entry[0] += int(calls)
+                entry[1] += float(seconds)
+    rows.sort(key=lambda row: row[4], reverse=True)
+    with open(profile, "w") as fd:
+        print("paper", "kind", "name", "calls", "seconds", sep="\t", file=fd)
+        for (kind, name), (calls, seconds) in sorted(
+            totals.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            print("*", kind, name, calls, f"{seconds:.6f}", sep="\t", file=fd)
+        for paper, kind, name, calls, seconds in rows:
+            print(
+                paper, kind, name, calls, f"{seconds:.6f}", sep="\t", file=fd
+            )
+    for path in worker_files:
+        path.unlink()
+
+
 # Set of LaTeX environments that implicitly switch to math mode.
+# (Those a paper defines are kept in its macros["math envs"].)
 MATH_ENVS = {
     "align",
     "alignat",
@@ -667,6 +852,10 @@ IGNORED_INCLUDES = {
 TEX_COMMENT = re.compile(r"((?<!\\)(\\\\)+|(?<!\\))[%٪].*?\n[ \t]*")
 
 
+# A control word right before a comment (see decomment)
+COMMAND_COMMENT = re.compile("(\\\\[A-Za-z]+)[%٪].*?\n[ \t]*")
+
+
 def decomment(tex_source: str) -> str:
     r"""
     Delete all TeX comments from multiline source code.
@@ -681,11 +870,215 @@ def decomment(tex_source: str) -> str:
     # will then be iterpreted as \foobar rather than foo{}bar
     # In this case, we replace the comment with a space (which will be
     # harmlessly consumed when we read the \foo)
-    result = re.sub("(\\\\[A-Za-z]+)[%٪].*?\n[ \t]*", r"\1 ", tex_source)
-    result = re.sub(TEX_COMMENT, "", result)
+    result = COMMAND_COMMENT.sub(r"\1 ", tex_source)
+    result = TEX_COMMENT.sub("", result)
     return result
 
 
+# Ad-hoc fixups (especially for isolated .tex inputs), as a list of
+#
+#      (what the filename contains, [rewrites])
+#
+# applied in order. A rewrite is either a pair of strings (for
+# str.replace) or a compiled regex and its replacement (for re.sub).
+# The filename keys are sometimes a paper id, but usually just the
+# name of the one file that needs fixing.
+Rewrite = Tuple[Union[str, Pattern[str]], str]
+
+GAME = re.compile("\\\\begin\\{game\\}.*?\\\\end\\{game\\}", re.DOTALL)
+
+FIXUPS: List[Tuple[Tuple[str, ...], List[Rewrite]]] = [
+    (
+        ("solpara-arxiv-2",),
+        [("\\providecommand{ }[1]{\\textcolor{blue}{#1}}", "")],
+    ),
+    (("Leb2Poi",), [("Moreover. the set", "Moreover, the set")]),
+    (
+        ("Journal_Hyp_2020January",),
+        [("same endpoints. and if", "same endpoints, and if")],
+    ),
+    (
+        ("pseudo.",),
+        [(re.compile(r"\{e\}\$.\s+for \$j"), r"{e}$ for $j")],
+    ),
+    (("canonicaldomainDMT.",), [(r"\alpha^\sigma$.", r"\alpha^\sigma$,")]),
+    (("paper_beta_arxiv.",), [("(???)", " REF ")]),
+    (("abci.",), [("Picture?????", "")]),
+    (("monotone.",), [("see??.", ".")]),
+    (("lipschitzfree.",), [("Proposition ???", "Proposition 42")]),
+    (("shi-yang-eppo.",), [("(??)", "")]),
+    (("46-100.",), [("？？？？？？？", "")]),
+    (
+        ("CDS-SU2n.",),
+        # Defines a 2-argument version of \fullref, which
+        # we can't handle (because reference commands like
+        # \fullref are considered immutable)
+        [("\\fullref", "\\myfullref"), ("\\pref", "\\mypref")],
+    ),
+    (("modularDD.",), [("\\NewCons{}{} ", "MATH ")]),
+    (
+        ("Harriss_OSTWI.",),
+        [("\\WARMprocessEPS{2to1_three_steps_window}{eps}{bb}", "")],
+    ),
+    (
+        ("mholy.",),
+        [(re.compile(r"\\beqn((.|\n)*?)\\eeqn"), "\\[A=A\\]")],
+    ),
+    (
+        ("MaxMin.",),
+        [(re.compile(r"\\begeq((.|\n)*?)\\endeq"), "\\[\\1\\]")],
+    ),
+    (("ch.",), [("\\home ", "")]),
+    (("AIJ-Crossover-v1-arxiv.",), [("{aligna}", "{align}")]),
+    (
+        ("2003.12106/macros.",),
+        [
+            (
+                "\\NewDocumentCommand\n  {\\HasTypeInCtx}\n  { O{} m m }\n  ",
+                "\\newcommand{\\HasTypeInCtx}[3][]",
+            ),
+            (
+                "\\NewDocumentCommand\n  {\\Constructible}\n  { O{} m m }\n  ",
+                "\\newcommand{\\Constructible}[3][]",
+            ),
+        ],
+    ),
+    (
+        ("2003.02840/simple_spinors_null_vectors_and_o_n__arxiv_2",),
+        # Hack to ignore the second argument of \opt{margin_notes}
+        # but not every \opt
+        [("\\opt{margin_notes}", "\\psfig")],
+    ),
+    (("2001/2001.02981/main.",), [("\\usepackage{theorems}", "")]),
+    (
+        ("1308/1308.4171/CominiTitoloVillanueva-CR.",),
+        [
+            (
+                "\\usepackage[fancyproofs,noextended,squareitemtag]{theorems}",
+                "",
+            )
+        ],
+    ),
+    (
+        (
+            "thomp-genus0.",
+            "hhn-swe-aug-12.",
+            "somespectralpropertiesderivations.",
+            "KT16.",
+            "plan25_united.",
+            "concatsakiris_arxiv-4oct19.",
+        ),
+        [("'s's", "'s")],
+    ),
+    (
+        ("primeness.",),
+        [
+            (
+                re.compile(r"\$\$ \$\$\s+with(\n|.)*\\end{proof}"),
+                r"\\end{proof}",
+            ),
+            # and as long as we're here
+            ("encoded in v.", "encoded in $v$."),
+            ("vector w,", "vector $w$,"),
+            (
+                r"$\mathfrak{X}=\mathfrak{U}(Q_{-1}'\cap Q_0)$ x $\mathfrak{U}(Q_{0}'\cap P_0)$ x $\mathfrak{U}(P_{-1}'\cap P_0)$ x $\mathfrak{U}(Q_{-1}'\cap P_{-1})$",
+                " MATH ",
+            ),
+        ],
+    ),
+    (("eqm7-x",), [("Gel\\acc fand", "NAME")]),
+    (("GTasOS-Main-EPTCS",), [("?!-determinism", "MATH-determinism")]),
+    (("g3arxiv.",), [("{footnotesize}", "{align}")]),
+    (("naaut70409sub.",), [("By applying ?", "By applying REF")]),
+    (
+        ("math0003081/paper.",),
+        [
+            (
+                re.compile(
+                    "following table:.*?\\\\smallskip.*?\\\\smallskip"
+                    ".*?\\\\smallskip",
+                    re.DOTALL,
+                ),
+                "following table: MATH.",
+            )
+        ],
+    ),
+    (("imperfect-best-response-journal4.",), [(GAME, "")]),
+    (("selfish13.",), [(GAME, " MATH ")]),
+    (
+        ("Maximizers_non_endpoint_Tomas_Stein_20190923.",),
+        [("TAB", "align")],
+    ),
+    (("proetalecob-arxiv-06.",), [(" CHECK!!", "")]),
+    # 0808/0808.1787
+    (
+        ("spanners-writeup.",),
+        [(re.compile("\\\\[saekdm]note\\b"), "\\\\phantom")],
+    ),
+    (
+        ("supp_for_review.",),
+        [
+            ("TODO: Does not depend on $n$?!", ""),
+            (re.compile("\\(TODO[^)]*\\)"), ""),
+        ],
+    ),
+    # 1907/1907.11133
+    (("arxiv-version.",), [(re.compile("\\\\warning\\{"), "\\\\phantom{")]),
+    # 0106/math0106063
+    (
+        ("Intro.",),
+        [
+            (
+                r"\newcommand{\notwritten}{\emph{$\langle$not written yet\/$\rangle$}}",
+                r"\newcommand{\notewritten}{}",
+            )
+        ],
+    ),
+    # 0708/0708.0780
+    (
+        ("ZeroOrderMonog_2010_09_12_port.",),
+        [(r"\textbf{Part 3} ?? \textbf{FINISH} ??", "")],
+    ),
+    (("motif-sublinear.",), [("???", "")]),  # 1007/1007.2618
+    (("weisfeiler.",), [("???", "")]),  # 1203/1203.1960
+    (("A10.",), [("???", "")]),  # 1211/1211.3680
+    # 1706/1706.07575
+    (
+        ("manuscript.",),
+        [
+            (
+                "``???? ?0?? ??1? ???? ???0'' (``?'' is Alice's unknown bit)",
+                "",
+            ),
+            (r"`\#\#\#\# d??? ?d?? \#\#\#\# ??d?'$\}$", ""),
+        ],
+    ),
+    (
+        ("ElJC-even2.",),
+        [
+            (
+                re.compile(
+                    "\\(see Figure 1\\)\\..*?\\\\medskip.*?\\\\medskip",
+                    re.DOTALL,
+                ),
+                "(see Figure 1).",
+            )
+        ],
+    ),
+]
+
+
+@functools.lru_cache(maxsize=4096)
+def fixups_for(filename: str) -> List[Rewrite]:
+    """Find the ad-hoc rewrites (if any) for a file."""
+    return [
+        rewrite
+        for keys, rewrites in FIXUPS
+        if any(key in filename for key in keys)
+        for rewrite in rewrites
+    ]
+
+
 def fixup(filename: str, tex_source: str) -> str:
     """
     Fixup annoyances (especially in isolated .tex inputs).
@@ -694,159 +1087,14 @@ def fixup(filename: str, tex_source: str) -> str:
     that's dangerous since there are copies of this
     directory floating around on different computers.
     """
+    for old, new in fixups_for(filename):
+        if isinstance(old, str):
+            tex_source = tex_source.replace(old, new)
+        else:
+            tex_source = old.sub(new, tex_source)
 
-    if "solpara-arxiv-2" in filename:
-        tex_source = tex_source.replace(
-            "\\providecommand{ }[1]{\\textcolor{blue}{#1}}", ""
-        )
-    if "Leb2Poi" in filename:
-        tex_source = tex_source.replace(
-            "Moreover. the set", "Moreover, the set"
-        )
-    if "Journal_Hyp_2020January" in filename:
-        tex_source = tex_source.replace(
-            "same endpoints. and if", "same endpoints, and if"
-        )
-    if "pseudo." in filename:
-        tex_source = re.sub(r"\{e\}\$.\s+for \$j", r"{e}$ for $j", tex_source)
-    if "canonicaldomainDMT." in filename:
-        tex_source = tex_source.replace(r"\alpha^\sigma$.", r"\alpha^\sigma$,")
-    if "paper_beta_arxiv." in filename:
-        tex_source = tex_source.replace("(???)", " REF ")
-    if "abci." in filename:
-        tex_source = tex_source.replace("Picture?????", "")
-    if "monotone." in filename:
-        tex_source = tex_source.replace("see??.", ".")
-    if "lipschitzfree." in filename:
-        tex_source = tex_source.replace("Proposition ???", "Proposition 42")
-    if "shi-yang-eppo." in filename:
-        tex_source = tex_source.replace("(??)", "")
-    if "46-100." in filename:
-        tex_source = tex_source.replace("？？？？？？？", "")
-    if "CDS-SU2n." in filename:
-        # Defines a 2-argument version of \fullref, which
-        # we can't handle (because reference commands like
-        # \fullref are considered immutable)
-        tex_source = tex_source.replace("\\fullref", "\\myfullref")
-        tex_source = tex_source.replace("\\pref", "\\mypref")
-    if "modularDD." in filename:
-        tex_source = tex_source.replace("\\NewCons{}{} ", "MATH ")
-    if "Harriss_OSTWI." in filename:
-        tex_source = tex_source.replace(
-            "\\WARMprocessEPS{2to1_three_steps_window}{eps}{bb}", ""
-        )
-    if "mholy." in filename:
-        tex_source = re.sub(r"\\beqn((.|\n)*?)\\eeqn", "\\[A=A\\]", tex_source)
-    if "MaxMin." in filename:
-        tex_source = re.sub(
-            r"\\begeq((.|\n)*?)\\endeq", "\\[\\1\\]", tex_source
-        )
-    if "ch." in filename:
-        tex_source = tex_source.replace("\\home ", "")
-    if "AIJ-Crossover-v1-arxiv." in filename:
-        tex_source = tex_source.replace("{aligna}", "{align}")
-    if "2003.12106/macros." in filename:
-        tex_source = tex_source.replace(
-            "\\NewDocumentCommand\n  {\\HasTypeInCtx}\n  { O{} m m }\n  ",
-            "\\newcommand{\\HasTypeInCtx}[3][]",
-        )
-        tex_source = tex_source.replace(
-            "\\NewDocumentCommand\n  {\\Constructible}\n  { O{} m m }\n  ",
-            "\\newcommand{\\Constructible}[3][]",
-        )
     if "2003.04180" in filename:
         TEX_REFS["\\objectref"] = 5
-    if "2003.02840/simple_spinors_null_vectors_and_o_n__arxiv_2" in filename:
-        # Hack to ignore the second argument of \opt{margin_notes}
-        # but not every \opt
-        tex_source = tex_source.replace("\\opt{margin_notes}", "\\psfig")
-    if "2001/2001.02981/main." in filename:
-        tex_source = tex_source.replace("\\usepackage{theorems}", "")
-    if "1308/1308.4171/CominiTitoloVillanueva-CR." in filename:
-        tex_source = tex_source.replace(
-            "\\usepackage[fancyproofs,noextended,squareitemtag]{theorems}", ""
-        )
-    if (
-        "thomp-genus0." in filename
-        or "hhn-swe-aug-12." in filename
-        or "somespectralpropertiesderivations." in filename
-        or "KT16." in filename
-        or "plan25_united." in filename
-        or "concatsakiris_arxiv-4oct19." in filename
-    ):
-        tex_source = tex_source.replace("'s's", "'s")
-    if "primeness." in filename:
-        tex_source = re.sub(
-            r"\$\$ \$\$\s+with(\n|.)*\\end{proof}",
-            r"\\end{proof}",
-            tex_source,
-        )
-        # and as long as we're here
-        tex_source = tex_source.replace("encoded in v.", "encoded in $v$.")
-        tex_source = tex_source.replace("vector w,", "vector $w$,")
-        tex_source = tex_source.replace(
-            "$\mathfrak{X}=\mathfrak{U}(Q_{-1}'\cap Q_0)$ x $\mathfrak{U}(Q_{0}'\cap P_0)$ x $\mathfrak{U}(P_{-1}'\cap P_0)$ x $\mathfrak{U}(Q_{-1}'\cap P_{-1})$",
-            " MATH ",
-        )
-    if "eqm7-x" in filename:
-        tex_source = tex_source.replace("Gel\\acc fand", "NAME")
-    if "GTasOS-Main-EPTCS" in filename:
-        tex_source = tex_source.replace("?!-determinism", "MATH-determinism")
-    if "g3arxiv." in filename:
-        tex_source = tex_source.replace("{footnotesize}", "{align}")
-    if "naaut70409sub." in filename:
-        tex_source = tex_source.replace("By applying ?", "By applying REF")
-    if "math0003081/paper." in filename:
-        regex = re.compile(
-            "following table:.*?\\\\smallskip.*?\\\\smallskip.*?\\\\smallskip",
-            re.DOTALL,
-        )
-        tex_source = re.sub(regex, "following table: MATH.", tex_source)
-    if "imperfect-best-response-journal4." in filename:
-        regex = re.compile("\\\\begin\{game\}.*?\\\\end\{game\}", re.DOTALL)
-        tex_source = re.sub(regex, "", tex_source)
-    if "selfish13." in filename:
-        regex = re.compile("\\\\begin\{game\}.*?\\\\end\{game\}", re.DOTALL)
-        tex_source = re.sub(regex, " MATH ", tex_source)
-    if "Maximizers_non_endpoint_Tomas_Stein_20190923." in filename:
-        tex_source = tex_source.replace("TAB", "align")
-    if "proetalecob-arxiv-06." in filename:
-        tex_source = tex_source.replace(" CHECK!!", "")
-    if "spanners-writeup." in filename:  # 0808/0808.1787
-        tex_source = re.sub("\\\\[saekdm]note\\b", "\\\\phantom", tex_source)
-    if "supp_for_review." in filename:
-        tex_source = tex_source.replace("TODO: Does not depend on $n$?!", "")
-        tex_source = re.sub("\\(TODO[^)]*\\)", "", tex_source)
-    if "arxiv-version." in filename:  # 1907/1907.11133
-        tex_source = re.sub("\\\\warning\\{", "\\\\phantom{", tex_source)
-    if "Intro." in filename:  # 0106/math0106063
-        tex_source = tex_source.replace(
-            r"\newcommand{\notwritten}{\emph{$\langle$not written yet\/$\rangle$}}",
-            r"\newcommand{\notewritten}{}",
-        )
-    if "ZeroOrderMonog_2010_09_12_port." in filename:  # 0708/0708.0780
-        tex_source = tex_source.replace(
-            r"\textbf{Part 3} ?? \textbf{FINISH} ??", ""
-        )
-    if "motif-sublinear." in filename:  # 1007/1007.2618
-        tex_source = tex_source.replace("???", "")
-    if "weisfeiler." in filename:  # 1203/1203.1960
-        tex_source = tex_source.replace("???", "")
-    if "A10." in filename:  # 1211/1211.3680
-        tex_source = tex_source.replace("???", "")
-    if "manuscript." in filename:  # 1706/1706.07575
-        tex_source = tex_source.replace(
-            "``???? ?0?? ??1? ???? ???0'' (``?'' is Alice's unknown bit)", ""
-        )
-        tex_source = tex_source.replace(
-            r"`\#\#\#\# d??? ?d?? \#\#\#\# ??d?'$\}$", ""
-        )
-    if "ElJC-even2." in filename:
-        regex = re.compile(
-            "\\(see Figure 1\\)\\..*?\\\\medskip.*?\\\\medskip",
-            re.DOTALL,
-        )
-        tex_source = re.sub(regex, "(see Figure 1).", tex_source)
 
     # A bunch of files, including
     # 0006/math-ph0006001/nonlinwa.tex
@@ -860,61 +1108,64 @@ def fixup(filename: str, tex_source: str) -> str:
     tex_source = tex_source.replace(
         "\\let\\myLabel\\@gobble", "\\def\\myLabel#1{\\label{#1}}"
     )
+    return tex_source
 
-    # print("Filename", filename, "\\snote" in tex_source)
-    # print(tex_source)
 
-    # elif "regularisation_robustness." in filename:
-    #     tex_source = tex_source.replace("
-    return tex_source
+ARROWS = [
+    "leftarrow",
+    "rightarrow",
+    "leftrightarrow",
+    "Leftarrow",
+    "Rightarrow",
+    "Leftrightarrow",
+    "longleftarrow",
+    "longrightarrow",
+    "longleftrightarrow",
+    "Longleftarrow",
+    "Longrightarrow",
+    "Longleftrightarrow",
+    "nleftarrow",
+    "nLeftarrow",
+    "nLeftrightarrow",
+    "nleftrightarrow",
+    "nRightarrow",
+    "nrightarrow",
+    "shortleftarrow",
+    "shortrightarrow",
+]
+
+# A lone arrow in $...$
+DOLLAR_ARROW = re.compile(
+    "(\\s+|(?<![$]))[$]\\s*\\\\(?:" + "|".join(ARROWS) + ")\\s*[$]\\s*"
+)
+
+# A lone \S in $...$ (which also becomes ARROW)
+DOLLAR_SECTION = re.compile("(\\s+|(?<![$]))[$]\\s*\\\\S\\s*[$]\\s*")
+
+# A lone arrow (group 1) or \S in \(...\)
+PAREN_ARROW = re.compile(
+    "\\s*\\\\\\(\\s*\\\\(?:(" + "|".join(ARROWS) + ")|S)\\s*\\\\\\)\\s*"
+)
 
 
 def highlight_arrows(tex_source: str):
-    arrows = [
-        "leftarrow",
-        "rightarrow",
-        "leftrightarrow",
-        "Leftarrow",
-        "Rightarrow",
-        "Leftrightarrow",
-        "longleftarrow",
-        "longrightarrow",
-        "longleftrightarrow",
-        "Longleftarrow",
-        "Longrightarrow",
-        "Longleftrightarrow",
-        "nleftarrow",
-        "nLeftarrow",
-        "nLeftrightarrow",
-        "nleftrightarrow",
-        "nRightarrow",
-        "nrightarrow",
-        "shortleftarrow",
-        "shortrightarrow",
-    ]
-    arrow_regex = "\\s*\\\\(?:" + "|".join(arrows) + ")\\s*"
-    tex_source = re.sub(
-        "(\\s+|(?<![$]))[$]" + arrow_regex + "[$]\\s*", " ARROW ", tex_source
-    )
-    tex_source = re.sub(
-        "\\s*\\\\\\(" + arrow_regex + "\\\\\)\\s*", " ARROW ", tex_source
-    )
-    section_regex = "\\s*\\\\S\\s*"
-    tex_source = re.sub(
-        "(\\s+|(?<![$]))[$]" + section_regex + "[$]\\s*", " ARROW ", tex_source
-    )
-    tex_source = re.sub(
-        "\\s*\\\\\\(" + section_regex + "\\\\\)\\s*", " Section ", tex_source
+    tex_source = DOLLAR_ARROW.sub(" ARROW ", tex_source)
+    # (One pass does both kinds of \(...\), which gives the same words
+    # as doing the \(\S\)'s last.)
+    tex_source = PAREN_ARROW.sub(
+        lambda m: " ARROW " if m.group(1) else " Section ", tex_source
     )
+    tex_source = DOLLAR_SECTION.sub(" ARROW ", tex_source)
     return tex_source
 
 
-def tokenize_string(filename: str, tex_source: str):
-    """
-    Turn a string (representing an entire file) into a stream of TeX-ish words.
+ELLIPSIS = re.compile(r"\.\.+")
 
-    This is a generator function returning strings (tokens).
-    """
+BLANK_LINE = re.compile("^[ \\t]*$", re.MULTILINE)
+
+
+def prepare_source(filename: str, tex_source: str) -> str:
+    """Apply the source-level rewrites that happen before tokenization."""
     # Remove a few known-bad lines
 
     # 0002/math0002136/zinno.tex
@@ -937,7 +1188,7 @@ def tokenize_string(filename: str, tex_source: str):
     # Might screw up macros applied to ellipses, but that's rare.
     # in particular, it seems more common to have $<stuff>...$
     # which generates a false positive for the final-period detector.
-    tex_source = re.sub(r"\.\.+", "…", tex_source)
+    tex_source = ELLIPSIS.sub("…", tex_source)
 
     # Ad-hoc fixups
     tex_source = fixup(filename, tex_source)
@@ -946,8 +1197,18 @@ def tokenize_string(filename: str, tex_source: str):
     tex_source = highlight_arrows(tex_source)
 
     # Insert "\par" where there were blank lines
-    tex_source = re.sub("^[ \\t]*$", "\\\\par", tex_source, flags=re.MULTILINE)
+    tex_source = BLANK_LINE.sub("\\\\par", tex_source)
+
+    return tex_source
+
+
+def tokenize_legacy(tex_source: str):
+    """
+    Split prepared TeX source into words, one character at a time.
 
+    This is the original tokenizer, kept so that its output can be
+    compared against tokenize_fast (via --tokenizer=legacy).
+    """
     # Create a peekable stream of characters.
     chars: more_itertools.peekable[str] = more_itertools.peekable(tex_source)
 
@@ -1011,44 +1272,488 @@ def tokenize_string(filename: str, tex_source: str):
     return
 
 
-def get_words(filename: str):
-    """Get a stream of words from the given file."""
-    path = Path(filename)
-    if not path.exists():
+# Master regular expression for tokenize_fast.
+# Group 1 is an alphabetic control sequence (minus any following
+# spaces or tabs, which TeX ignores); group 2 is any other word.
+TEX_TOKEN = re.compile(
+    r"(\\(?:[^\W\d_]|@)+)[ \t]*|(\\.|#[^\D0]|---|--|\s+|.)", re.DOTALL
+)
+
+DASHES = {"---": "—", "--": "–"}
+
+
+def tokenize_fast(tex_source: str) -> List[str]:
+    """
+    Split prepared TeX source into words, using one regular expression.
+
+    Produces exactly the same words as tokenize_legacy.
+    """
+    # Characters like ² or Ⅳ are [^\W\d_] word characters for TEX_TOKEN
+    # but neither str.isalpha nor str.isdecimal, so sources containing
+    # them need a closer look.
+    if any(c.isnumeric() and not c.isdecimal() for c in set(tex_source)):
+        return tokenize_numerals(tex_source)
+    return [
+        cs or (" " if word.isspace() else DASHES.get(word, word))
+        for cs, word in TEX_TOKEN.findall(tex_source)
+    ]
+
+
+def tokenize_numerals(tex_source: str) -> List[str]:
+    r"""
+    Split prepared TeX source that contains characters like ² into words.
+
+    Those characters match [^\W\d_] in TEX_TOKEN but end a control
+    sequence in TeX, and count as digits after a #.
+    """
+    words: List[str] = []
+    pos = 0
+    end = len(tex_source)
+    while pos < end:
+        m = TEX_TOKEN.match(tex_source, pos)
+        cs, word = m.groups()
+        pos = m.end()
+        if cs:
+            length = 1
+            while length < len(cs) and (
+                cs[length] == "@" or cs[length].isalpha()
+            ):
+                length += 1
+            if length < len(cs):
+                # Back up to the numeral, without skipping any spaces.
+                # (If it comes right after the backslash, then
+                #  it's a control symbol like \².)
+                length = max(length, 2)
+                cs = cs[:length]
+                pos = m.start() + length
+            words.append(cs)
+        elif word == "#":
+            d = tex_source[pos : pos + 1]
+            if d.isdigit() and d != "0":
+                word += d
+                pos += 1
+            words.append(word)
+        elif word.isspace():
+            words.append(" ")
+        else:
+            words.append(DASHES.get(word, word))
+    return words
+
+
+TOKENIZERS = {
+    "fast": tokenize_fast,
+    "legacy": tokenize_legacy,
+}
+
+
+def tokenize_string(
+    filename: str, tex_source: str, tokenizer: str = "fast"
+) -> List[str]:
+    """Turn a string (an entire file) into a list of TeX-ish words."""
+    tex_source = prepare_source(filename, tex_source)
+    return list(TOKENIZERS[tokenizer](tex_source))
+
+
+_NO_DEFAULT = object()
+
+# Words besides control sequences that matter when skipping math
+MATH_SPECIALS = {"{", "}", "$"}
+
+# Control sequences that skip_rest_math and skip_rest_env handle
+MATH_STRUCTURE = {
+    "\\(",
+    "\\)",
+    "\\[",
+    "\\]",
+    "\\begin",
+    "\\end",
+    "\\right",
+    "\\label",
+    "\\eqno",
+    "\\leqno",
+    "\\ifmmode",
+}
+
+
+class TokenStream:
+    """
+    The stream of words that the interpreter consumes.
+
+    A drop-in replacement for more_itertools.peekable (supporting
+    next(), peek, prepend, truth-testing, and indexing/slicing), but
+    backed by the list of all the words in the file plus a cursor.
+    Words put back with prepend (e.g., macro expansions) are kept on
+    a separate stack, stored in reverse so that the next word is
+    always at the end.
+
+    The first time we look for a particular end marker (e.g., \endxy)
+    we record all its positions in the file, so that afterwards we can
+    tell immediately whether one is coming up, and jump right to it.
+    Similarly, braces are matched using their positions.
+    """
+
+    __slots__ = ("_tokens", "_pos", "_end", "_pushed", "_index")
+
+    def __init__(self, tokens: List[str]):
+        self._tokens = tokens
+        self._pos = 0
+        self._end = len(tokens)
+        self._pushed: List[str] = []
+        # Maps a word (or begin/end pair of words) to where it occurs
+        self._index: Dict = {}
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        if self._pushed:
+            return self._pushed.pop()
+        pos = self._pos
+        if pos < self._end:
+            self._pos = pos + 1
+            return self._tokens[pos]
+        raise StopIteration
+
+    def __bool__(self) -> bool:
+        return bool(self._pushed) or self._pos < self._end
+
+    @property
+    def size(self) -> int:
+        """How many words the file had in all."""
+        return len(self._tokens)
+
+    def peek(self, default=_NO_DEFAULT):
+        """Return the next word without consuming it."""
+        if self._pushed:
+            return self._pushed[-1]
+        if self._pos < self._end:
+            return self._tokens[self._pos]
+        if default is _NO_DEFAULT:
+            raise StopIteration
+        return default
+
+    def prepend(self, *tokens: str):
+        """Put the given words back at the front of the stream."""
+        self._pushed.extend(reversed(tokens))
+
+    def lookahead(self, n: Optional[int] = None) -> List[str]:
+        """Return (without consuming) the next n words, or all of them."""
+        pushed = self._pushed
+        if n is None:
+            return pushed[::-1] + self._tokens[self._pos :]
+        if n <= len(pushed):
+            return pushed[len(pushed) - n :][::-1]
+        pos = self._pos
+        return pushed[::-1] + self._tokens[pos : pos + n - len(pushed)]
+
+    def startswith(self, tokens: List[str]) -> bool:
+        """Check whether the next words are exactly the given words."""
+        pushed = self._pushed
+        if not pushed:
+            pos = self._pos
+            return self._tokens[pos : pos + len(tokens)] == tokens
+        return self.lookahead(len(tokens)) == tokens
+
+    def _positions(self, word: str) -> List[int]:
+        """Find (once) the positions of the given word in the file."""
+        positions = self._index.get(word)
+        if positions is None:
+            positions = []
+            find = self._tokens.index
+            i = -1
+            try:
+                while True:
+                    i = find(word, i + 1)
+                    positions.append(i)
+            except ValueError:
+                pass
+            self._index[word] = positions
+        return positions
+
+    def _ends_by_depth(self, begin: str, end: str) -> Dict[int, List[int]]:
+        """
+        Find (once) the positions of end, grouped by nesting depth.
+
+        The depth at a position is the number of begins minus the
+        number of ends before it; each end is filed under the depth
+        just after it.
+        """
+        ends_by_depth = self._index.get((begin, end))
+        if ends_by_depth is None:
+            ends_by_depth = {}
+            depth = 0
+            for i in sorted(self._positions(begin) + self._positions(end)):
+                if self._tokens[i] == begin:
+                    depth += 1
+                else:
+                    depth -= 1
+                    ends_by_depth.setdefault(depth, []).append(i)
+            self._index[(begin, end)] = ends_by_depth
+        return ends_by_depth
+
+    def has_ahead(self, word: str) -> bool:
+        """Check whether the word occurs anywhere in the rest of the stream."""
+        if word in self._pushed:
+            return True
+        positions = self._positions(word)
+        return bool(positions) and positions[-1] >= self._pos
+
+    def skip_past(self, end: str, begin: Optional[str] = None):
+        """
+        Discard words up to and including the next end.
+
+        If begin is given, then begin...end pairs nest, and we stop
+        at the end matching a begin that we've just passed.
+        If there's no such end, everything is discarded and we raise
+        StopIteration (just as a loop calling next() would).
+        """
+        nesting = 1
+        pushed = self._pushed
+        while pushed:
+            w = pushed.pop()
+            if w == end:
+                nesting -= 1
+                if nesting == 0:
+                    return
+            elif w == begin:
+                nesting += 1
+
+        pos = self._pos
+        if begin is None:
+            candidates = self._positions(end)
+        else:
+            depth = bisect_left(self._positions(begin), pos) - bisect_left(
+                self._positions(end), pos
+            )
+            candidates = self._ends_by_depth(begin, end).get(
+                depth - nesting, []
+            )
+        i = bisect_left(candidates, pos)
+        if i < len(candidates):
+            self._pos = candidates[i] + 1
+            return
+        self._pos = self._end
+        raise StopIteration
+
+    def take_group(self) -> List[str]:
+        """
+        Take the words up to the } matching a { that was just taken.
+
+        Returns the words in between, and discards the }. If there's
+        no such }, everything is discarded and we raise StopIteration.
+        """
+        if not self._pushed:
+            tokens = self._tokens
+            start = pos = self._pos
+            # Most groups are short, so look a little way first
+            end = min(start + 8, self._end)
+            while pos < end:
+                w = tokens[pos]
+                if w == "}":
+                    self._pos = pos + 1
+                    return tokens[start:pos]
+                if w == "{":
+                    break
+                pos += 1
+            self.skip_past("}", "{")
+            return tokens[start : self._pos - 1]
+        nesting = 1
+        arg = []
+        while True:
+            w = next(self)
+            if w == "}":
+                nesting -= 1
+                if nesting == 0:
+                    return arg
+            elif w == "{":
+                nesting += 1
+            arg.append(w)
+
+    def take_inert(self, macros) -> List[str]:
+        r"""
+        Take the words that can't matter in math, except for a period.
+
+        These are the words before the next brace, $, or control
+        sequence that execute might do something with: those that
+        skip_rest_math handles itself, those with handlers, macros,
+        and any followed by what might be an assignment. Others (like
+        \alpha) are ignored in math. Only words from the file itself
+        are taken, so if any words have been put back, this returns
+        an empty list.
+        """
+        if self._pushed:
+            return []
+        tokens = self._tokens
+        end = self._end
+        start = pos = self._pos
+        while pos < end:
+            w = tokens[pos]
+            if w[0] == "\\":
+                if w in MATH_STRUCTURE or w in COMMANDS or w in macros:
+                    break
+                # Could execute treat what follows as an assignment?
+                # (See try_assign.)
+                after = tokens[pos + 1] if pos + 1 < end else "x"
+                if (
+                    after == "="
+                    or after.isdigit()
+                    or (
+                        after in ("-", ".")
+                        and (pos + 2 >= end or tokens[pos + 2].isdigit())
+                    )
+                ):
+                    break
+            elif w in MATH_SPECIALS:
+                break
+            pos += 1
+        self._pos = pos
+        return tokens[start:pos]
+
+    def __getitem__(self, index):
+        # Only look as far ahead as necessary.
+        if isinstance(index, slice):
+            stop = index.stop
+            if stop is None or stop < 0 or (index.start or 0) < 0:
+                return self.lookahead()[index]
+            return self.lookahead(stop)[index]
+        if index < 0:
+            return self.lookahead()[index]
+        return self.lookahead(index + 1)[index]
+
+
+@functools.lru_cache(maxsize=None)
+def directory_index(directory: str) -> Tuple[set, Dict[str, str]]:
+    """
+    List a directory (once per paper; process_file clears this cache).
+
+    Returns the set of names in the directory, and a map from
+    lowercased names to the first name with that lowercase form.
+    """
+    names = archives.listdir(directory)
+    lowered: Dict[str, str] = {}
+    for name in names:
+        lowered.setdefault(name.lower(), name)
+    return set(names), lowered
+
+
+def find_file(filename: str) -> Optional[str]:
+    """
+    Find the named file, allowing for differences in case.
+
+    Returns None if there is no such file (or directory).
+    """
+    directory, name = os.path.split(filename)
+    try:
+        names, lowered = directory_index(directory or ".")
+    except FileNotFoundError:
+        names, lowered = set(), {}
+    if name in names:
+        return filename
+    elif name.lower() in lowered:
         # in case the source code is assuming a case-insensitive
         # file system, and we're running on a linux server with a
         # case-sensitive file system.
-        directory, name = os.path.split(path)
-        directory, name = (directory or "."), name.lower()
-        for f in os.listdir(directory):
-            newpath = os.path.join(directory, f)
-            if f.lower() == name:
-                filename = newpath
-                break
+        return os.path.join(directory or ".", lowered[name.lower()])
+    if files_read is not None:
+        # Results depend on this file not existing
+        files_read.append(filename)
+    return None
+
+
+def resolve_filename(filename: str) -> str:
+    """Find the named file, allowing for differences in case."""
+    return find_file(filename) or filename
+
+
+# How the files of the current paper were decoded (see decode_tex)
+decode_counts: Counter = Counter()
+
+# Encodings (other than UTF-8) found for files in each directory
+# of the current paper
+directory_encodings: Dict[str, str] = {}
+
+# A UTF-8 encoded non-ASCII character
+UTF8_SEQUENCE = re.compile(rb"[\xc2-\xf4][\x80-\xbf]")
+
+# Bytes that are neither ASCII nor a Windows-1252 letter or common
+# punctuation mark (quotes, dashes, ellipsis, degree sign, ...)
+UNLIKELY_CP1252 = re.compile(rb"[\x80-\x84\x86-\x90\x98-\x9f]")
 
-    with open(filename, "r") as fh:
+NON_ASCII = bytes(range(128, 256))
+
+
+def decode_tex(filename: str, tex_bytes: bytes) -> str:
+    """
+    Decode the contents of a .tex file, trying the cheap ways first.
+
+    Most files are UTF-8 (or ASCII). Files that aren't are usually
+    Windows-1252 (perhaps mixed with UTF-8), and the other files of
+    the same paper usually use the same encoding. Only if none of these
+    work do we ask UnicodeDammit to work out the encoding.
+    """
+    try:
+        tex_source = tex_bytes.decode("utf-8")
+        decode_counts["utf-8"] += 1
+        return tex_source
+    except UnicodeDecodeError:
+        pass
+
+    directory = os.path.dirname(filename)
+    if UTF8_SEQUENCE.search(tex_bytes):
+        # Perhaps Windows-1252 characters pasted into UTF-8
         try:
-            tex_source: str = fh.read()
+            tex_source = bs4.UnicodeDammit.detwingle(tex_bytes).decode("utf-8")
+            decode_counts["detwingled utf-8"] += 1
+            return tex_source
         except UnicodeDecodeError:
-            with open(filename, "rb") as fd:
-                tex_bytes = fd.read()
-                tex_source = bs4.UnicodeDammit.detwingle(tex_bytes)
-                tex_source = bs4.UnicodeDammit(tex_source).unicode_markup
-                if not tex_source:
-                    tex_source = ""
+            pass
+    elif not UNLIKELY_CP1252.search(tex_bytes) and 50 * (
+        len(tex_bytes) - len(tex_bytes.translate(None, NON_ASCII))
+    ) < len(tex_bytes):
+        # English with the odd accented name or curly quote. (Text
+        # in other languages has more non-ASCII characters, and
+        # might be in some other 8-bit encoding.) This comes before
+        # the other files' encoding, since UnicodeDammit's guesses
+        # (e.g., mac_roman) decode anything, just not correctly.
+        directory_encodings[directory] = "cp1252"
+        decode_counts["cp1252"] += 1
+        return tex_bytes.decode("cp1252")
+    elif directory in directory_encodings:
+        try:
+            tex_source = tex_bytes.decode(directory_encodings[directory])
+            decode_counts["same as other files"] += 1
+            return tex_source
+        except UnicodeDecodeError:
+            pass
+
+    dammit = bs4.UnicodeDammit(bs4.UnicodeDammit.detwingle(tex_bytes))
+    decode_counts["UnicodeDammit"] += 1
+    if dammit.original_encoding:
+        directory_encodings[directory] = dammit.original_encoding
+    return dammit.unicode_markup or ""
+
+
+def get_words(filename: str, tokenizer: str = "fast"):
+    """Get a stream of words from the given file."""
+    filename = resolve_filename(filename)
+    if files_read is not None:
+        files_read.append(filename)
+
+    with archives.open_file(filename, "rb") as fd:
+        tex_source = decode_tex(filename, fd.read())
+    # Translate newlines, as reading in text mode would
+    tex_source = tex_source.replace("\r\n", "\n").replace("\r", "\n")
 
-    return more_itertools.peekable(tokenize_string(filename, tex_source))
+    return TokenStream(tokenize_string(filename, tex_source, tokenizer))
 
 
-def skip_ws(words: "more_itertools.peekable[str]"):
+def skip_ws(words: TokenStream):
     """Skip whitespace characters."""
     while words.peek("!").isspace():
         next(words)
 
 
-def get_arg(
-    words: "more_itertools.peekable[str]", macro_body: bool = False
-) -> List[str]:
+def get_arg(words: TokenStream, macro_body: bool = False) -> List[str]:
     """Get contents (words) of a single macro argument."""
     skip_ws(words)
     # by default the argument is a single token/word
@@ -1057,18 +1762,7 @@ def get_arg(
         # but if there are curly braces, keep reading
         # words until we find the matching close-brace
         # (allowing for nesting brackets)
-        nesting = 1
-        arg = []
-        while True:
-            w = next(words)
-            if w == "}":
-                nesting -= 1
-                assert nesting >= 0  # nosec
-                if nesting == 0:
-                    break
-            elif w == "{":
-                nesting += 1
-            arg.append(w)
+        arg = words.take_group()
     else:
         arg = [w]
     if arg in [["}"], ["$"], ["\\begin"], ["\\end"]] and not macro_body:
@@ -1082,7 +1776,7 @@ def get_arg(
     return arg
 
 
-def skip_optional_eq(words: "more_itertools.peekable[str]"):
+def skip_optional_eq(words: TokenStream):
     """Skip whitespace, plus an equals-sign & more whitespace if present."""
     skip_ws(words)
     if words.peek("!") == "=":
@@ -1090,12 +1784,12 @@ def skip_optional_eq(words: "more_itertools.peekable[str]"):
         skip_ws(words)
 
 
-def skip_optional_arg(words: "more_itertools.peekable[str]", macros):
+def skip_optional_arg(words: TokenStream, macros):
     """Skip an optional (bracketed) argument, if present."""
     skip_ws(words)
     if words.peek("!") == "[":
         next(words)
-        if words[:3] == ["$", "$", "]"]:
+        if words.startswith(["$", "$", "]"]):
             next(words)
             next(words)
             next(words)
@@ -1103,7 +1797,7 @@ def skip_optional_arg(words: "more_itertools.peekable[str]", macros):
         skip_rest_optional_arg(words, macros)
 
 
-def skip_rest_optional_arg(words: "more_itertools.peekable[str]", macros):
+def skip_rest_optional_arg(words: TokenStream, macros):
     """Skip to the end of the bracketed argument we're currently in."""
     while True:
         w = next(words)
@@ -1125,7 +1819,7 @@ def skip_rest_optional_arg(words: "more_itertools.peekable[str]", macros):
             break
 
 
-def get_optional_arg(words: "more_itertools.peekable[str]"):
+def get_optional_arg(words: TokenStream):
     """Get one optional macro argument."""
     w = next(words)
     assert w == "["  # nosec
@@ -1145,7 +1839,7 @@ def get_optional_arg(words: "more_itertools.peekable[str]"):
 
 
 def skip_rest_conditional(
-    words: "more_itertools.peekable[str]", macros, stop_on_else: bool = True
+    words: TokenStream, macros, stop_on_else: bool = True
 ):
     r"""
     Skip the rest of the conditional arm we are currently inside.
@@ -1167,8 +1861,7 @@ def skip_rest_conditional(
             return
         elif w == "\\loop" and w not in macros:
             # Ignore primitive loops
-            while next(words) != "\\repeat":
-                pass
+            words.skip_past("\\repeat")
         elif w in TEX_IFS or w in macros["new ifs"]:
             # If we're skipping past a nested conditional, we want to go
             # all the way to the \fi (not just to the \else), even if
@@ -1176,7 +1869,7 @@ def skip_rest_conditional(
             skip_rest_conditional(words, macros, stop_on_else=False)
 
 
-def skip_num(words: "more_itertools.peekable[str]"):
+def skip_num(words: TokenStream):
     """Skip a (decimal) integer or float number."""
     skip_ws(words)
     # Funny numbers like `\@
@@ -1202,11 +1895,11 @@ def skip_num(words: "more_itertools.peekable[str]"):
         next(words)
 
 
-def skip_dimen(words: "more_itertools.peekable[str]"):
+def skip_dimen(words: TokenStream):
     """Skip a TeX dimension (with unit)."""
     skip_num(words)
     skip_ws(words)
-    if words[:4] == ["t", "r", "u", "e"]:
+    if words.startswith(["t", "r", "u", "e"]):
         for _ in range(4):
             next(words)
     skip_ws(words)
@@ -1232,7 +1925,7 @@ def skip_dimen(words: "more_itertools.peekable[str]"):
     return
 
 
-def skip_glue(words: "more_itertools.peekable[str]"):
+def skip_glue(words: TokenStream):
     """Skip TeX glue (dimension with optional stretch/shrink)."""
     skip_dimen(words)
     while try_skip_keywords(words, ["plus", "minus"]):
@@ -1240,7 +1933,7 @@ def skip_glue(words: "more_itertools.peekable[str]"):
 
 
 def get_primitive_def(
-    words: "more_itertools.peekable[str]",
+    words: TokenStream,
     debug: bool = False,
     verbose: bool = False,
 ):
@@ -1257,8 +1950,7 @@ def get_primitive_def(
     if debug:
         print("   defining", name)
     if name == "\\csname":
-        while next(words) != "\\endcsname":
-            pass
+        words.skip_past("\\endcsname")
         skip_to_lbrace(words)
         get_arg(words)
         return None, [[]], None
@@ -1379,85 +2071,167 @@ def get_newcommand(words):
     return name, parameters, optional_param, body
 
 
-def try_expand(words, parameters, optional_param, body):
+def delimiter_failures(delim: List[str]) -> List[int]:
     """
-    Try to expand a macro.
+    Compute the KMP failure function for a parameter delimiter.
 
-    We're given information from the definition for a macro
-    we just saw, plus the stream of upcoming words. If we
-    can find enough arguments, we take them off the
-    stream and return the tokens of the substituted macro-body
+    failures[i] is the length of the longest proper prefix of
+    delim[: i + 1] that is also a suffix of it, i.e., how much of
+    a partial match is still matched after the next word doesn't fit.
+    """
+    failures = [0] * len(delim)
+    matched = 0
+    for i in range(1, len(delim)):
+        while matched > 0 and delim[i] != delim[matched]:
+            matched = failures[matched - 1]
+        if delim[i] == delim[matched]:
+            matched += 1
+        failures[i] = matched
+    return failures
+
+
+def compile_macro(parameters, optional_param, body):
+    r"""
+    Package up a macro definition, as stored in macros.
 
-    If we can't find enough arguments, we consume everything
-    we could find, and return an empty list. (We probably
-    weren't supposed to expand the macro at this point anyway.)
+    Along with the parameters, default optional argument, and body,
+    we save a substitution plan for try_expand: the body split at
+    each use of a parameter, as a list of (tokens, argument number)
+    pairs, where the last pair has None for the number. So for a
+    macro with no parameters (e.g., \R), the plan is just one
+    pair, holding the entire expansion.
+
+    For delimited parameters (from \def) we also save the failure
+    functions for matching their delimiters (see get_delimited_arg).
     """
-    # print("try_expand 1")
-    param_dict = {}
+    num_params = len(parameters) - 1 + (optional_param is not None)
+    slots = {f"#{arg_num}": arg_num for arg_num in range(1, num_params + 1)}
+    plan = []
+    start = 0
+    for i, tok in enumerate(body):
+        if tok in slots:
+            plan.append((body[start:i], slots[tok]))
+            start = i + 1
+    # Hack: If macro ends with $ and there's a $ immediately following,
+    #  it's probably smarter not to treat this as $$.
+    #  E.g., 0301/math0301115/waldspurger.tex
+    if body[-1:] == ["$"]:
+        plan.append((body[start:] + [" "], None))
+    elif start == 0:
+        plan.append((body, None))
+    else:
+        plan.append((body[start:], None))
+    failures = [delimiter_failures(delim) for delim in parameters[1:]]
+    return (parameters, optional_param, body, plan, failures)
+
+
+def get_delimited_arg(
+    words: TokenStream, delim: List[str], failures: List[int]
+) -> List[str]:
+    r"""
+    Get a macro argument that ends with the given delimiter.
+
+    Reads the words once, tracking how much of the delimiter the
+    latest words match (as in Knuth-Morris-Pratt string matching).
+    Groups are taken whole, since the delimiter can't match inside
+    them, though it may end with a "{" (as in \def\foo#1#{...}).
+    """
+    arg: List[str] = []
+    groups_found = 0
+    nongroups_found = 0
+    matched = 0
+    while matched < len(delim):
+        w = words.peek()
+        while matched > 0 and delim[matched] != w:
+            matched = failures[matched - 1]
+        if delim[matched] == w:
+            matched += 1
+        if w == "{" and matched < len(delim):
+            # curly braces entirely around a delimited
+            arg.append("{")
+            arg.extend(get_arg(words))
+            arg.append("}")
+            groups_found += 1
+            matched = 0
+        else:
+            arg.append(next(words))
+            nongroups_found += 1
+    # The delimiter itself isn't part of the argument
+    del arg[-len(delim) :]
+    nongroups_found -= len(delim)
+    # Remove curly braces if it's a single
+    # group, per §400
+    if groups_found == 1 and nongroups_found == 0:
+        arg = arg[1:-1]
+    return arg
+
+
+def try_expand(words, parameters, optional_param, body, plan, failures):
+    """
+    Try to expand a macro.
+
+    We're given information from the definition for a macro
+    we just saw (see compile_macro), plus the stream of upcoming
+    words. If we can find enough arguments, we take them off the
+    stream and return the tokens of the substituted macro-body
+    (which the caller must not modify).
+
+    If we can't find enough arguments, we consume everything
+    we could find, and return an empty list. (We probably
+    weren't supposed to expand the macro at this point anyway.)
+    """
+    if optional_param is None and parameters == [[]]:
+        # No arguments to find, so the expansion is always the same
+        return plan[0][0]
+    # print("try_expand 1")
+    # The arguments, where args[n] is #n
+    args: List[List[str]] = [[]]
     # handle optional arg
     if optional_param is not None:
         skip_ws(words)
         if words.peek("!") == "[":
-            param_dict["#1"] = get_optional_arg(words)
+            args.append(get_optional_arg(words))
         else:
-            param_dict["#1"] = optional_param
-        first_required = 2
-    else:
-        first_required = 1
+            args.append(optional_param)
     # handle required args
     # primitive tex initial delimeter
     for expected_tok in parameters[0]:
         found_tok = next(words)
         if expected_tok != found_tok:
             return []
-    for arg_num, delim in enumerate(parameters[1:], start=first_required):
-        parameter_token = "#" + str(arg_num)
+    for delim, delim_failures in zip(parameters[1:], failures):
         if delim:
-            param_dict[parameter_token] = []
-            groups_found = 0
-            nongroups_found = 0
-
-            while words[: len(delim)] != delim:
-                # print(f"looking for {delim=}")
-                # print(f"upcoming: {''.join(words[: len(delim)])}")
-                # curly braces entirely around a delimited
-                if words.peek() == "{":
-                    param_dict[parameter_token].append("{")
-                    param_dict[parameter_token].extend(get_arg(words))
-                    param_dict[parameter_token].append("}")
-                    groups_found += 1
-                else:
-                    param_dict[parameter_token].append(next(words))
-                    nongroups_found += 1
-            # Remove curly braces if it's a single
-            # group, per §400
-            if groups_found == 1 and nongroups_found == 0:
-                param_dict[parameter_token] = param_dict[parameter_token][1:-1]
-            for _ in delim:
-                next(words)
+            arg = get_delimited_arg(words, delim, delim_failures)
         else:
-            param_dict[parameter_token] = get_arg(words)
+            arg = get_arg(words)
 
-        if param_dict[parameter_token] in [["}"], ["$"]]:
+        if arg in [["}"], ["$"]]:
             # Something went wrong; missing argument?
-            words.prepend(*param_dict[parameter_token])
+            words.prepend(*arg)
             return []
+        args.append(arg)
 
-    substituted_body = []
-    for tok in body:
-        if tok in param_dict:
-            substituted_body.extend(param_dict[tok])
-        else:
-            substituted_body.append(tok)
+    substituted_body: List[str] = []
+    for tokens, arg_num in plan:
+        substituted_body.extend(tokens)
+        if arg_num is not None:
+            substituted_body.extend(args[arg_num])
     # print(f"{body=} {substituted_body=}")
-    # Hack: If macro ends with $ and there's a $ immediately following,
-    #  it's probably smarter not to treat this as $$.
-    #  E.g., 0301/math0301115/waldspurger.tex
+    # (The hack in compile_macro, for a body ending with an argument)
     if substituted_body[-1:] == ["$"]:
         substituted_body.append(" ")
     return substituted_body
 
 
+def last_printable_is_period(plain: List[str], final_period: bool) -> bool:
+    """Update the final-period flag after skipping some words."""
+    for w in reversed(plain):
+        if not w.isspace() and not w.startswith("\\"):
+            return w == "."
+    return final_period
+
+
+@profiled("skip", "skip_rest_math")
 def skip_rest_math(
     words, macros, single_dollar: bool, debug=False, verbose=False
 ) -> bool:
@@ -1470,13 +2244,32 @@ def skip_rest_math(
     nwords_seen = 0
     final_period = False
     while True:
-        if words.peek() == "{":
+        w = words.peek()
+        if w == "{":
             arg = get_arg(words)
             while arg and (arg[-1].isspace() or arg[-1].startswith("\\")):
                 arg.pop()
             if arg:
                 final_period = arg[-1] == "."
         else:
+            if not (
+                debug
+                or w in MATH_SPECIALS
+                or w in MATH_STRUCTURE
+                or w in COMMANDS
+            ):
+                # Take all the words that can only change the
+                # final-period flag at once.
+                plain = words.take_inert(macros)
+                if plain:
+                    nwords_seen += len(plain)
+                    if nwords_seen >= 100_000:
+                        print("skip_rest_math", nwords_seen)
+                        raise SkipThisProof
+                    final_period = last_printable_is_period(
+                        plain, final_period
+                    )
+                    continue
             # print("srm", words[:20])
             w = next(words)
             nwords_seen += 1
@@ -1578,6 +2371,7 @@ def skip_rest_math(
     return final_period
 
 
+@profiled("skip", "skip_rest_env")
 def skip_rest_env(words, macros, stop_at=None) -> bool:
     r"""
     Skip to past the \end{...} of the environment we are in.
@@ -1590,6 +2384,18 @@ def skip_rest_env(words, macros, stop_at=None) -> bool:
     env_nesting = 1
     # tag = random.random()
     while words:
+        w = words.peek()
+        if not (w in MATH_SPECIALS or w in MATH_STRUCTURE or w in COMMANDS):
+            # Take all the words that can only change the final-period
+            # flag at once (as in skip_rest_math).
+            plain = words.take_inert(macros)
+            if plain:
+                nwords_seen += len(plain)
+                if nwords_seen >= 400_000 and stop_at is None:
+                    print("skip_rest_env", nwords_seen)
+                    raise SkipThisProof
+                final_period = last_printable_is_period(plain, final_period)
+                continue
         w = next(words)
         # print("ske", w, tag, stop_at)
         # if stop_at:
@@ -1655,7 +2461,7 @@ def try_skip_keywords(words, keywords) -> bool:
     kws = list(keywords) + [" " + kw for kw in keywords]
     # print("tsw", " ".join(words[:15]), keywords)
     for kw in kws:
-        if "".join(words[: len(kw)]) == kw:
+        if "".join(words.lookahead(len(kw))) == kw:
             for _ in kw:
                 next(words)
             return True
@@ -1770,991 +2576,1386 @@ def try_skip_units(words):
 #
 # Key function - the fake LaTeX interpreter
 #
+# Each built-in command we know about has a handler function, registered
+# (with the @command decorator) in the COMMANDS table under every name
+# it handles. A handler is called as handler(cmd, words, macros) and
+# returns the words to emit, or None if the command should get the
+# generic treatment in execute (expanding user macros, and so on).
+#
 
+# Maps control-sequence names to their handlers
+COMMANDS: Dict[str, Callable] = {}
 
-def execute(cmd, words, macros, nomath=True, debug=False, inproof=False):
-    """Naively attempt to interpret TeX and LaTeX commands."""
-    if cmd == "\\ensuremath":
-        get_arg(words)
-        return ["MATH"]
 
-    # Override Paul Taylor's macros
-    if cmd == "\\prooftree":
-        while next(words) != "\\endprooftree":
-            pass
-        return [" "]
+def command(*names: str):
+    """Register the decorated function as the handler for these commands."""
 
-    # Override xy macros
-    if cmd == "\\xy" and "\\endxy" in words[:]:
-        nesting = 1
-        while True:
-            word = next(words)
-            if word == "\\xy":
-                nesting += 1
-            elif word == "\\endxy":
-                nesting -= 1
-                if nesting == 0:
-                    break
-        return [" "]
+    def register(handler):
+        for name in names:
+            assert name not in COMMANDS, name  # nosec
+            COMMANDS[name] = handler
+        return handler
 
-    if cmd == "\\pspicture":
-        while next(words) != "\\endpspicture":
-            pass
-        return [" "]
+    return register
 
-    if cmd == "\\psmatrix":
-        while next(words) != "\\endpsmatrix":
-            pass
-        return [" "]
 
-    # pictex
-    if cmd == "\\beginpicture":
-        while next(words) != "\\endpicture":
-            pass
-        return [" "]
+def execute(cmd, words, macros, nomath=True, debug=False, inproof=False):
+    """Naively attempt to interpret TeX and LaTeX commands."""
+    # (Timed inline, rather than with @profiled, since this is called
+    # so often.)
+    start = time.perf_counter() if profile_counts is not None else 0.0
+    try:
+        handler = COMMANDS.get(cmd)
+        if handler is not None:
+            output = handler(cmd, words, macros)
+            if output is not None:
+                return output
+
+        if cmd in macros:
+            if cmd == "\\BoxedEPSF":
+                # Hack for 0002/math0002136/zinno.tex
+                get_arg(words)
+                return []
 
-    if cmd == "\\begindc":
-        while next(words) != "\\enddc":
-            pass
-        return [" "]
+            if macros[cmd] != "frozen":
+                # print(f"calling try_expand on {cmd}")
+                if profile_counts is None:
+                    expansion = try_expand(words, *macros[cmd])
+                else:
+                    macro_start = time.perf_counter()
+                    expansion = try_expand(words, *macros[cmd])
+                    add_profile_time("macro", cmd, macro_start)
+                # Filter out recursion!
+                if cmd in expansion:
+                    expansion = [
+                        w if w != cmd else "\\nopenopenope " for w in expansion
+                    ]
+                words.prepend(*expansion)
+                # print(words[:10])
+                return []
+
+        if nomath and cmd in MATHONLY_COMMANDS:
+            print(
+                f"Oops: encountered {cmd} before "
+                f'{" ".join(words[:20])} ({os.getpid()})',
+                file=sys.stdout if debug else sys.stderr,
+            )
+            raise SkipThisProof(f"oops: encountered {cmd}")
+
+        if inproof and cmd in {
+            "\\psset",
+            "\\psline",
+            "\\rput",
+            "\\uput",
+            "\\pspolyline",
+            "\\newrgbcolor",
+            "\\pscircle",
+            "\\qline",
+            "\\ncline",
+        }:
+            raise SkipThisProof(f"oops: encountered {cmd}")
 
-    if cmd == "\\beginpgfgraphicnamed":
-        while next(words) != "\\endpgfgraphicnamed":
-            pass
-        return [" "]
+        if try_assign(words):
+            return []
 
-    # Override pinlabel
-    if cmd == "\\labellist":
-        while next(words) != "\\endlabellist":
-            pass
-        return [" "]
+        return []
+    finally:
+        if profile_counts is not None:
+            add_profile_time("command", cmd, start)
 
-    # qtree package
-    if cmd == "\\Tree" and "\\Tree" not in macros:
-        nesting = 0
-        while True:
-            word = next(words)
-            if word == "[":
-                nesting += 1
-            elif word == "]":
-                nesting -= 1
-                if nesting == 0:
-                    break
-        return [" MATH "]
-
-    if cmd not in macros:
-        # Allow user to override these, but otherwise
-        # translate accent commands to unicode
-        if cmd == "\\`" and words.peek("!") != " ":
-            arg_tokens = get_arg(words)
-            # \` means something different in a tabbing environment
-            if (
-                len(arg_tokens) == 1
-                and len(arg_tokens[0]) == 1
-                and arg_tokens[0].isalpha()
-            ):
-                return ["".join(arg_tokens) + "\u0300"]
-            else:
-                words.prepend(*arg_tokens)
-        if cmd == "\\'" and words.peek("!") != " ":
-            arg_tokens = get_arg(words)
-            # \' means something different in a tabbing environment
-            if (
-                len(arg_tokens) == 1
-                and len(arg_tokens[0]) == 1
-                and arg_tokens[0].isalpha()
-            ):
-                return ["".join(arg_tokens) + "\u0301"]
-            else:
-                words.prepend(*arg_tokens)
-        if cmd == "\\^":
-            return ["".join(get_arg(words)) + "\u0302"]
-        if cmd == "\\~":
-            arg = "".join(get_arg(words))
-            if arg.strip():
-                return [arg + "\u0303"]
-            else:
-                return "~"
-        if cmd == "\\=" and words.peek("!") != " ":
-            arg_tokens = get_arg(words)
-            # \= means something different in a tabbing environment
-            if (
-                len(arg_tokens) == 1
-                and len(arg_tokens[0]) == 1
-                and arg_tokens[0].isalpha()
-            ):
-                return ["".join(arg_tokens) + "\u0304"]
-            else:
-                words.prepend(*arg_tokens)
-        if cmd == "\\u" and cmd not in macros:
-            return ["".join(get_arg(words)) + "\u0306"]
-        if cmd == "\\.":
-            return ["".join(get_arg(words)) + "\u0307"]
-        if cmd == '\\"':
-            return ["".join(get_arg(words)) + "\u0308"]
-        if cmd == "\\r":
-            return ["".join(get_arg(words)) + "\u030a"]
-        if cmd == "\\H":
-            return ["".join(get_arg(words)) + "\u030c"]
-        if cmd == "\\v":
-            return ["".join(get_arg(words)) + "\u030c"]
-        if cmd == "\\c":
-            return ["".join(get_arg(words)) + "\u0327"]
-        if cmd == "\\d":
-            return ["".join(get_arg(words)) + "\u0323"]
-        if cmd == "\\k":
-            return ["".join(get_arg(words)) + "\u0328"]
-        if cmd == "\\b":
-            return ["".join(get_arg(words)) + "\u0331"]
-
-        if cmd in NO_ARGUMENT_NOOPS:
-            # If the user hasn't redefined this command, it does nothing
-            # and takes no arguments.(We'd expect them to do nothing anyway,
-            # but the extractor gets confused by {\bf 2}, which gets
-            # interpreted as an abbreviation for the assignment {\bf=2}.)
-            return []
 
-    if cmd in {
-        r"\ ",
-        r"\,",
-        r"\:",
-        r"\>",
-        "\\enspace",
-        "\\quad",
-        "\\qquad",
-        "\\bigskip",
-        "\\medskip",
-        "\\smallskip",
-        "\\eject",
-        "\\clearpage",
-        "\\cleardoublepage",
-    }:
-        # ignore these (no argument)
-        return [" "]
+@command("\\ensuremath")
+def execute_ensuremath(cmd, words, macros):
+    get_arg(words)
+    return ["MATH"]
 
-    if cmd in {
-        "\\label",
-        "\\message",
-        "\\errmessage",
-        "\\ClassInfo",
-        "\\ClassWarning",
-        "\\ClassWarningNoLine",
-        "\\ClassError",
-        "\\TBInfo",  # tugboat class
-        "\\TBWarning",
-        "\\TBError",
-        "\\TBWarningNL",
-        "\\string",  # valid but unlikely to produce anything helpful.
-        "\\linethickness",
-        "\\newsavebox",
-        "\\enlargethispage",
-        "\\special",
-        "\\rlap",
-        "\\llap",
-        "\\ding",
-        "\\nocite",
-        # mathtools
-        "\\noeqref",
-    }:
-        # ignore these (and their argument)
-        # Skip optional asterisk
-        if words.peek("!") == "*":
-            next(words)
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return []
 
-    if cmd == "\\index":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        if "two-argument \\index" in macros:
-            get_arg(words)
-        return []
+# Commands that start a block we skip entirely, mapped to the
+# command that ends the block.
+SKIPPED_BLOCKS = {
+    # Override Paul Taylor's macros
+    "\\prooftree": "\\endprooftree",
+    "\\pspicture": "\\endpspicture",
+    "\\psmatrix": "\\endpsmatrix",
+    # pictex
+    "\\beginpicture": "\\endpicture",
+    "\\begindc": "\\enddc",
+    "\\beginpgfgraphicnamed": "\\endpgfgraphicnamed",
+    # Override pinlabel
+    "\\labellist": "\\endlabellist",
+}
 
-    if cmd in [
-        "\\asciiabstract",
-        "\\epsfig",
-        "\\psfig",
-        "\\epsffile",
-        "\\epsfgetbb",
-    ]:
-        get_arg(words)
-        return [" "]
 
-    if cmd == "\\epsfbox":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" "]
+@command(*SKIPPED_BLOCKS)
+def execute_skipped_block(cmd, words, macros):
+    words.skip_past(SKIPPED_BLOCKS[cmd])
+    return [" "]
 
-    if cmd == "\\figbox" and cmd not in macros:
-        # 0009/cs0009023
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
-        return [" "]
 
-    if cmd == "\\fig" and cmd not in macros:
-        # 0703/math070392
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
+@command("\\xy")
+def execute_xy(cmd, words, macros):
+    # Override xy macros
+    if words.has_ahead("\\endxy"):
+        words.skip_past("\\endxy", begin="\\xy")
         return [" "]
+    return None
 
-    if cmd in ["\\DeclareMathSymbol", "\\mathchoice"]:
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
-        return []
 
-    if cmd in {"\\mathpalette", "\\fontsize"}:
-        get_arg(words)
-        get_arg(words)
-        return []
+@command("\\Tree")
+def execute_tree(cmd, words, macros):
+    # qtree package
+    if cmd in macros:
+        return None
+    nesting = 0
+    while True:
+        word = next(words)
+        if word == "[":
+            nesting += 1
+        elif word == "]":
+            nesting -= 1
+            if nesting == 0:
+                break
+    return [" MATH "]
+
+
+# Accents that take an argument, mapped to the corresponding
+# Unicode combining character.
+ACCENTS = {
+    "\\`": "\u0300",
+    "\\'": "\u0301",
+    "\\^": "\u0302",
+    "\\=": "\u0304",
+    "\\u": "\u0306",
+    "\\.": "\u0307",
+    '\\"': "\u0308",
+    "\\r": "\u030a",
+    "\\H": "\u030c",
+    "\\v": "\u030c",
+    "\\c": "\u0327",
+    "\\d": "\u0323",
+    "\\k": "\u0328",
+    "\\b": "\u0331",
+}
 
-    if cmd == "\\kern":
-        if words.peek() == "{":
-            get_arg(words)
+
+@command(*ACCENTS)
+def execute_accent(cmd, words, macros):
+    # Allow user to override these, but otherwise
+    # translate accent commands to unicode
+    if cmd in macros:
+        return None
+    if cmd in {"\\`", "\\'", "\\="}:
+        # These mean something different in a tabbing environment
+        if words.peek("!") == " ":
+            return None
+        arg_tokens = get_arg(words)
+        if (
+            len(arg_tokens) == 1
+            and len(arg_tokens[0]) == 1
+            and arg_tokens[0].isalpha()
+        ):
+            return ["".join(arg_tokens) + ACCENTS[cmd]]
         else:
-            skip_dimen(words)
-        return [" "]
+            words.prepend(*arg_tokens)
+            return None
+    return ["".join(get_arg(words)) + ACCENTS[cmd]]
 
-    if cmd in ["\\hskip", "\\vskip", "\\mskip"]:
-        skip_glue(words)
-        return [" "]
 
-    if cmd in {"\\hspace", "\\vspace", "\\addvspace"}:
-        # Skip optional asterisk
-        if words.peek("!") == "*":
-            next(words)
-        get_arg(words)
-        return [" "]
+@command("\\~")
+def execute_tilde_accent(cmd, words, macros):
+    if cmd in macros:
+        return None
+    arg = "".join(get_arg(words))
+    if arg.strip():
+        return [arg + "\u0303"]
+    else:
+        return "~"
 
-    if cmd == "\\iftrue":
-        return []
 
-    if cmd == "\\ifdefined" and words.peek("") == "\\hyperref":
-        # Hack: make "\ifdefined\hyperref" true, to handle 1404/1404.2618
+@command(*NO_ARGUMENT_NOOPS)
+def execute_noop(cmd, words, macros):
+    if cmd in macros:
+        return None
+    # If the user hasn't redefined this command, it does nothing
+    # and takes no arguments.(We'd expect them to do nothing anyway,
+    # but the extractor gets confused by {\bf 2}, which gets
+    # interpreted as an abbreviation for the assignment {\bf=2}.)
+    return []
+
+
+@command(
+    r"\ ",
+    r"\,",
+    r"\:",
+    r"\>",
+    "\\enspace",
+    "\\quad",
+    "\\qquad",
+    "\\bigskip",
+    "\\medskip",
+    "\\smallskip",
+    "\\eject",
+    "\\clearpage",
+    "\\cleardoublepage",
+)
+def execute_space(cmd, words, macros):
+    # ignore these (no argument)
+    return [" "]
+
+
+@command(
+    "\\label",
+    "\\message",
+    "\\errmessage",
+    "\\ClassInfo",
+    "\\ClassWarning",
+    "\\ClassWarningNoLine",
+    "\\ClassError",
+    "\\TBInfo",  # tugboat class
+    "\\TBWarning",
+    "\\TBError",
+    "\\TBWarningNL",
+    "\\string",  # valid but unlikely to produce anything helpful.
+    "\\linethickness",
+    "\\newsavebox",
+    "\\enlargethispage",
+    "\\special",
+    "\\rlap",
+    "\\llap",
+    "\\ding",
+    "\\nocite",
+    # mathtools
+    "\\noeqref",
+)
+def execute_ignored_with_arg(cmd, words, macros):
+    # ignore these (and their argument)
+    # Skip optional asterisk
+    if words.peek("!") == "*":
         next(words)
-        return []
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return []
 
-    if cmd in ["\\hyperlink", "\\hypertarget"]:
-        get_arg(words)  # skip a label
-        return []
 
-    if cmd in TEX_IFS:
-        # Treat all built-in conditionals as false.
-        # (except iftrue, which we handled above)
-        skip_rest_conditional(words, macros, stop_on_else=True)
-        return []
+@command("\\index")
+def execute_index(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    if "two-argument \\index" in macros:
+        get_arg(words)
+    return []
 
-    if cmd == "\\else":
-        skip_rest_conditional(words, macros, stop_on_else=False)
-        return []
 
-    if cmd == "\\fi":
-        return []
+@command(
+    "\\asciiabstract",
+    "\\epsfig",
+    "\\psfig",
+    "\\epsffile",
+    "\\epsfgetbb",
+)
+def execute_figure_file(cmd, words, macros):
+    get_arg(words)
+    return [" "]
 
-    if cmd == "\\loop":
-        # Ignore primitive loops
-        while next(words) != "\\repeat":
-            pass
-        return []
 
-    if cmd == "\\penalty":
-        # Skip an integer
-        skip_int(words)
-        return []
+@command("\\epsfbox")
+def execute_epsfbox(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" "]
 
-    if cmd in ["\\hbox", "\\vbox", "\\vtop", "\\hrule", "\\vrule"]:
-        # print("X1: ", cmd, words[:10])
-        while try_skip_keywords(
-            words, ["width", "height", "depth", "to", "spread"]
-        ):
-            # print("X2: ", cmd, words[:10])
-            try_assign(words, allow_space=True)
-            # print("X3: ", cmd, words[:10])
-        # print("X4: ", cmd, words[:10])
-        return []
 
-    if cmd == "\\rule":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        get_arg(words)
-        return [" "]
+@command("\\figbox")
+def execute_figbox(cmd, words, macros):
+    # 0009/cs0009023
+    if cmd in macros:
+        return None
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    return [" "]
 
-    if cmd == "\\raisebox":
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        return []
 
-    if cmd == "\\scalebox":
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        return []
+@command("\\fig")
+def execute_fig(cmd, words, macros):
+    # 0703/math070392
+    if cmd in macros:
+        return None
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    return [" "]
+
+
+@command("\\DeclareMathSymbol", "\\mathchoice")
+def execute_four_args(cmd, words, macros):
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    return []
 
-    if cmd == "\\parbox":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return []
 
-    if cmd in {"\\makebox", "\\framebox"}:
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        return []
+@command("\\mathpalette", "\\fontsize")
+def execute_two_args(cmd, words, macros):
+    get_arg(words)
+    get_arg(words)
+    return []
 
-    if cmd == "\\resizebox":
-        if words.peek("!") == "*":
-            next(words)
-        get_arg(words)
-        get_arg(words)
-        return []
 
-    if cmd in [
-        "\\setlength",
-        "\\addtolength",
-        "\\setcounter",
-        "\\addtocounter",
-    ]:
-        get_arg(words)
+@command("\\kern")
+def execute_kern(cmd, words, macros):
+    if words.peek() == "{":
         get_arg(words)
-        return []
+    else:
+        skip_dimen(words)
+    return [" "]
 
-    if cmd in [
-        "\\advance",
-        "\\multiply",
-        "\\divide",
-    ]:
-        get_arg(words)
-        try_skip_keywords(words, ["by"])
-        skip_num(words)
-        try_skip_units(words)
-
-    if cmd == "\\setbox":
-        # Ignore "\setbox17="
-        # Ignore "\setbox\mybox="
-        # Ignore "\setbox\endbox{...}"
-        skip_ws(words)
-        if words.peek().isdigit():
-            while words.peek().isdigit():
-                next(words)
-        else:
-            next(words)
-        skip_optional_eq(words)
-        return []
 
-    if cmd in ["\\stepcounter", "\\refstepcounter"]:
-        get_arg(words)
-        return []
+@command("\\hskip", "\\vskip", "\\mskip")
+def execute_skip(cmd, words, macros):
+    skip_glue(words)
+    return [" "]
 
-    if cmd == "\\item":
-        skip_optional_arg(words, macros)
-        return [" CASE: "]
 
-    if cmd in ["\\paragraph", "\\subparagraph"]:
-        get_arg(words)
-        return [" CASE: "]
+@command("\\hspace", "\\vspace", "\\addvspace")
+def execute_space_arg(cmd, words, macros):
+    # Skip optional asterisk
+    if words.peek("!") == "*":
+        next(words)
+    get_arg(words)
+    return [" "]
 
-    if cmd in ["\\includegraphics", "\\marginpar", "\\adjincludegraphics"]:
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" "]
 
-    if cmd == "\\marginnote":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        return [" "]
+@command("\\iftrue")
+def execute_iftrue(cmd, words, macros):
+    return []
 
-    if cmd == "\\@ifnextchar":
-        # \define@key is in 1603/1603.00294
-        get_arg(words)
-        get_arg(words)
-        get_arg(words)
-        return []
 
-    if cmd == "\\define@key":
-        # 1603/1603.00294
-        get_arg(words)
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return []
+@command(*(TEX_IFS - {"\\iftrue", "\\ifdefined"}))
+def execute_conditional(cmd, words, macros):
+    # Treat all built-in conditionals as false.
+    # (except iftrue)
+    skip_rest_conditional(words, macros, stop_on_else=True)
+    return []
 
-    if cmd == "\\tablehead" or cmd == "\\tablefirsthead":
-        # supertabular?
-        get_arg(words)
-        return []
 
-    if cmd == "\\todo" and "\\todo" not in macros:
-        # todonotes package
-        skip_optional_arg(words, macros)
-        get_arg(words)
+@command("\\ifdefined")
+def execute_ifdefined(cmd, words, macros):
+    if words.peek("") == "\\hyperref":
+        # Hack: make "\ifdefined\hyperref" true, to handle 1404/1404.2618
+        next(words)
         return []
+    return execute_conditional(cmd, words, macros)
 
-    if cmd == "\\setuptodonotes":
-        # todonotes package
-        get_arg(words)
-        return []
 
-    if cmd == "\\missingfigure":
-        # todonotes package
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" "]
+@command("\\hyperlink", "\\hypertarget")
+def execute_hyperlink(cmd, words, macros):
+    get_arg(words)  # skip a label
+    return []
 
-    if cmd in VERB_COMMANDS:
-        end_ch = next(words)
-        while next(words) != end_ch:
-            pass
-        return [" VERBATIM "]
-
-        # end_ch = next(words)
-        # arg: List[str] = []
-        # while True:
-        #     w = next(words)
-        #     if w == end_ch:
-        #         return "".join(arg)
-        #     else:
-        #         arg.append(w)
-
-    if cmd == "\\lstinputlisting":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" "]
 
-    if cmd == "\\lstset":
-        # Ignore setting defaults for listings package
-        get_arg(words)
-        return []
+@command("\\else")
+def execute_else(cmd, words, macros):
+    skip_rest_conditional(words, macros, stop_on_else=False)
+    return []
 
-    if cmd == "\\ytableausetup":
-        # Ignore settings for ytableau package
-        get_arg(words)
-        return []
 
-    if cmd == "\\footnote":
-        # Footnotes can interrupt sentences, and do not necessarily
-        # contain normal "proof-like" wording.
-        get_arg(words)
-        return []
+@command("\\fi")
+def execute_fi(cmd, words, macros):
+    return []
 
-    if cmd == "\\footnotetext":
-        # Footnotes can interrupt sentences, and do not necessarily
-        # contain normal "proof-like" wording.
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return []
 
-    if cmd in ["\\phantom", "\\hphantom", "\\vphantom"]:
-        # Ignore invisible text
-        get_arg(words)
-        return []
+@command("\\loop")
+def execute_loop(cmd, words, macros):
+    # Ignore primitive loops
+    words.skip_past("\\repeat")
+    return []
 
-    if cmd in ["\\\\", "\\\\*"]:
-        skip_optional_arg(words, macros)
-        return [" "]
 
-    if cmd == "\\savebox":
-        get_arg(words)
-        if words.peek() == "(":
-            while next(words) != ")":
-                pass
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        get_arg(words)  # If we're saving it, it shouldn't be emitted here.
-        return []
+@command("\\penalty")
+def execute_penalty(cmd, words, macros):
+    # Skip an integer
+    skip_int(words)
+    return []
 
-    if cmd == "\\roman":
-        get_arg(words)
-        return ["v"]
-    if cmd == "\\Roman":
-        get_arg(words)
-        return ["V"]
-    if cmd == "\\arabic":
-        get_arg(words)
-        return ["4", "2"]
-    if cmd == "\\alph":
-        get_arg(words)
-        return ["q"]
-    if cmd == "\\Alph":
-        get_arg(words)
-        return ["Q"]
-    if cmd == "\\fnsymbol":
-        get_arg(words)
-        return []
-    if cmd == "\\S":
-        return ["Section "]
-
-    if cmd in {"\\ifthenelse", "\\IfFileExists", "\\iftoggle"}:
-        # Assume the conditional is false;
-        # remove braces around the result
-        condition = get_arg(words)
-        if condition == ["\\isempty", "{", "}"]:
-            # 2002/2002.1279
-            then = get_arg(words)
-            get_arg(words)
-            words.prepend(*then)
-        else:
-            get_arg(words)
-            words.prepend(*get_arg(words))
-            return []
 
-    if cmd == "\\@ifstar":
-        # Assume the conditional is _true_ (1708/1708.06228)
-        # remove braces around the result
-        w1 = get_arg(words)
-        get_arg(words)
-        words.prepend(*w1)
-        return []
+@command("\\hbox", "\\vbox", "\\vtop", "\\hrule", "\\vrule")
+def execute_box(cmd, words, macros):
+    # print("X1: ", cmd, words[:10])
+    while try_skip_keywords(
+        words, ["width", "height", "depth", "to", "spread"]
+    ):
+        # print("X2: ", cmd, words[:10])
+        try_assign(words, allow_space=True)
+        # print("X3: ", cmd, words[:10])
+    # print("X4: ", cmd, words[:10])
+    return []
 
-    if cmd == "\\ifstrequal" or cmd == "\\ifnumequal" or cmd == "\\IfEq":
-        a1 = "".join(get_arg(words))
-        a2 = "".join(get_arg(words))
-        if a1 == a2:
-            then_arg = get_arg(words)
-            get_arg(words)  # skip else
-            words.prepend(*then_arg)
-        else:
-            get_arg(words)
-            # leave the else alone (in braces)
-        return []
 
-    # xstring
-    if cmd == "\\IfBeginWith":
-        if words.peek("!") == "*":
-            next(words)
-        skip_optional_arg(words, macros)
-        a1 = "".join(get_arg(words))
-        a2 = "".join(get_arg(words))
-        if a1.startswith(a2):
-            then_arg = get_arg(words)
-            get_arg(words)  # skip else
-            words.prepend(*then_arg)
-        else:
-            get_arg(words)
-            # leave the else alone (in braces)
-            return []
+@command("\\rule")
+def execute_rule(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    get_arg(words)
+    return [" "]
 
-    if cmd == "\\IfEndWith":
-        if words.peek("!") == "*":
-            next(words)
-        skip_optional_arg(words, macros)
-        a1 = "".join(get_arg(words))
-        a2 = "".join(get_arg(words))
-        if a1.endswith(a2):
-            then_arg = get_arg(words)
-            get_arg(words)  # skip else
-            words.prepend(*then_arg)
-        else:
-            get_arg(words)
-            # leave the else alone (in braces)
-            return []
 
-    if cmd == "\\IfSubStr":
-        if words.peek("!") == "*":
-            next(words)
-        skip_optional_arg(words, macros)
-        a1 = "".join(get_arg(words))
-        a2 = "".join(get_arg(words))
-        if a2 in a1:
-            then_arg = get_arg(words)
-            get_arg(words)  # skip else
-            words.prepend(*then_arg)
-        else:
-            get_arg(words)
-            # leave the else alone (in braces)
-            return []
+@command("\\raisebox")
+def execute_raisebox(cmd, words, macros):
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    return []
+
+
+@command("\\scalebox")
+def execute_scalebox(cmd, words, macros):
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    return []
+
+
+@command("\\parbox")
+def execute_parbox(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return []
+
+
+@command("\\makebox", "\\framebox")
+def execute_makebox(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    return []
+
+
+@command("\\resizebox")
+def execute_resizebox(cmd, words, macros):
+    if words.peek("!") == "*":
+        next(words)
+    get_arg(words)
+    get_arg(words)
+    return []
+
+
+@command(
+    "\\setlength",
+    "\\addtolength",
+    "\\setcounter",
+    "\\addtocounter",
+)
+def execute_setlength(cmd, words, macros):
+    get_arg(words)
+    get_arg(words)
+    return []
+
+
+@command(
+    "\\advance",
+    "\\multiply",
+    "\\divide",
+)
+def execute_arithmetic(cmd, words, macros):
+    get_arg(words)
+    try_skip_keywords(words, ["by"])
+    skip_num(words)
+    try_skip_units(words)
+    return None
 
-    if cmd == "\\IfStrEqual":
-        if words.peek("!") == "*":
-            next(words)
-        skip_optional_arg(words, macros)
-        a1 = "".join(get_arg(words))
-        a2 = "".join(get_arg(words))
-        if a1 == a2:
-            then_arg = get_arg(words)
-            get_arg(words)  # skip else
-            words.prepend(*then_arg)
-        else:
-            get_arg(words)
-            # leave the else alone (in braces)
-            return []
 
-    if cmd == "\\IfEqCase":
-        # still from xstring
-        if words.peek("!") == "*":
+@command("\\setbox")
+def execute_setbox(cmd, words, macros):
+    # Ignore "\setbox17="
+    # Ignore "\setbox\mybox="
+    # Ignore "\setbox\endbox{...}"
+    skip_ws(words)
+    if words.peek().isdigit():
+        while words.peek().isdigit():
             next(words)
-        skip_optional_arg(words, macros)
-        a1 = "".join(get_arg(words))
-        skip_ws(words)
-        found = False
-        then_arg = []
-        if next(words) == "{":
-            while words.peek("!") != "}":
-                a2 = "".join(get_arg(words))
-                if a1 == a2 and not found:
-                    found = True
-                    then_arg = get_arg(words)
-                else:
-                    get_arg(words)
-                skip_ws(words)
-            next(words)  # skip the "}"
-            words.prepend(*then_arg)
+    else:
+        next(words)
+    skip_optional_eq(words)
+    return []
 
-    if cmd == "\\write":
-        if words.peek("q").isdigit():
-            while words.peek("q").isdigit():
-                next(words)
-        else:
-            get_arg(words)
-        skip_ws(words)
+
+@command("\\stepcounter", "\\refstepcounter")
+def execute_stepcounter(cmd, words, macros):
+    get_arg(words)
+    return []
+
+
+@command("\\item")
+def execute_item(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    return [" CASE: "]
+
+
+@command("\\paragraph", "\\subparagraph")
+def execute_paragraph(cmd, words, macros):
+    get_arg(words)
+    return [" CASE: "]
+
+
+@command("\\includegraphics", "\\marginpar", "\\adjincludegraphics")
+def execute_includegraphics(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" "]
+
+
+@command("\\marginnote")
+def execute_marginnote(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    return [" "]
+
+
+@command("\\@ifnextchar")
+def execute_ifnextchar(cmd, words, macros):
+    # \define@key is in 1603/1603.00294
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    return []
+
+
+@command("\\define@key")
+def execute_define_key(cmd, words, macros):
+    # 1603/1603.00294
+    get_arg(words)
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return []
+
+
+@command("\\tablehead", "\\tablefirsthead")
+def execute_tablehead(cmd, words, macros):
+    # supertabular?
+    get_arg(words)
+    return []
+
+
+@command("\\todo")
+def execute_todo(cmd, words, macros):
+    # todonotes package
+    if cmd in macros:
+        return None
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return []
+
+
+@command("\\setuptodonotes")
+def execute_setuptodonotes(cmd, words, macros):
+    # todonotes package
+    get_arg(words)
+    return []
+
+
+@command("\\missingfigure")
+def execute_missingfigure(cmd, words, macros):
+    # todonotes package
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" "]
+
+
+@command(*VERB_COMMANDS)
+def execute_verb(cmd, words, macros):
+    end_ch = next(words)
+    words.skip_past(end_ch)
+    return [" VERBATIM "]
+
+    # end_ch = next(words)
+    # arg: List[str] = []
+    # while True:
+    #     w = next(words)
+    #     if w == end_ch:
+    #         return "".join(arg)
+    #     else:
+    #         arg.append(w)
+
+
+@command("\\lstinputlisting")
+def execute_lstinputlisting(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" "]
+
+
+@command("\\lstset")
+def execute_lstset(cmd, words, macros):
+    # Ignore setting defaults for listings package
+    get_arg(words)
+    return []
+
+
+@command("\\ytableausetup")
+def execute_ytableausetup(cmd, words, macros):
+    # Ignore settings for ytableau package
+    get_arg(words)
+    return []
+
+
+@command("\\footnote")
+def execute_footnote(cmd, words, macros):
+    # Footnotes can interrupt sentences, and do not necessarily
+    # contain normal "proof-like" wording.
+    get_arg(words)
+    return []
+
+
+@command("\\footnotetext")
+def execute_footnotetext(cmd, words, macros):
+    # Footnotes can interrupt sentences, and do not necessarily
+    # contain normal "proof-like" wording.
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return []
+
+
+@command("\\phantom", "\\hphantom", "\\vphantom")
+def execute_phantom(cmd, words, macros):
+    # Ignore invisible text
+    get_arg(words)
+    return []
+
+
+@command("\\\\", "\\\\*")
+def execute_newline(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    return [" "]
+
+
+@command("\\savebox")
+def execute_savebox(cmd, words, macros):
+    get_arg(words)
+    if words.peek() == "(":
+        words.skip_past(")")
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    get_arg(words)  # If we're saving it, it shouldn't be emitted here.
+    return []
+
+
+# Counter-formatting commands, mapped to what we pretend they produce.
+COUNTER_FORMATS = {
+    "\\roman": ["v"],
+    "\\Roman": ["V"],
+    "\\arabic": ["4", "2"],
+    "\\alph": ["q"],
+    "\\Alph": ["Q"],
+    "\\fnsymbol": [],
+}
+
+
+@command(*COUNTER_FORMATS)
+def execute_counter_format(cmd, words, macros):
+    get_arg(words)
+    return list(COUNTER_FORMATS[cmd])
+
+
+@command("\\S")
+def execute_section_sign(cmd, words, macros):
+    return ["Section "]
+
+
+@command("\\ifthenelse", "\\IfFileExists", "\\iftoggle")
+def execute_ifthenelse(cmd, words, macros):
+    # Assume the conditional is false;
+    # remove braces around the result
+    condition = get_arg(words)
+    if condition == ["\\isempty", "{", "}"]:
+        # 2002/2002.1279
+        then = get_arg(words)
         get_arg(words)
+        words.prepend(*then)
+        return None
+    else:
+        get_arg(words)
+        words.prepend(*get_arg(words))
         return []
 
-    if cmd == "\\protected@write":
-        if words.peek("q").isdigit():
-            while words.peek("q").isdigit():
-                next(words)
-        else:
-            get_arg(words)
-        skip_ws(words)
+
+@command("\\@ifstar")
+def execute_ifstar(cmd, words, macros):
+    # Assume the conditional is _true_ (1708/1708.06228)
+    # remove braces around the result
+    w1 = get_arg(words)
+    get_arg(words)
+    words.prepend(*w1)
+    return []
+
+
+@command("\\ifstrequal", "\\ifnumequal", "\\IfEq")
+def execute_ifstrequal(cmd, words, macros):
+    a1 = "".join(get_arg(words))
+    a2 = "".join(get_arg(words))
+    if a1 == a2:
+        then_arg = get_arg(words)
+        get_arg(words)  # skip else
+        words.prepend(*then_arg)
+    else:
         get_arg(words)
+        # leave the else alone (in braces)
+    return []
+
+
+# xstring conditionals, mapped to their test
+XSTRING_TESTS = {
+    "\\IfBeginWith": lambda a1, a2: a1.startswith(a2),
+    "\\IfEndWith": lambda a1, a2: a1.endswith(a2),
+    "\\IfSubStr": lambda a1, a2: a2 in a1,
+    "\\IfStrEqual": lambda a1, a2: a1 == a2,
+}
+
+
+@command(*XSTRING_TESTS)
+def execute_xstring_test(cmd, words, macros):
+    if words.peek("!") == "*":
+        next(words)
+    skip_optional_arg(words, macros)
+    a1 = "".join(get_arg(words))
+    a2 = "".join(get_arg(words))
+    if XSTRING_TESTS[cmd](a1, a2):
+        then_arg = get_arg(words)
+        get_arg(words)  # skip else
+        words.prepend(*then_arg)
+        return None
+    else:
         get_arg(words)
+        # leave the else alone (in braces)
         return []
 
-    if cmd in [
-        "\\section",
-        "\\subsection",
-        "\\subsubsection",
-        "\\paragraph",
-        "\\subparagraph",
-    ]:
-        # Skip optional asterisk
-        if words.peek("!") == "*":
+
+@command("\\IfEqCase")
+def execute_ifeqcase(cmd, words, macros):
+    # still from xstring
+    if words.peek("!") == "*":
+        next(words)
+    skip_optional_arg(words, macros)
+    a1 = "".join(get_arg(words))
+    skip_ws(words)
+    found = False
+    then_arg = []
+    if next(words) == "{":
+        while words.peek("!") != "}":
+            a2 = "".join(get_arg(words))
+            if a1 == a2 and not found:
+                found = True
+                then_arg = get_arg(words)
+            else:
+                get_arg(words)
+            skip_ws(words)
+        next(words)  # skip the "}"
+        words.prepend(*then_arg)
+    return None
+
+
+@command("\\write")
+def execute_write(cmd, words, macros):
+    if words.peek("q").isdigit():
+        while words.peek("q").isdigit():
             next(words)
-        # OK, this is debatable, but we will completely ignore the
-        #    contents of section/paragraph/etc. headers.
-        # They're rarely full sentences, and often lack periods
-        #    so they get glommed on to the first sentence of the
-        #    section/paragraph itself.
+    else:
         get_arg(words)
-        return [" CASE: "]
+    skip_ws(words)
+    get_arg(words)
+    return []
 
-    if cmd == "\\htmladdnormallink":
-        # Ignore the second argument, but not the first.
-        arg1 = get_arg(words)
-        get_arg(words)  # skip hyperlink
-        words.prepend(*arg1)
-        return []
 
-    if cmd == "\\href":
-        skip_optional_arg(words, macros)
-        get_arg(words)  # url
-        return []  # will emit the text argument normally
+@command("\\protected@write")
+def execute_protected_write(cmd, words, macros):
+    if words.peek("q").isdigit():
+        while words.peek("q").isdigit():
+            next(words)
+    else:
+        get_arg(words)
+    skip_ws(words)
+    get_arg(words)
+    get_arg(words)
+    return []
 
-    if cmd == "\\hyperref" and cmd not in macros:
-        skip_ws(words)
-        if words.peek() == "[":
-            skip_optional_arg(words, macros)
-            return []  # will emit the text argument normally
-        else:
-            get_arg(words)
-            get_arg(words)
-            get_arg(words)
-            return []  # will emit the text argument normally
 
-    if cmd in {"\\color", "\\textcolor", "\\colorbox"}:
-        skip_optional_arg(words, macros)
-        get_arg(words)  # color
-        return []
+@command(
+    "\\section",
+    "\\subsection",
+    "\\subsubsection",
+)
+def execute_section(cmd, words, macros):
+    # Skip optional asterisk
+    if words.peek("!") == "*":
+        next(words)
+    # OK, this is debatable, but we will completely ignore the
+    #    contents of section/paragraph/etc. headers.
+    # They're rarely full sentences, and often lack periods
+    #    so they get glommed on to the first sentence of the
+    #    section/paragraph itself.
+    get_arg(words)
+    return [" CASE: "]
+
+
+@command("\\htmladdnormallink")
+def execute_htmladdnormallink(cmd, words, macros):
+    # Ignore the second argument, but not the first.
+    arg1 = get_arg(words)
+    get_arg(words)  # skip hyperlink
+    words.prepend(*arg1)
+    return []
+
+
+@command("\\href")
+def execute_href(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)  # url
+    return []  # will emit the text argument normally
 
-    if cmd == "\\definecolor":  # tikz
+
+@command("\\hyperref")
+def execute_hyperref(cmd, words, macros):
+    if cmd in macros:
+        return None
+    skip_ws(words)
+    if words.peek() == "[":
+        skip_optional_arg(words, macros)
+        return []  # will emit the text argument normally
+    else:
         get_arg(words)
         get_arg(words)
         get_arg(words)
-        return []
+        return []  # will emit the text argument normally
 
-    if cmd == "\\colorlet":  # tikz
-        get_arg(words)
-        get_arg(words)
-        return []
 
-    if cmd == "\\tikzset":
-        get_arg(words)  # ignore argument
-        return []
+@command("\\color", "\\textcolor", "\\colorbox")
+def execute_color(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)  # color
+    return []
 
-    if cmd == "\\tikzmath":
-        get_arg(words)  # ignore argument
-        return [" MATH "]
 
-    if cmd == "\\adjustimage":
-        get_arg(words)
-        get_arg(words)
-        return [" "]
+@command("\\definecolor")
+def execute_definecolor(cmd, words, macros):
+    # tikz
+    get_arg(words)
+    get_arg(words)
+    get_arg(words)
+    return []
 
-    if cmd in {
-        "\\AxiomC",
-        "\\UnaryInfC",
-        "\\BinaryInfC",
-        "\\TrinaryInfC",
-        "\\QuaternaryInfC",
-        "\\QuinaryInfC",
-        "\\LeftLabel",
-        "\\RightLabel",
-    }:
-        # bussproofs, e.g., 1708/1708.05896
-        get_arg(words)
-        return [""]
 
-    if cmd == "\\DisplayProof":
-        # bussproofs, e.g., 1708/1708.05896
-        return [" MATH "]
+@command("\\colorlet")
+def execute_colorlet(cmd, words, macros):
+    # tikz
+    get_arg(words)
+    get_arg(words)
+    return []
 
-    if cmd in {"\\noLine", "\\doubleLine"}:
-        # bussproofs, e.g., 1708/1708.05896
-        return [""]
 
-    if cmd == "\\adjustbox":
-        get_arg(words)  # ignore scaling
-        # implicitly leave the content alone
-        return []
+@command("\\tikzset")
+def execute_tikzset(cmd, words, macros):
+    get_arg(words)  # ignore argument
+    return []
 
-    if cmd == "\\tikz":
-        skip_optional_arg(words, macros)
-        if words.peek() == "{":
-            get_arg(words)
-        else:
-            while True:
-                if next(words) == ";":
-                    break
 
-    if cmd == "\\tikzstyle":
-        get_arg(words)
-        skip_optional_eq(words)
-        skip_optional_arg(words, macros)
-        return []
+@command("\\tikzmath")
+def execute_tikzmath(cmd, words, macros):
+    get_arg(words)  # ignore argument
+    return [" MATH "]
 
-    if cmd == "\\pdfstringdefDisableCommands":
-        # hyperref
-        get_arg(words)
-        return []
 
-    if cmd == "\\textattachfile":
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        # implicitly leave the text alone
-        return []
+@command("\\adjustimage")
+def execute_adjustimage(cmd, words, macros):
+    get_arg(words)
+    get_arg(words)
+    return [" "]
 
-    if cmd == "\\theoremstyle":
-        get_arg(words)
 
-    if cmd == "\\newtheorem":
-        get_arg(words)
-        skip_optional_arg(words, macros)
+@command(
+    "\\AxiomC",
+    "\\UnaryInfC",
+    "\\BinaryInfC",
+    "\\TrinaryInfC",
+    "\\QuaternaryInfC",
+    "\\QuinaryInfC",
+    "\\LeftLabel",
+    "\\RightLabel",
+)
+def execute_bussproofs_arg(cmd, words, macros):
+    # bussproofs, e.g., 1708/1708.05896
+    get_arg(words)
+    return [""]
+
+
+@command("\\DisplayProof")
+def execute_displayproof(cmd, words, macros):
+    # bussproofs, e.g., 1708/1708.05896
+    return [" MATH "]
+
+
+@command("\\noLine", "\\doubleLine")
+def execute_bussproofs_line(cmd, words, macros):
+    # bussproofs, e.g., 1708/1708.05896
+    return [""]
+
+
+@command("\\adjustbox")
+def execute_adjustbox(cmd, words, macros):
+    get_arg(words)  # ignore scaling
+    # implicitly leave the content alone
+    return []
+
+
+@command("\\tikz")
+def execute_tikz(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    if words.peek() == "{":
         get_arg(words)
-        skip_optional_arg(words, macros)
+    else:
+        words.skip_past(";")
+    return None
+
+
+@command("\\tikzstyle")
+def execute_tikzstyle(cmd, words, macros):
+    get_arg(words)
+    skip_optional_eq(words)
+    skip_optional_arg(words, macros)
+    return []
+
+
+@command("\\pdfstringdefDisableCommands")
+def execute_pdfstringdefdisablecommands(cmd, words, macros):
+    # hyperref
+    get_arg(words)
+    return []
+
+
+@command("\\textattachfile")
+def execute_textattachfile(cmd, words, macros):
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    # implicitly leave the text alone
+    return []
+
+
+@command("\\theoremstyle")
+def execute_theoremstyle(cmd, words, macros):
+    get_arg(words)
+    return None
+
+
+@command("\\newtheorem")
+def execute_newtheorem(cmd, words, macros):
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    return []
+
+
+@command("\\lq")
+def execute_lq(cmd, words, macros):
+    if words.peek() == "\\lq":
+        next(words)
+        return ['"']
+    else:
+        return ["`"]
+
+
+@command("\\rq")
+def execute_rq(cmd, words, macros):
+    if words.peek() == "\\rq":
+        next(words)
+        return ['"']
+    else:
+        return ["'"]
+
+
+XSPACE_EXCEPTIONS = {
+    ",",
+    ".",
+    "’",
+    "'",
+    "/",
+    "?",
+    ";",
+    ":",
+    "!",
+    "~",
+    "-",
+    ")",
+    "\\ ",
+    "\\/",
+    "\\bgroup",
+    "\\egroup",
+    "\\@sptoken",
+    "\\space",
+    "\\@xobeysp",
+    "\\footnote",
+    "\\footnotemark",
+}
+
+
+@command("\\xspace")
+def execute_xspace(cmd, words, macros):
+    upcoming = words.peek(".")
+    if upcoming not in XSPACE_EXCEPTIONS:
+        return [" "]
+    else:
         return []
 
-    if cmd == "\\lq":
-        if words.peek() == "\\lq":
-            next(words)
-            return ['"']
-        else:
-            return ["`"]
 
-    if cmd == "\\rq":
-        if words.peek() == "\\rq":
+@command("\\put")
+def execute_put(cmd, words, macros):
+    if cmd in macros:
+        return None
+    words.skip_past(")")
+    get_arg(words)
+    return []
+
+
+# @command("\\useshorthands", "\\useshorthands*")
+# def execute_useshorthands(cmd, words, macros):
+#     if '"' in "".join(get_arg(words)):
+#         macros["german shorthands"] = True
+#         print("GS")
+#         exit(-1)
+#     return []
+
+
+@command("\\languageshorthands")
+def execute_languageshorthands(cmd, words, macros):
+    argument = "".join(get_arg(words))
+    if "german" in argument:
+        macros["german shorthands"] = True
+    return []
+
+
+@command("\\catcode")
+def execute_catcode(cmd, words, macros):
+    # 1504/1504.0647
+    # Terrible hack to check for german shorthands
+    if words.startswith(["`", '"', "=", "1", "3"]):
+        macros["german shorthands"] = True
+        for i in range(5):
             next(words)
-            return ['"']
-        else:
-            return ["'"]
-
-    if cmd == "\\xspace":
-        XSPACE_EXCEPTIONS = {
-            ",",
-            ".",
-            "’",
-            "'",
-            "/",
-            "?",
-            ";",
-            ":",
-            "!",
-            "~",
-            "-",
-            ")",
-            "\\ ",
-            "\\/",
-            "\\bgroup",
-            "\\egroup",
-            "\\@sptoken",
-            "\\space",
-            "\\@xobeysp",
-            "\\footnote",
-            "\\footnotemark",
-        }
-        upcoming = words.peek(".")
-        if upcoming not in XSPACE_EXCEPTIONS:
-            return [" "]
-        else:
-            return []
+    return []
+
+
+@command("\\char")
+def execute_char(cmd, words, macros):
+    if words.peek("x") == "`":
+        next(words)
+        character = next(words).lstrip("\\")
+        return [character]
+    else:
+        number: int = 0
+        while words.peek("x").isdigit():
+            number = number * 10 + ord(next(words)) - ord("0")
+        if number >= ord(" ") and number <= ord("~"):
+            return [chr(number)]
+    return None
+
+
+@command("\\ednote")
+def execute_ednote(cmd, words, macros):
+    # 2004/2004.08576
+    get_arg(words)
+    return []
+
+
+@command("\\the")
+def execute_the(cmd, words, macros):
+    get_arg(words)
+    return ["42"]
+
+
+@command("\\thechapter", "\\thesection", "\\thesubsection")
+def execute_thesection(cmd, words, macros):
+    return ["42"]
+
+
+@command("\\tabto")
+def execute_tabto(cmd, words, macros):
+    get_arg(words)
+    return [" "]
+
+
+@command("\\glossary")
+def execute_glossary(cmd, words, macros):
+    get_arg(words)
+    return []
+
+
+@command("\\setboolean")
+def execute_setboolean(cmd, words, macros):
+    get_arg(words)
+    get_arg(words)
+    return []
+
+
+@command("\\psfrag")
+def execute_psfrag(cmd, words, macros):
+    if words.peek("!") == "*":
+        next(words)
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" "]
+
+
+@command("\\infax")
+def execute_infax(cmd, words, macros):
+    # probably from bcprules.sty
+    if cmd in macros:
+        return None
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    return [" MATH "]
 
-    if cmd == "\\put" and cmd not in macros:
-        while next(words) != ")":
-            pass
-        get_arg(words)
-        return []
 
-    # if cmd == "\\useshorthands" or cmd == "\\useshorthands*":
-    #     if '"' in "".join(get_arg(words)):
-    #         macros["german shorthands"] = True
-    #         print("GS")
-    #         exit(-1)
-    #     return []
-
-    if cmd == "\\languageshorthands":
-        argument = "".join(get_arg(words))
-        if "german" in argument:
-            macros["german shorthands"] = True
-        return []
+@command("\\infrule")
+def execute_infrule(cmd, words, macros):
+    # probably from bcprules.sty
+    if cmd in macros:
+        return None
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    get_arg(words)
+    return [" MATH "]
 
-    if cmd == "\\catcode":
-        # 1504/1504.0647
-        # Terrible hack to check for german shorthands
-        if words[:5] == ["`", '"', "=", "1", "3"]:
-            macros["german shorthands"] = True
-            for i in range(5):
-                next(words)
-        return []
 
-    if cmd == "\\char":
-        if words.peek("x") == "`":
-            next(words)
-            character = next(words).lstrip("\\")
-            return [character]
-        else:
-            number: int = 0
-            while words.peek("x").isdigit():
-                number = number * 10 + ord(next(words)) - ord("0")
-            if number >= ord(" ") and number <= ord("~"):
-                return [chr(number)]
+@command("\\bordermatrix")
+def execute_bordermatrix(cmd, words, macros):
+    get_arg(words)
+    return [" MATH "]
 
-    if cmd == "\\ednote":
-        # 2004/2004.08576
-        get_arg(words)
-        return []
 
-    if cmd == "\\the":
-        get_arg(words)
-        return ["42"]
+@command("\\hvFloat")
+def execute_hvfloat(cmd, words, macros):
+    if words.peek("!") == "*":
+        next(words)
+    # from hvfloat.sty
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    get_arg(words)
+    skip_optional_arg(words, macros)
+    get_arg(words)
+    get_arg(words)
+    return None
 
-    if cmd in {"\\thechapter", "\\thesection", "\\thesubsection"}:
-        return ["42"]
 
-    if cmd == "\\tabto":
-        get_arg(words)
-        return [" "]
+def skip_to_lbrace(words):
+    """Discard tokens up to (but not including) the next left brace."""
+    while words.peek() != "{":
+        next(words)
 
-    if cmd == "\\glossary":
-        get_arg(words)
-        return []
 
-    if cmd == "\\setboolean":
-        get_arg(words)
-        get_arg(words)
-        return []
+#
+# Cache of what local style files do to the macro table
+#
+# Many papers include the same local .sty/.cls files. When process_file
+# is given a cache directory, we remember what loading each one added
+# to macros (and which existing entries of macros it looked at), so
+# that the next paper loading the same file with the same relevant
+# definitions can just merge in the result.
+#
 
-    if cmd == "\\psfrag":
-        if words.peek("!") == "*":
-            next(words)
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" "]
 
-    if cmd == "\\infax" and cmd not in macros:
-        # probably from bcprules.sty
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        return [" MATH "]
+class RecordingDict(dict):
+    """
+    A copy of a macro table that records which entries were used.
 
-    if cmd == "\\infrule" and cmd not in macros:
-        # probably from bcprules.sty
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        get_arg(words)
-        return [" MATH "]
+    Lookups are recorded in terms of the original table: keys it
+    contains (with their original values), and keys it lacks.
+    We also record which keys were assigned.
+    """
 
-    if cmd == "\\bordermatrix":
-        get_arg(words)
-        return [" MATH "]
+    def __init__(self, original: dict):
+        super().__init__(original)
+        # Lists (e.g., "new ifs", "math envs") are updated in place
+        for key, value in original.items():
+            if isinstance(value, list):
+                dict.__setitem__(self, key, list(value))
+        self.original = original
+        self.present: dict = {}
+        self.absent: set = set()
+        self.written: set = set()
+
+    def note(self, key):
+        """Record a lookup of key."""
+        if key not in self.present and key not in self.absent:
+            if key in self.original:
+                self.present[key] = self.original[key]
+            else:
+                self.absent.add(key)
+
+    def __contains__(self, key):
+        self.note(key)
+        return super().__contains__(key)
+
+    def __getitem__(self, key):
+        self.note(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.note(key)
+        return super().get(key, default)
+
+    def __setitem__(self, key, value):
+        self.written.add(key)
+        super().__setitem__(key, value)
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def changes(self) -> dict:
+        """Return the entries that differ from the original table."""
+        return {
+            key: value
+            for key, value in dict.items(self)
+            if key in self.written
+            or (isinstance(value, list) and value != self.original[key])
+        }
 
-    if cmd == "\hvFloat":
-        if words.peek("!") == "*":
-            next(words)
-        # from hvfloat.sty
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        get_arg(words)
-        skip_optional_arg(words, macros)
-        get_arg(words)
-        get_arg(words)
 
-    if cmd in macros:
-        if cmd == "\\BoxedEPSF":
-            # Hack for 0002/math0002136/zinno.tex
-            get_arg(words)
-            return []
+def load_style_file(
+    filename: Path,
+    directory,
+    macros,
+    verbose=False,
+    debug=False,
+    strip=True,
+    input_nesting=0,
+) -> List[str]:
+    """
+    Interpret a local style file, returning any proofs it contains.
 
-        if macros[cmd] != "frozen":
-            # print(f"calling try_expand on {cmd}")
-            expansion = try_expand(words, *macros[cmd])
-            # Filter out recursion!
-            expansion = [
-                w if w != cmd else "\\nopenopenope " for w in expansion
-            ]
-            words.prepend(*expansion)
-            # print(words[:10])
-            return []
+    If macros["style cache"] names a directory, reuses the cached effect
+    of the file on macros when possible.
+    """
+    global files_read
+    # Not macros.get, which would record a lookup in a RecordingDict
+    style_cache = dict.get(macros, "style cache")
+    if not style_cache or debug:
+        subwords = get_words(filename.as_posix(), macros["tokenizer"])
+        if verbose or debug or True:
+            print(f"  loading {filename}", file=sys.stderr)
+        return get_all_proofs(
+            subwords, directory, macros, verbose, debug, strip, input_nesting
+        )
 
-    if nomath and cmd in MATHONLY_COMMANDS:
-        print(
-            f"Oops: encountered {cmd} before "
-            f'{" ".join(words[:20])} ({os.getpid()})',
-            file=sys.stdout if debug else sys.stderr,
+    resolved = resolve_filename(filename.as_posix())
+    with archives.open_file(resolved, "rb") as fd:
+        digest = hashlib.sha256(fd.read())
+    digest.update(extractor_version().encode())
+    digest.update(f"{strip} {input_nesting}".encode())
+    key = digest.hexdigest()
+    entry_path = Path(style_cache) / key[:2] / f"{key}.pickle"
+
+    entry = load_style_entry(entry_path, directory, macros)
+    if entry:
+        print(f"  loading {filename} (cached)", file=sys.stderr)
+        macros.update(entry["delta"])
+        if files_read is not None:
+            files_read.extend(
+                os.path.join(directory, name) for name in entry["files"]
+            )
+        return entry["proofs"]
+
+    # Load the file into a copy of macros, and see what changed.
+    outer_files_read, files_read = files_read, []
+    recording = RecordingDict(macros)
+    try:
+        subwords = get_words(resolved, macros["tokenizer"])
+        print(f"  loading {filename}", file=sys.stderr)
+        proofs = get_all_proofs(
+            subwords,
+            directory,
+            recording,
+            verbose,
+            debug,
+            strip,
+            input_nesting,
         )
-        raise SkipThisProof(f"oops: encountered {cmd}")
-
-    if inproof and cmd in {
-        "\\psset",
-        "\\psline",
-        "\\rput",
-        "\\uput",
-        "\\pspolyline",
-        "\\newrgbcolor",
-        "\\pscircle",
-        "\\qline",
-        "\\ncline",
-    }:
-        raise SkipThisProof(f"oops: encountered {cmd}")
-
-    if try_assign(words):
-        return []
+    finally:
+        delta = recording.changes()
+        macros.update(delta)
+        style_files, files_read = files_read, outer_files_read
+        if files_read is not None:
+            files_read.extend(style_files)
+
+    save_style_entry(
+        entry_path,
+        {
+            "files": {
+                os.path.relpath(name, directory): file_hash(name)
+                for name in style_files
+            },
+            "present": recording.present,
+            "absent": recording.absent,
+            "delta": delta,
+            "proofs": proofs,
+        },
+    )
+    return proofs
 
-    return []
+
+def load_style_entry(entry_path: Path, directory, macros) -> Optional[dict]:
+    """Return a cached effect of a style file, if one applies here."""
+    for variant in read_style_variants(entry_path):
+        try:
+            if any(
+                file_hash(os.path.join(directory, name)) != digest
+                for name, digest in variant["files"].items()
+            ):
+                continue
+        except OSError:
+            continue
+        if any(
+            key not in macros or macros[key] != value
+            for key, value in variant["present"].items()
+        ):
+            continue
+        if any(key in macros for key in variant["absent"]):
+            continue
+        # Mark the entry as recently used, for evict_cache
+        os.utime(entry_path)
+        return variant
+    return None
 
 
-def skip_to_lbrace(words):
-    """Discard tokens up to (but not including) the next left brace."""
-    while words.peek() != "{":
-        next(words)
+# How many versions of the effect of one style file we keep
+# (e.g., for a file loaded before and after some other package).
+STYLE_VARIANTS = 4
+
+
+def read_style_variants(entry_path: Path) -> List[dict]:
+    """Read the cached effects of a style file."""
+    try:
+        with entry_path.open("rb") as fd:
+            return pickle.load(fd)  # nosec
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return []
+
+
+def save_style_entry(entry_path: Path, variant: dict):
+    """Add an effect of a style file to the cache."""
+    variants = read_style_variants(entry_path)[-(STYLE_VARIANTS - 1) :]
+    variants.append(variant)
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = entry_path.with_suffix(f".{os.getpid()}")
+    with temp_path.open("wb") as fd:
+        pickle.dump(variants, fd)
+    os.replace(temp_path, entry_path)
 
 
 def get_all_proofs(
@@ -2858,7 +4059,9 @@ def get_proofs(
                 ):
                     pass
                 else:
-                    macros[name] = (parameters, optional_arg, body)
+                    macros[name] = compile_macro(
+                        parameters, optional_arg, body
+                    )
                 # print("defined ", name, macros[name])
 
         elif w == "\\csdef":
@@ -2877,12 +4080,31 @@ def get_proofs(
             ):
                 subfname: Path = directory / fn
                 try:
-                    try:
-                        subwords = get_words(subfname.as_posix() + ".tex")
+                    tex_filename = find_file(subfname.as_posix() + ".tex")
+                    if skippable_inputs and (
+                        os.path.normpath(
+                            tex_filename
+                            or resolve_filename(subfname.as_posix())
+                        )
+                        in skippable_inputs
+                    ):
+                        input_filename = tex_filename or subfname.as_posix()
+                        if files_read is not None:
+                            # Results still depend on what it contains
+                            files_read.append(resolve_filename(input_filename))
+                        print(
+                            f"  skipping {input_filename} (no proofs)",
+                            file=sys.stderr,
+                        )
+                        continue
+                    if tex_filename is not None:
+                        subwords = get_words(tex_filename, macros["tokenizer"])
                         if verbose or debug or True:
                             print(f"  loading {subfname}.tex", file=sys.stderr)
-                    except FileNotFoundError:
-                        subwords = get_words(subfname.as_posix())
+                    else:
+                        subwords = get_words(
+                            subfname.as_posix(), macros["tokenizer"]
+                        )
                         if verbose or debug or True:
                             print(f"  loading {subfname}", file=sys.stderr)
 
@@ -2939,12 +4161,13 @@ def get_proofs(
                 ):
                     continue
                 subfname = directory / fn
+                if find_file(subfname.as_posix()) is None:
+                    # Probably a standard library package
+                    # For now, we won't try to find these.
+                    continue
                 try:
-                    subwords = get_words(subfname.as_posix())
-                    if verbose or debug or True:
-                        print(f"  loading {subfname}", file=sys.stderr)
-                    subproofs = get_all_proofs(
-                        subwords,
+                    subproofs = load_style_file(
+                        subfname,
                         directory,
                         macros,
                         verbose,
@@ -2954,8 +4177,7 @@ def get_proofs(
                     )
                     proofs.extend(subproofs)
                 except FileNotFoundError:
-                    # Probably a standard library package
-                    # For now, we won't try to find these.
+                    # e.g., a dangling symbolic link
                     pass
 
         elif w in [
@@ -2978,12 +4200,14 @@ def get_proofs(
                 else:
                     if debug:
                         print("  defined", name)
-                    macros[name] = (parameters, optional_args, body)
+                    macros[name] = compile_macro(
+                        parameters, optional_args, body
+                    )
 
         elif w in ["\\newcounter"]:
             counterName = "".join(get_arg(words))
             skip_optional_arg(words, macros)
-            macros["\\the" + counterName] = ([[]], [], ["4", "2"])
+            macros["\\the" + counterName] = compile_macro([[]], [], ["4", "2"])
 
         elif w in ["\\newenvironment", "\\renewenvironment"]:
             # Skip optional asterisk
@@ -3021,7 +4245,8 @@ def get_proofs(
                     or ("\\begin{eqnarray}" in begin_code)
                     or ("\\begin{eqnarray*}" in begin_code)
                 ):
-                    MATH_ENVS.add(env_name)
+                    # Per paper (in macros, so the style cache sees it)
+                    macros["math envs"].append(env_name)
 
             else:
                 skip_to_lbrace(words)
@@ -3032,18 +4257,14 @@ def get_proofs(
             newif = "".join(get_arg(words))
             macros["new ifs"].append(newif)
             # \iftest
-            macros[newif] = ([[]], [], ["\\iffalse"])
+            macros[newif] = compile_macro([[]], [], ["\\iffalse"])
             # \testtrue
-            macros["\\" + newif[3:] + "true"] = (
-                [[]],
-                [],
-                ["\\let", newif, "\\iftrue"],
+            macros["\\" + newif[3:] + "true"] = compile_macro(
+                [[]], [], ["\\let", newif, "\\iftrue"]
             )
             # \testfalse
-            macros["\\" + newif[3:] + "false"] = (
-                [[]],
-                [],
-                ["\\let", newif, "\\iffalse"],
+            macros["\\" + newif[3:] + "false"] = compile_macro(
+                [[]], [], ["\\let", newif, "\\iffalse"]
             )
 
         elif w == "\\begin":
@@ -3090,7 +4311,10 @@ def get_proofs(
                         #   {\myref{foo}} gives us...
                         words.prepend(*(["{"] + maybe_arg + ["}", " "]))
 
-            elif env_name.rstrip("*") in MATH_ENVS:
+            elif (
+                env_name.rstrip("*") in MATH_ENVS
+                or env_name.rstrip("*") in macros["math envs"]
+            ):
                 fp = skip_rest_env(words, macros)
                 if proof_nesting > 0:
                     current_proof_words.append(" MATH ")
@@ -3272,18 +4496,17 @@ def get_proofs(
                 #  number of arguments, which is common).
                 if rhs.startswith("\\"):
                     macros[rhs] = "frozen"
-                macros[lhs] = ([[]], None, [rhs])
+                macros[lhs] = compile_macro([[]], None, [rhs])
                 if debug:
                     print(f"  ... as macro for {rhs}")
             else:
                 # Something weird like   \let~=\space
                 pass
 
-        elif w == "{" and words[:3] == ["e", "q", ":"]:
+        elif w == "{" and words.startswith(["e", "q", ":"]):
             # A common mistake is to say "{eq:quadratic}"
             # instead of "\ref{eq:quadratic}"
-            while next(words) != "}":
-                pass
+            words.skip_past("}")
             if proof_nesting > 0:
                 current_proof_words.append("REF")
 
@@ -3345,42 +4568,528 @@ def get_proofs(
     return proofs
 
 
+#
+# Optional result cache (--cache)
+#
+
+# While extracting a paper for the cache, the names of all the files
+# that get_words has tried to read; otherwise None.
+files_read: Optional[List[str]] = None
+
+# With --prefilter, the local files of the current paper that \input
+# can skip, because they can't contain proofs (see prescan.py)
+skippable_inputs: Optional[Set[str]] = None
+
+
+@functools.lru_cache(maxsize=None)
+def extractor_version() -> str:
+    """Hash the code and data that determine what we extract."""
+    digest = hashlib.sha256()
+    for source in [
+        __file__,
+        archives.__file__,
+        kpse.__file__,
+        kpse.NAMES,
+        prescan.__file__,
+    ]:
+        with open(source, "rb") as fd:
+            digest.update(fd.read())
+    # Which packages count as standard also depends on --texmf
+    digest.update(kpse.tree_version().encode())
+    return digest.hexdigest()
+
+
+def file_hash(filename: str) -> Optional[str]:
+    """Hash the contents of a file (None if there is no such file)."""
+    try:
+        with archives.open_file(filename, "rb") as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def cache_entry_path(
+    cache: str, filename: str, tokenizer: str, prefilter: bool = False
+) -> Path:
+    """
+    Find where the cached results for a file would be stored.
+
+    The entry is named by a hash of the file's contents, its name,
+    the version of the extractor, and whether --prefilter was used
+    (which skips files, so it might change the results). The files
+    it reads in turn are checked when the entry is loaded.
+    """
+    digest = hashlib.sha256()
+    digest.update(extractor_version().encode())
+    digest.update(tokenizer.encode())
+    digest.update(b"prefilter" if prefilter else b"")
+    digest.update(filename.encode())
+    with archives.open_file(filename, "rb") as fd:
+        digest.update(fd.read())
+    key = digest.hexdigest()
+    return Path(cache) / key[:2] / f"{key}.json"
+
+
+def load_cache_entry(entry_path: Path) -> Optional[dict]:
+    """Return the cached results, if they exist and are still valid."""
+    try:
+        with entry_path.open() as fd:
+            entry = json.load(fd)
+        for source, digest in entry["sources"].items():
+            if file_hash(source) != digest:
+                return None
+    except (OSError, ValueError, KeyError):
+        return None
+    # Mark the entry as recently used, for evict_cache
+    os.utime(entry_path)
+    return entry
+
+
+def save_cache_entry(
+    entry_path: Path, proofs: Optional[List[str]], error: Optional[str]
+):
+    """Store the results for a file, along with the files it read."""
+    entry = {
+        "sources": {source: file_hash(source) for source in files_read},
+        "proofs": proofs,
+        "error": error,
+    }
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = entry_path.with_suffix(f".{os.getpid()}")
+    with temp_path.open("w") as fd:
+        json.dump(entry, fd)
+    os.replace(temp_path, entry_path)
+
+
+def evict_cache(cache: str, max_megabytes: float):
+    """Delete the least-recently-used entries until the cache fits."""
+    entries = []
+    for entry_path in Path(cache).glob("**/*.*"):
+        try:
+            stat = entry_path.stat()
+        except FileNotFoundError:
+            # Evicted by another run sharing the cache
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry_path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_megabytes * 1_000_000:
+            break
+        entry_path.unlink(missing_ok=True)
+        total -= size
+
+
 def process_file(
-    filename, debug=False, verbose=False, in_parallel=True, only_new=False
+    filename,
+    debug=False,
+    verbose=False,
+    in_parallel=True,
+    only_new=False,
+    tokenizer="fast",
+    profile=None,
+    timeout=None,
+    cache=None,
+    sharded=False,
+    clean=False,
+    files=None,
+    prefilter=None,
+    want_hash=False,
 ):
-    """Get proofs from the named file, writing to an external file."""
+    """
+    Get proofs from the named file, writing to an external file.
+
+    If sharded is true, the proofs are appended to this worker's shard
+    (see shards.py) instead; errors still get their own .err file.
+    If clean is also true, the cleaned proofs and their sentences are
+    appended to shards too.
+
+    If profile is given, also appends timings for this paper to
+    the worker's profile file (profile.<pid>).
+
+    If timeout is given, a file that takes more than that many seconds
+    is abandoned, getting an .err file and a line in QUARANTINE_FILE.
+
+    If cache is given, reuses (or saves) results in that directory.
+
+    If files is given, it maps names to contents for the file and its
+    inputs (see read_with_inputs), so that they needn't be read again.
+
+    If prefilter is given, a summary of the paper (see prescan.py),
+    saved in that directory, is used to skip the paper, or some of the
+    files it inputs, when they can't contain proofs.
+
+    If want_hash is true, the summary includes a hash of the file's
+    contents (which costs another read of the file).
+
+    Returns a summary of what happened, for the manifest (see
+    manifest.py), or None if the file was skipped.
+    """
+    global profile_counts, files_read, skippable_inputs
     orig_dir = Path(filename).parent
     path = Path(re.sub(".*texes/", "proofs/", filename, count=1))
-    path.parent.mkdir(parents=True, exist_ok=True)
+    if not sharded:
+        path.parent.mkdir(parents=True, exist_ok=True)
     out_path = path.with_suffix(".txt")
     err_path = path.with_suffix(".err")
     # Optionally skip this file if the corresponding output exists
+    # (main checks the shards, which we can't see here)
     if only_new and (os.path.exists(out_path) or os.path.exists(err_path)):
         return
-    print(" ", os.getpid(), filename, file=sys.stderr)
+    began = time.perf_counter()
+    reset_peak_rss()
+    decode_counts.clear()
+    archives.preload(files)
+    result = {
+        "filename": filename,
+        "status": "ok",
+        "output": None,
+        "seconds": None,
+        "tokens": None,
+        "hash": None,
+        "cache": None,
+        "pid": os.getpid(),
+        "peak_rss": None,
+        "decodings": None,
+        "prefilter": None,
+    }
+    entry_path = entry = None
+    start = time.perf_counter()
+    if profile:
+        profile_counts = {}
+    if timeout:
+        signal.signal(signal.SIGALRM, raise_file_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    # (Everything that reads the file is in here, so that running out of
+    # memory, say, fails just this file.)
     try:
-        words = get_words(filename)
-        macros = {"new ifs": []}
-        proofs = get_all_proofs(
-            words, orig_dir, macros, verbose=verbose, debug=debug
-        )
-
-        with out_path.open("w") as fd:
-            # print("Writing to ", out_path)
-            for proof in proofs:
-                print(proof, file=fd)
+        try:
+            if want_hash:
+                result["hash"] = file_hash(filename)
+            if cache:
+                try:
+                    entry_path = cache_entry_path(
+                        cache, filename, tokenizer, bool(prefilter)
+                    )
+                except OSError:
+                    # Let the extractor report the problem
+                    entry_path = None
+                entry = entry_path and load_cache_entry(entry_path)
+                result["cache"] = "hit" if entry else "miss"
+                if not entry:
+                    files_read = []
+            if entry:
+                proofs = entry["proofs"]
+            else:
+                print(" ", os.getpid(), filename, file=sys.stderr)
+                directory_index.cache_clear()
+                directory_encodings.clear()
+                summary = (
+                    prescan.get_summary(prefilter, filename)
+                    if prefilter
+                    else None
+                )
+                if summary and summary["proof_free"]:
+                    print(f"  no proofs in {filename}", file=sys.stderr)
+                    result["prefilter"] = "skipped"
+                    if files_read is not None:
+                        files_read.extend(summary["sources"])
+                    proofs = []
+                else:
+                    if summary:
+                        skippable_inputs = set(summary["skippable"])
+                        result["prefilter"] = (
+                            "pruned" if skippable_inputs else "kept"
+                        )
+                    words = get_words(filename, tokenizer)
+                    result["tokens"] = words.size
+                    # Besides macro definitions, macros holds per-paper
+                    # settings under keys that can't be TeX tokens.
+                    macros = {
+                        "new ifs": [],
+                        "math envs": [],
+                        "tokenizer": tokenizer,
+                    }
+                    if cache:
+                        macros["style cache"] = os.path.join(cache, "styles")
+                    proofs = get_all_proofs(
+                        words, orig_dir, macros, verbose=verbose, debug=debug
+                    )
+        finally:
+            # Cancel the alarm before handling any errors
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+        if entry and entry["error"] is not None:
+            # Replay the failure
+            err_path.parent.mkdir(parents=True, exist_ok=True)
+            with err_path.open("w") as fd:
+                fd.write(entry["error"])
+            result["status"] = "error"
+            result["output"] = str(err_path)
+        else:
+            result["output"] = write_proofs(out_path, proofs, sharded, clean)
+            if cache and entry_path and not entry:
+                save_cache_entry(entry_path, proofs, None)
+
+    except FileTimeout:
+        elapsed = time.perf_counter() - start
+        print("TIMEOUT: ", filename, file=sys.stderr)
+        err_path.parent.mkdir(parents=True, exist_ok=True)
+        with err_path.open("w") as fd:
+            print(filename, file=fd)
+            print(f"Timed out after {elapsed:.1f} seconds", file=fd)
+        with open(QUARANTINE_FILE, "a") as fd:
+            print(filename, f"{elapsed:.1f}", sep="\t", file=fd)
+        result["status"] = "timeout"
+        result["output"] = str(err_path)
+
+    except MemoryError:
+        # Let go of this paper's data before doing anything else
+        words = macros = None
+        print("OUT OF MEMORY: ", filename, file=sys.stderr)
+        err_path.parent.mkdir(parents=True, exist_ok=True)
+        with err_path.open("w") as fd:
+            print(filename, file=fd)
+            print(
+                f"Ran out of memory (peak RSS {peak_rss():,} bytes)", file=fd
+            )
+        result["status"] = "memory"
+        result["output"] = str(err_path)
 
     except Exception as e:
         print("ERROR: ", filename, file=sys.stderr)
+        err_path.parent.mkdir(parents=True, exist_ok=True)
         with err_path.open("w") as fd:
             print("writing ", err_path)
             print(filename, file=fd)
             traceback.print_exc(file=fd)
+        result["status"] = "error"
+        result["output"] = str(err_path)
+        if cache and entry_path and not entry:
+            save_cache_entry(entry_path, None, err_path.read_text())
         if debug:
             traceback.print_exc()
-        if not in_parallel and not only_new:
+        # (Unless this is a batch run, where the .err file, and the
+        # manifest, if any, record the failure)
+        if not in_parallel and not (only_new or want_hash):
             raise e
 
+    finally:
+        if profile:
+            if not entry:
+                add_profile_time("paper", "", start)
+                save_profile(profile, filename)
+            profile_counts = None
+        files_read = None
+        skippable_inputs = None
+        archives.preload(None)
+
+    result["seconds"] = time.perf_counter() - began
+    result["peak_rss"] = peak_rss()
+    result["decodings"] = dict(decode_counts)
+    return result
+
+
+def write_proofs(
+    out_path: Path, proofs: List[str], sharded: bool, clean: bool = False
+) -> str:
+    """
+    Save the proofs from one file, either to out_path or to shards.
+
+    Returns where the proofs went.
+    """
+    # (Files outside texes/ have nowhere else to go.)
+    if sharded and out_path.parts[0] == "proofs":
+        name = "/".join(out_path.parts[1:])
+        raw = shards.tsv_lines(name, proofs)
+        if clean:
+            # Only needed (along with nltk and cleanup.py's word lists)
+            # for --clean
+            import postprocess
+
+            postprocess.append_cleaned(name, raw)
+        # Last, since -n only checks for the raw proofs
+        return shards.append_lines("raw", name, raw)
+    with out_path.open("w") as fd:
+        # print("Writing to ", out_path)
+        for proof in proofs:
+            print(proof, file=fd)
+    return str(out_path)
+
+
+def init_worker(
+    archive_dir: Optional[str],
+    max_memory: Optional[float],
+    texmf: Optional[str],
+):
+    """Set up a process to run process_file."""
+    archives.use_archives(archive_dir)
+    kpse.use_tree(texmf)
+    if max_memory:
+        limit_memory(max_memory)
+
+
+def process_file_star(args):
+    """
+    Call process_file with a tuple of arguments (for imap_unordered).
+
+    Returns the filename along with the result.
+    """
+    return args[0], process_file(*args)
+
+
+# Peak resident size of each worker process, in bytes
+worker_peaks: Dict[int, int] = {}
+
+# How the files read were decoded (see decode_tex), for all papers
+decode_totals: Counter = Counter()
+
+# What --prefilter did with the papers (see process_file)
+prefilter_totals: Counter = Counter()
+
+
+def note_result(result: Optional[dict], cache_counts: Counter, db, retried):
+    """Take note of what process_file returned."""
+    if result is None:
+        return
+    cache_counts[result["cache"]] += 1
+    pid = result["pid"]
+    worker_peaks[pid] = max(worker_peaks.get(pid, 0), result["peak_rss"])
+    decode_totals.update(result["decodings"])
+    if result["prefilter"]:
+        prefilter_totals[result["prefilter"]] += 1
+    if db is not None:
+        manifest.record(db, result)
+    if result["status"] == "ok" and result["filename"] in retried:
+        # This file failed before, but not this time
+        Path(retried[result["filename"]]).unlink(missing_ok=True)
+
+
+INPUT_COMMAND = re.compile(rb"\\(?:input|include)\s*{?\s*([^\s{}\\%]+)")
+
+
+def read_with_inputs(filename: str) -> Dict[str, bytes]:
+    r"""
+    Read a file and any local files it (transitively) \input's or \include's.
+
+    We find these with a quick regular-expression search rather than by
+    interpreting the TeX, allowing (like find_file) for differences in
+    case. Returns the contents of each file that could be read.
+    """
+    directory = Path(filename).parent
+    listings: Dict[Path, Tuple[set, Dict[str, str]]] = {}
+
+    def lookup(path: Path) -> Path:
+        if path.parent not in listings:
+            try:
+                names = archives.listdir(path.parent)
+            except OSError:
+                names = []
+            lowered: Dict[str, str] = {}
+            for name in names:
+                lowered.setdefault(name.lower(), name)
+            listings[path.parent] = (set(names), lowered)
+        names, lowered = listings[path.parent]
+        if path.name in names:
+            return path
+        return path.parent / lowered.get(path.name.lower(), path.name)
+
+    files = {}
+    pending = [Path(filename)]
+    while pending:
+        path = pending.pop()
+        if str(path) in files:
+            continue
+        try:
+            with archives.open_file(path, "rb") as fd:
+                tex_bytes = fd.read()
+        except OSError:
+            continue
+        files[str(path)] = tex_bytes
+        for name in INPUT_COMMAND.findall(tex_bytes):
+            subfname = directory / name.decode("latin-1")
+            # Like get_proofs, try adding .tex first
+            for candidate in [Path(f"{subfname}.tex"), subfname]:
+                candidate = lookup(candidate)
+                if archives.is_file(candidate):
+                    pending.append(candidate)
+                    break
+    return files
+
+
+def estimate_work(filename: str) -> int:
+    """
+    Estimate how much work it will be to extract proofs from a file.
+
+    This only looks at file sizes (see archives.source_size), so that
+    we don't read the whole corpus before extraction even starts.
+    """
+    return archives.source_size(filename)
+
+
+# Number of threads reading files for --prefetch
+PREFETCH_THREADS = 8
+
+
+class Prefetcher:
+    """
+    Read upcoming files (with their local inputs) on background threads.
+
+    Iterating gives (filename, contents) pairs in the original order,
+    where contents is as for read_with_inputs. To bound memory use,
+    iteration waits while the files handed out but not yet released
+    total more than max_bytes (beyond any reads already under way).
+    """
+
+    def __init__(self, filenames: List[str], max_bytes: float):
+        self.filenames = filenames
+        self.max_bytes = max_bytes
+        self.in_use = 0
+        self.sizes: Dict[str, List[int]] = {}
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def __iter__(self):
+        filenames = iter(self.filenames)
+        with ThreadPoolExecutor(PREFETCH_THREADS) as executor:
+            reads = deque(
+                (filename, executor.submit(read_with_inputs, filename))
+                for filename in islice(filenames, 2 * PREFETCH_THREADS)
+            )
+            while reads:
+                filename, future = reads.popleft()
+                contents = future.result()
+                size = sum(len(data) for data in contents.values())
+                with self.condition:
+                    while (
+                        self.in_use > 0
+                        and self.in_use + size > self.max_bytes
+                        and not self.stopped
+                    ):
+                        self.condition.wait()
+                    if self.stopped:
+                        executor.shutdown(cancel_futures=True)
+                        return
+                    self.in_use += size
+                    self.sizes.setdefault(filename, []).append(size)
+                for upcoming in islice(filenames, 1):
+                    reads.append(
+                        (upcoming, executor.submit(read_with_inputs, upcoming))
+                    )
+                yield filename, contents
+
+    def release(self, filename: str):
+        """Note that a file handed out earlier has been processed."""
+        with self.condition:
+            self.in_use -= self.sizes[filename].pop()
+            self.condition.notify_all()
+
+    def stop(self):
+        """Stop handing out files (e.g., because the run was interrupted)."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
 
 if __name__ == "__main__":
     nicer.make_nice()
@@ -3408,6 +5117,89 @@ if __name__ == "__main__":
     parser.add_argument(
         "-p", "--cores", help="Number of cores to use", type=int, default=4
     )
+    parser.add_argument(
+        "--tokenizer",
+        help="Tokenizer implementation (legacy is for comparisons)",
+        choices=sorted(TOKENIZERS),
+        default="fast",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Write per-command timings (as TSV) to this file",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Give up on any file that takes longer than this",
+        type=float,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--archives",
+        help="Read texes/... files from the arXiv source archives in DIR",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--texmf",
+        help="Also treat packages in this TeX tree as standard",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--prefilter",
+        help="Skip papers and inputs that can't contain proofs,"
+        " keeping summaries of the papers in this directory",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Reuse results from earlier runs, kept in this directory",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Maximum size of the cache (default: 4000)",
+        type=float,
+        default=4000,
+        metavar="MB",
+    )
+    parser.add_argument(
+        "--shards",
+        help="Append proofs to per-worker TSV files, not one .txt per file",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Read up to this much input ahead of the workers",
+        type=float,
+        metavar="MB",
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="Fail any file that makes a worker use more memory than this",
+        type=float,
+        metavar="MB",
+    )
+    parser.add_argument(
+        "--max-tasks",
+        help="Replace each worker process after this many files",
+        type=int,
+        metavar="N",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Record how each file went in this SQLite file (used by -n)",
+        metavar="FILE",
+    )
+    parser.add_argument(
+        "--failed",
+        help="Only retry the files that failed, according to the manifest",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--clean",
+        help="Also clean up and sentence-split the proofs (implies --shards)",
+        action="store_true",
+    )
 
     parser.add_argument("files", nargs="+")
     args = parser.parse_args()
@@ -3423,15 +5215,39 @@ if __name__ == "__main__":
         tex_files = args.files
 
     os.makedirs("proofs", exist_ok=True)
-
-    if args.new:
+    archives.use_archives(args.archives)
+    kpse.use_tree(args.texmf)
+    if args.clean:
+        args.shards = True
+
+    if args.failed and not args.manifest:
+        parser.error("--failed needs a --manifest")
+    db = manifest.open_manifest(args.manifest) if args.manifest else None
+    retried: Dict[str, str] = {}
+
+    if args.failed:
+        retried = manifest.failed_files(db)
+        tex_files = [filename for filename in tex_files if filename in retried]
+        print(f"retrying {len(tex_files)} failed files")
+    elif args.new and db is not None:
+        finished = manifest.finished_files(db)
+        tex_files = [
+            filename for filename in tex_files if filename not in finished
+        ]
+        print(f"found {len(tex_files)} new files")
+    elif args.new:
         print(f"prescanning {len(tex_files)} files")
+        sharded_files = shards.read_index()
         new_tex_files = []
         for filename in tex_files:
             path = Path(re.sub(".*texes/", "proofs/", filename, count=1))
             out_path = path.with_suffix(".txt")
             err_path = path.with_suffix(".err")
-            if not (os.path.exists(out_path) or os.path.exists(err_path)):
+            if not (
+                os.path.exists(out_path)
+                or os.path.exists(err_path)
+                or "/".join(out_path.parts[1:]) in sharded_files
+            ):
                 new_tex_files.append(filename)
         tex_files = new_tex_files
         print(f"found {len(tex_files)} new files")
@@ -3439,33 +5255,87 @@ if __name__ == "__main__":
         #     for filename in tex_files:
         #         print(filename, file=fd)
 
+    if args.profile:
+        # Discard anything left over from an interrupted run
+        for path in profile_worker_files(args.profile):
+            path.unlink()
+
     if len(tex_files) > 1 and not (args.cores == 1):
-        with Pool(processes=args.cores) as p:
-            # p.map(pf, tex_files, 1)
-            p.starmap(
-                process_file,
+        with Pool(
+            processes=args.cores,
+            initializer=init_worker,
+            initargs=(args.archives, args.max_memory, args.texmf),
+            maxtasksperchild=args.max_tasks,
+        ) as p:
+            # Start with the biggest files, so we don't end with one
+            # core grinding through a huge paper while the rest sit idle.
+            work = p.map(estimate_work, tex_files, 100)
+            tex_files = [
+                tex_file
+                for _, tex_file in sorted(
+                    zip(work, tex_files), key=lambda wf: wf[0], reverse=True
+                )
+            ]
+            if args.prefetch:
+                # Read ahead, so workers needn't wait for the file system
+                prefetcher = Prefetcher(tex_files, args.prefetch * 1_000_000)
+                contents = (files for _, files in prefetcher)
+            else:
+                prefetcher = None
+                contents = repeat(None)
+            # Hand out files one at a time, as workers become free
+            # (rather than in fixed chunks, which could leave a
+            # slow file holding up the rest of its chunk).
+            results = p.imap_unordered(
+                process_file_star,
                 zip(
                     tex_files,
                     repeat(args.debug),
                     repeat(args.verbose),
                     repeat(True),
-                    repeat(args.new),
+                    # (With a manifest, main has already chosen the files)
+                    repeat(args.new and db is None),
+                    repeat(args.tokenizer),
+                    repeat(args.profile),
+                    repeat(args.timeout),
+                    repeat(args.cache),
+                    repeat(args.shards),
+                    repeat(args.clean),
+                    contents,
+                    repeat(args.prefilter),
+                    repeat(db is not None),
                 ),
-                # max(4, min(100, len(tex_files) / args.cores / 4))
-                50
-                # let's try handing out files to CPUs
-                # in chunks of 100 (rather than the default
-                # which is approximately num-files / CPUS / 4)
             )
+            cache_counts: Counter = Counter()
+            try:
+                for filename, result in results:
+                    if prefetcher:
+                        prefetcher.release(filename)
+                    note_result(result, cache_counts, db, retried)
+            finally:
+                if prefetcher:
+                    prefetcher.stop()
     else:
+        if args.max_memory:
+            limit_memory(args.max_memory)
+        cache_counts = Counter()
         for tex_file in tex_files:
-            process_file(
+            result = process_file(
                 tex_file,
                 debug=args.debug,
                 verbose=args.verbose,
                 in_parallel=False,
-                only_new=args.new,
+                only_new=args.new and db is None,
+                tokenizer=args.tokenizer,
+                profile=args.profile,
+                timeout=args.timeout,
+                cache=args.cache,
+                sharded=args.shards,
+                clean=args.clean,
+                prefilter=args.prefilter,
+                want_hash=db is not None,
             )
+            note_result(result, cache_counts, db, retried)
         # except SystemExit as exn:
         #     print(f"\nError: {exn}")
         #     print("-----")
@@ -3475,3 +5345,37 @@ if __name__ == "__main__":
         #         state.token_numbers,
         #     ):
         #         print(f"file {f}, line {l}, token {c}")
+
+    if args.profile:
+        merge_profiles(args.profile)
+
+    if decode_totals:
+        print(
+            "decoded files as:",
+            ", ".join(f"{how} {n}" for how, n in decode_totals.most_common()),
+            file=sys.stderr,
+        )
+
+    if prefilter_totals:
+        print(
+            "prefilter:",
+            ", ".join(
+                f"{how} {n}" for how, n in prefilter_totals.most_common()
+            ),
+            file=sys.stderr,
+        )
+
+    if worker_peaks:
+        print("peak memory use (RSS) by worker:", file=sys.stderr)
+        for pid, peak in sorted(
+            worker_peaks.items(), key=lambda pp: pp[1], reverse=True
+        ):
+            print(f"  {pid}: {peak / 1_000_000:,.0f} MB", file=sys.stderr)
+
+    if args.cache:
+        evict_cache(args.cache, args.cache_size)
+        print(
+            f"cache: {cache_counts['hit']} hits, "
+            f"{cache_counts['miss']} misses",
+            file=sys.stderr,
+        )
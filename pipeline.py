@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+
+"""Rebuild whichever per-year outputs are out of date."""
+
+# The outputs for each year YY are built in stages:
+#
+#      matches/matchesYY    that year's lines of matches/eng-matches
+#      extract YY           naive.py --clean on those files
+#      proofsYY.tsv         collect_raw_proofs.py YY
+#      cleanproofsYY.tsv    cleanup.py proofsYY.tsv
+#      sentYY.tsv           sentize2.py cleanproofsYY.tsv
+#      sortedYY.txt         the year's sentences, by frequency
+#
+# followed by sorted.txt and successful-proof-ids for all the years.
+#
+# STATE_FILE records, for every stage that has been built, digests of
+# the code, data, and options it used, and the size and modification
+# time of its outputs (and of the outputs of the stages it read). A stage
+# is rebuilt only if one of these has changed since, or if a stage it
+# depends on is being rebuilt. Stages from different years run at the
+# same time, with at most --cores cores busy at once.
+#
+# naive.py --clean produces cleaned proofs and sentences along with the
+# raw proofs, so the cleanup and sentence stages just collect those,
+# unless cleanup.py or sentize2.py (or their data) changed since.
+#
+# Typical use, after changing cleanup.py:
+#      ./pipeline.py --dry-run
+#      ./pipeline.py -p36
+
+import argparse
+import functools
+import glob
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess  # nosec
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import nicer
+
+STATE_FILE = "pipeline.json"
+
+# 1992-2020
+YEARS = [f"{year % 100:02}" for year in range(1992, 2021)]
+
+# Code and data that each kind of stage depends on
+EXTRACT_SOURCES = [
+    "naive.py",
+    "archives.py",
+    "kpse.py",
+    "prescan.py",
+    "shards.py",
+    "texmf-dist.txt",
+]
+COLLECT_SOURCES = ["collect_raw_proofs.py", "shards.py"]
+CLEANUP_SOURCES = ["cleanup.py", "words_alpha.txt", "known_names.txt"]
+SENTIZE_SOURCES = ["sentize2.py"]
+# What naive.py --clean used to clean and split the proofs
+FUSED_SOURCES = ["postprocess.py"] + CLEANUP_SOURCES + SENTIZE_SOURCES
+
+
+@functools.lru_cache(maxsize=None)
+def file_digest(filename: str) -> Optional[str]:
+    """Hash the contents of a file (None if there is no such file)."""
+    try:
+        with open(filename, "rb") as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def digests(sources: List[str]) -> Dict[str, Optional[str]]:
+    """Hash each of the named files."""
+    return {source: file_digest(source) for source in sources}
+
+
+def output_stamps(patterns: List[str]) -> Dict[str, List[int]]:
+    """Get the size and modification time of each matching file."""
+    stamps = {}
+    for pattern in patterns:
+        for filename in sorted(glob.glob(pattern)):
+            stat = os.stat(filename)
+            stamps[filename] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+
+def python(script: str, *args: str) -> str:
+    """Build the shell command for running one of our scripts."""
+    return shlex.join([sys.executable, script, *args])
+
+
+class Stage:
+    """One step of the pipeline."""
+
+    def __init__(
+        self,
+        name: str,
+        outputs: List[str],
+        inputs: Dict[str, Optional[str]],
+        deps: List["Stage"],
+        command: Callable[[], Tuple[str, int]],
+        stdout: Optional[str] = None,
+        clear: Optional[List[str]] = None,
+    ):
+        # e.g., "clean 08"
+        self.name = name
+        # Files (or glob patterns for files) that the stage creates
+        self.outputs = outputs
+        # Digests of the code, data and options it uses
+        self.inputs = inputs
+        # Stages whose outputs it reads
+        self.deps = deps
+        # Returns the shell command and how many cores it will use
+        # (called only once the dependencies are up to date)
+        self.command = command
+        # Where the command's output goes (if not to the log)
+        self.stdout = stdout
+        # Files (or directories) to delete before running the command
+        self.clear = clear or []
+
+    def reasons(self, state: dict, rebuilding: List["Stage"]) -> List[str]:
+        """Say why this stage must be rebuilt (if it must)."""
+        record = state.get(self.name)
+        if record is None:
+            return ["never built"]
+        reasons = [
+            f"{label} changed"
+            for label in sorted(set(self.inputs) | set(record["inputs"]))
+            if self.inputs.get(label) != record["inputs"].get(label)
+        ]
+        if output_stamps(self.outputs) != record["outputs"]:
+            reasons.append("output missing or modified")
+        for dep in self.deps:
+            if dep in rebuilding:
+                reasons.append(f"{dep.name} is being rebuilt")
+            elif record["deps"].get(dep.name) != state[dep.name]["outputs"]:
+                reasons.append(f"{dep.name} changed")
+        return reasons
+
+    def record(self, state: dict) -> dict:
+        """Describe the newly built stage, for STATE_FILE."""
+        return {
+            "inputs": self.inputs,
+            "outputs": output_stamps(self.outputs),
+            "deps": {
+                dep.name: state[dep.name]["outputs"] for dep in self.deps
+            },
+        }
+
+
+def year_stages(
+    year: str, state: dict, args: argparse.Namespace
+) -> List[Stage]:
+    """Make the stages for one year, in order."""
+    job_cores = min(args.job_cores, args.cores)
+    matches = f"matches/matches{year}"
+    proofs = f"proofs{year}.tsv"
+    cleanproofs = f"cleanproofs{year}.tsv"
+    sent = f"sent{year}.tsv"
+    options = {"--timeout": str(args.timeout), "--archives": args.archives}
+    if args.texmf:
+        # (Only when given, so earlier extractions still count as current)
+        options["--texmf"] = args.texmf
+
+    def fused_is_current() -> bool:
+        record = state.get(f"extract {year}", {})
+        return record.get("fused") == digests(FUSED_SOURCES)
+
+    select = Stage(
+        f"matches {year}",
+        [matches],
+        digests(["matches/eng-matches"]),
+        [],
+        lambda: (
+            "awk "
+            + shlex.quote(f'index($0, "/texes/{year}") && !/^#/')
+            + " matches/eng-matches",
+            1,
+        ),
+        stdout=matches,
+    )
+
+    def extract_command():
+        naive_args = [f"-p{job_cores}", "--clean", "--cache", args.cache]
+        if args.timeout:
+            naive_args += ["--timeout", str(args.timeout)]
+        if args.archives:
+            naive_args += ["--archives", args.archives]
+        if args.texmf:
+            naive_args += ["--texmf", args.texmf]
+        return python("naive.py", *naive_args, "-m", matches), job_cores
+
+    shard_files = [
+        f"proofs/shards/{kind}{year}.*.{suffix}"
+        for kind in ["", "clean/", "sent/"]
+        for suffix in ["tsv", "idx"]
+    ]
+    extract = Stage(
+        f"extract {year}",
+        shard_files,
+        {**digests(EXTRACT_SOURCES), **options},
+        [select],
+        extract_command,
+        # Output from an earlier run (including .err files)
+        clear=shard_files + [f"proofs/{year}??"],
+    )
+    collect = Stage(
+        f"collect {year}",
+        [proofs],
+        digests(COLLECT_SOURCES),
+        [extract],
+        lambda: (python("collect_raw_proofs.py", year), 1),
+        stdout=proofs,
+    )
+
+    def clean_command():
+        if fused_is_current():
+            return python("collect_raw_proofs.py", "-k", "clean", year), 1
+        return python("cleanup.py", f"-p{job_cores}", proofs), job_cores
+
+    clean = Stage(
+        f"clean {year}",
+        [cleanproofs],
+        digests(CLEANUP_SOURCES),
+        [collect],
+        clean_command,
+        stdout=cleanproofs,
+    )
+
+    def sentize_command():
+        if fused_is_current():
+            return python("collect_raw_proofs.py", "-k", "sent", year), 1
+        return python("sentize2.py", f"-p{job_cores}", cleanproofs), job_cores
+
+    sentize = Stage(
+        f"sentize {year}",
+        [sent],
+        digests(SENTIZE_SOURCES),
+        [clean],
+        sentize_command,
+        stdout=sent,
+    )
+    count = Stage(
+        f"count {year}",
+        [f"sorted{year}.txt"],
+        {},
+        [sentize],
+        lambda: (f"cut -f2 {sent} | sort | uniq -c | sort -rn", 1),
+        stdout=f"sorted{year}.txt",
+    )
+    return [select, extract, collect, clean, sentize, count]
+
+
+def all_stages(state: dict, args: argparse.Namespace) -> List[Stage]:
+    """Make all the stages, roughly in the order they should start."""
+    # Start with the years that have the most papers, so we don't
+    # end with one big year running on its own.
+    with open("matches/eng-matches") as fd:
+        lines = fd.readlines()
+    years = sorted(
+        args.years,
+        key=lambda year: sum(f"/texes/{year}" in line for line in lines),
+        reverse=True,
+    )
+    by_year = {year: year_stages(year, state, args) for year in years}
+    stages = [stage for year in years for stage in by_year[year]]
+    sent_files = " ".join(f"sent{year}.tsv" for year in args.years)
+    stages.append(
+        Stage(
+            "count all",
+            ["sorted.txt"],
+            {},
+            [by_year[year][4] for year in years],
+            lambda: (f"cut -f2 {sent_files} | sort | uniq -c | sort -rn", 1),
+            stdout="sorted.txt",
+        )
+    )
+    stages.append(
+        Stage(
+            "successful ids",
+            ["successful-proof-ids"],
+            digests(COLLECT_SOURCES),
+            [by_year[year][1] for year in years],
+            lambda: (
+                python("collect_raw_proofs.py", "--ids")
+                + " | cut -d'/' -f2 | sort",
+                1,
+            ),
+            stdout="successful-proof-ids",
+        )
+    )
+    return stages
+
+
+def load_state() -> dict:
+    """Read STATE_FILE (if it exists)."""
+    try:
+        with open(STATE_FILE) as fd:
+            return json.load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state: dict):
+    """Write STATE_FILE (atomically, in case we're interrupted)."""
+    with open(f"{STATE_FILE}.tmp", "w") as fd:
+        json.dump(state, fd, indent=1, sort_keys=True)
+    os.replace(f"{STATE_FILE}.tmp", STATE_FILE)
+
+
+def start(stage: Stage, command: str, log) -> subprocess.Popen:
+    """Start running a stage."""
+    for pattern in stage.clear:
+        for filename in glob.glob(pattern):
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.unlink(filename)
+    print(f"{time.strftime('%H:%M:%S')} starting {stage.name}: {command}")
+    if not stage.stdout:
+        return subprocess.Popen(  # nosec
+            command, shell=True, stdout=log, stderr=log
+        )
+    with open(f"{stage.stdout}.part", "w") as stdout:
+        return subprocess.Popen(  # nosec
+            command, shell=True, stdout=stdout, stderr=log
+        )
+
+
+def finish(stage: Stage, process: subprocess.Popen, state: dict) -> bool:
+    """Record a stage that has stopped; return whether it succeeded."""
+    if process.returncode != 0:
+        print(f"{time.strftime('%H:%M:%S')} FAILED {stage.name}")
+        if stage.stdout:
+            os.unlink(f"{stage.stdout}.part")
+        state.pop(stage.name, None)
+        save_state(state)
+        return False
+    if stage.stdout:
+        os.replace(f"{stage.stdout}.part", stage.stdout)
+    print(f"{time.strftime('%H:%M:%S')} finished {stage.name}")
+    state[stage.name] = stage.record(state)
+    if stage.name.startswith("extract"):
+        state[stage.name]["fused"] = digests(FUSED_SOURCES)
+    save_state(state)
+    return True
+
+
+def run(stages: List[Stage], state: dict, cores: int, log) -> bool:
+    """Run the stages as cores become free; return whether all succeeded."""
+    waiting = list(stages)
+    running: Dict[Stage, Tuple[subprocess.Popen, int]] = {}
+    failed: List[Stage] = []
+    while waiting or running:
+        busy = sum(used for _, used in running.values())
+        for stage in list(waiting):
+            if any(dep in failed for dep in stage.deps):
+                print(f"skipping {stage.name}")
+                waiting.remove(stage)
+                failed.append(stage)
+            elif not any(
+                dep in waiting or dep in running for dep in stage.deps
+            ):
+                command, used = stage.command()
+                # (Something has to run, even if it wants too many cores.)
+                if running and busy + used > cores:
+                    continue
+                waiting.remove(stage)
+                running[stage] = (start(stage, command, log), used)
+                busy += used
+        time.sleep(1)
+        for stage, (process, _) in list(running.items()):
+            if process.poll() is not None:
+                del running[stage]
+                if not finish(stage, process, state):
+                    failed.append(stage)
+    return not failed
+
+
+if __name__ == "__main__":
+    nicer.make_nice()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p",
+        "--cores",
+        help="Total number of cores to use",
+        type=int,
+        default=max(1, os.cpu_count() * 9 // 10),
+    )
+    parser.add_argument(
+        "--job-cores",
+        help="Number of cores for any one stage (default: 8)",
+        type=int,
+        default=8,
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        help="Just show what would be rebuilt, and why",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--log",
+        help="Append the stages' messages to this file (default: log.txt)",
+        default="log.txt",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Result cache for naive.py (default: naive-cache)",
+        default="naive-cache",
+    )
+    parser.add_argument(
+        "--timeout",
+        help="Passed on to naive.py",
+        type=float,
+        metavar="SECONDS",
+    )
+    parser.add_argument(
+        "--archives", help="Passed on to naive.py", metavar="DIR"
+    )
+    parser.add_argument("--texmf", help="Passed on to naive.py", metavar="DIR")
+    parser.add_argument(
+        "years", nargs="*", help="e.g., 92 08 (default: all)", default=YEARS
+    )
+    args = parser.parse_args()
+
+    state = load_state()
+    stages = all_stages(state, args)
+    rebuilding: List[Stage] = []
+    for stage in stages:
+        reasons = stage.reasons(state, rebuilding)
+        if reasons:
+            rebuilding.append(stage)
+            if args.dry_run:
+                print(f"{stage.name}: {', '.join(reasons)}")
+    print(f"{len(rebuilding)} of {len(stages)} stages out of date")
+
+    if not args.dry_run:
+        with open(args.log, "a") as log:
+            ok = run(rebuilding, state, args.cores, log)
+        sys.exit(0 if ok else 1)
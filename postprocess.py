@@ -0,0 +1,45 @@
+"""Clean up and sentence-split freshly extracted proofs, in memory."""
+
+# With naive.py --clean, each worker takes the proofs it just extracted
+# from a file (as the lines collect_raw_proofs.py would produce for them)
+# through the same steps as
+#
+#      ./cleanup.py proofsYY.tsv > cleanproofsYY.tsv
+#      ./sentize2.py cleanproofsYY.tsv > sentYY.tsv
+#
+# and appends the results to the "clean" and "sent" shards, so that
+# collect_raw_proofs.py can assemble all three files for a year
+# without another pass over the proofs.
+
+import io
+
+import cleanup
+import sentize2
+import shards
+
+
+def clean_lines(raw: str, filename: str) -> str:
+    """Clean up TSV lines of proofs, as cleanup.py does."""
+    cleaned = []
+    for orig in io.StringIO(raw, newline=None):
+        clean = cleanup.clean_proof(orig, False, filename)
+        if not cleanup.skip_this_proof(clean):
+            cleaned.append(f"{clean}\n")
+    return "".join(cleaned)
+
+
+def sentence_lines(cleaned: str) -> str:
+    """Split TSV lines of proofs into sentences, as sentize2.py does."""
+    return "".join(
+        f"{sentence}\n"
+        for proof in io.StringIO(cleaned, newline=None)
+        for sentence in sentize2.sentize_proof(proof)
+    )
+
+
+def append_cleaned(name: str, raw: bytes):
+    """Clean and sentence-split the proofs from a .txt file, into shards."""
+    cleaned = clean_lines(raw.decode(), f"proofs{name[:2]}.tsv")
+    sentences = sentence_lines(cleaned)
+    shards.append_lines("clean", name, cleaned.encode())
+    shards.append_lines("sent", name, sentences.encode())
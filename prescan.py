@@ -0,0 +1,386 @@
+"""Find papers (and inputs) that can't contain proofs, without TeX."""
+
+# naive.py only finds a proof at a \begin{proof...} or \begin{Proof...},
+# so a paper none of whose files even mention "proof" or "Proof" (outside
+# comments) has nothing to extract. With naive.py --prefilter DIR, each
+# paper is first summarized using regular expressions alone:
+#
+#      files      for each file it may read (starting with the paper,
+#                 and following \input, \include, and local packages),
+#                 whether it mentions a proof (or an alias of one),
+#                 whether it may change what later files mean (by
+#                 defining anything, including anything, or using
+#                 anything the paper defines, e.g., \longversiontrue
+#                 after \newif\iflongversion), and what it includes
+#      aliases    names defined (by \def, \newcommand, \let,
+#                 \newenvironment, \newtheorem, ...) as something that
+#                 mentions a proof or another alias, e.g., \bp after
+#                 \newcommand{\bp}{\begin{proof}}
+#      proof_free true if no file mentions a proof
+#      skippable  the files other than the paper that neither mention
+#                 a proof nor change anything, which \input can skip
+#
+# If some \input's file name isn't written out literally (e.g., \input{#1}
+# inside a macro), we can't be sure what is read, so nothing is skipped.
+# If only some definition's name (or \newif's) isn't (e.g.,
+# \expandafter\def\csname), proof_free still holds, but no inputs are
+# skipped, since we can't tell which files use it.
+#
+# The summary is saved in DIR, along with hashes of the files it was
+# based on (and of any it looked for but didn't find), so later runs
+# reuse it until one of those files changes.
+
+import functools
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+import archives
+
+# What starts a proof environment, as far as naive.py is concerned
+PROOF = re.compile(rb"[pP]roof")
+
+# A comment (perhaps not, after \\, but then we just see more text)
+COMMENT = re.compile(rb"(?<!\\)%[^\n]*")
+
+# Names of control sequences, and of environments
+CONTROL_SEQUENCE = re.compile(rb"\\([A-Za-z@]+)")
+ENVIRONMENT = re.compile(rb"\\(?:begin|end)\s*{([^{}]*)}")
+
+# Commands that make a file matter to what comes after it (including
+# conditionals, e.g., an \iffalse in one file and its \fi in another)
+STATEFUL = re.compile(
+    rb"\\(?:[egx]?def|let|futurelet|newcommand|renewcommand|providecommand"
+    rb"|DeclareRobustCommand|DeclareMathOperator|@namedef|newcounter"
+    rb"|newenvironment|renewenvironment|newtheorem|newif|csname|input"
+    rb"|include|usepackage|RequirePackage|languageshorthands|catcode"
+    rb"|if[A-Za-z@]*|unless|else|or|fi)"
+    rb"(?![A-Za-z@])"
+)
+
+# Definitions, with the name being defined (if written out)
+DEFINITION = re.compile(
+    rb"\\([egx]?def|let|futurelet|newcommand|renewcommand|providecommand"
+    rb"|DeclareRobustCommand|DeclareMathOperator|@namedef|newenvironment"
+    rb"|renewenvironment|newtheorem)(?![A-Za-z@])\*?\s*({\s*)?"
+    rb"(\\(?:[A-Za-z@]+|.)|[A-Za-z@*]+)?"
+)
+# Commands whose definitions are two groups, not one
+TWO_PARTS = {b"newenvironment", b"renewenvironment"}
+# Definitions whose name is a control sequence we can't see
+HIDDEN_NAMES = {b"\\csname", b"\\expandafter"}
+# The rest of \let\a=\b or \let\a\b
+LET_RHS = re.compile(rb"\s*=?\s*(\\(?:[A-Za-z@]+|.)|.)?", re.S)
+# Switches, with the name after \if (if written out)
+NEWIF = re.compile(rb"\\newif(?![A-Za-z@])\s*(?:\\if([A-Za-z@]+))?")
+
+# Inputs, and packages, with the file names (if written out)
+INPUT = re.compile(
+    rb"\\(?:input|include)(?![A-Za-z@])\s*"
+    rb'(?:{\s*([^{}\\%#\s]+)\s*}|"([^"\\%#\n]+)"|([^\s{}\\%#"]+))?'
+)
+PACKAGE = re.compile(
+    rb"\\(?:usepackage|RequirePackage)(?![A-Za-z@])\s*"
+    rb"(?:\[[^\]]*\]\s*)?(?:{([^{}\\#]*)})?"
+)
+
+
+def group_end(text: bytes, start: int) -> int:
+    """Find the end of the {...} group starting at start (or of text)."""
+    depth = 0
+    i = start
+    while i < len(text):
+        c = text[i : i + 1]
+        if c == b"\\":
+            i += 2
+            continue
+        if c == b"{":
+            depth += 1
+        elif c == b"}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return len(text)
+
+
+def body_end(text: bytes, start: int) -> int:
+    r"""
+    Find the end of the first group after start that isn't in [...].
+
+    This covers the parameters of \def and the optional arguments of
+    \newcommand, \newtheorem, etc. (or the rest of text, if need be).
+    """
+    brackets = 0
+    i = start
+    while i < len(text):
+        c = text[i : i + 1]
+        if c == b"\\":
+            i += 2
+            continue
+        if c == b"{":
+            end = group_end(text, i)
+            if brackets == 0:
+                return end
+            i = end
+            continue
+        if c == b"[":
+            brackets += 1
+        elif c == b"]" and brackets:
+            brackets -= 1
+        i += 1
+    return len(text)
+
+
+def used_names(text: bytes) -> Set[str]:
+    """Get the control sequences and environments that text mentions."""
+    return {
+        name.decode("latin-1")
+        for pattern in [CONTROL_SEQUENCE, ENVIRONMENT]
+        for name in pattern.findall(text)
+    }
+
+
+def definitions(text: bytes) -> List[Tuple[Optional[str], bytes]]:
+    """
+    Find what text defines, and the text of each definition.
+
+    The name is None if we can't tell what is being defined.
+    """
+    found = []
+    for match in DEFINITION.finditer(text):
+        command, _, name = match.groups()
+        start = match.end()
+        if command in {b"let", b"futurelet"}:
+            rhs = LET_RHS.match(text, start)
+            end = rhs.end()
+        else:
+            end = body_end(text, start)
+            if command in TWO_PARTS:
+                end = body_end(text, end)
+        if name is None or name in HIDDEN_NAMES:
+            found.append((None, text[start:end]))
+        else:
+            found.append(
+                (name.lstrip(b"\\").decode("latin-1"), text[start:end])
+            )
+    return found
+
+
+def switches(text: bytes) -> List[Optional[str]]:
+    r"""
+    Find the commands that text's \newif's define (e.g., \iffoo, \footrue,
+    and \foofalse for \newif\iffoo).
+
+    None stands for a \newif whose name we can't see.
+    """
+    found: List[Optional[str]] = []
+    for match in NEWIF.finditer(text):
+        if match.group(1) is None:
+            found.append(None)
+        else:
+            name = match.group(1).decode("latin-1")
+            found += [f"if{name}", f"{name}true", f"{name}false"]
+    return found
+
+
+def included_names(text: bytes) -> Optional[List[str]]:
+    r"""
+    Find the files that text \input's, \include's, or uses as packages.
+
+    Returns None if some file name isn't written out.
+    """
+    names = []
+    for match in INPUT.finditer(text):
+        name = next((group for group in match.groups() if group), None)
+        if name is None:
+            return None
+        names.append(name.decode("latin-1").strip().lower())
+    for match in PACKAGE.finditer(text):
+        if match.group(1) is None:
+            return None
+        for package in match.group(1).decode("latin-1").split(","):
+            package = package.strip().lower()
+            if package:
+                # As for \usepackage in naive.py
+                if Path(package).suffix == "":
+                    package += ".sty"
+                names.append(package)
+    return names
+
+
+def file_digest(filename: str) -> Optional[str]:
+    """Hash the contents of a file (None if there is no such file)."""
+    try:
+        with archives.open_file(filename, "rb") as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def summarize(filename: str) -> dict:
+    """Summarize a paper, as described above."""
+    directory = os.path.dirname(filename)
+    listings: Dict[str, Tuple[set, Dict[str, str]]] = {}
+
+    def lookup(path: str) -> Optional[str]:
+        # Allowing for differences in case, as find_file does
+        parent, name = os.path.split(path)
+        if parent not in listings:
+            try:
+                names = archives.listdir(parent or ".")
+            except OSError:
+                names = []
+            lowered: Dict[str, str] = {}
+            for entry in names:
+                lowered.setdefault(entry.lower(), entry)
+            listings[parent] = (set(names), lowered)
+        names, lowered = listings[parent]
+        if name not in names:
+            name = lowered.get(name.lower(), name)
+        path = os.path.normpath(os.path.join(parent, name))
+        return path if archives.is_file(path) else None
+
+    sources: Dict[str, Optional[str]] = {}
+    texts: Dict[str, bytes] = {}
+    includes: Dict[str, List[str]] = {}
+    # Files that regular expressions can't read (e.g., UTF-16)
+    opaque: Set[str] = set()
+    # Whether we know every file that might be read, and every name defined
+    inputs_known = names_known = True
+    pending = [os.path.normpath(filename)]
+    while pending:
+        path = pending.pop()
+        if path in texts:
+            continue
+        try:
+            with archives.open_file(path, "rb") as fd:
+                data = fd.read()
+        except OSError:
+            sources[path] = None
+            continue
+        sources[path] = hashlib.sha256(data).hexdigest()
+        texts[path] = COMMENT.sub(b"", data)
+        if b"\0" in data:
+            opaque.add(path)
+            inputs_known = False
+        names = included_names(texts[path])
+        if names is None:
+            inputs_known = False
+            names = []
+        includes[path] = []
+        for name in names:
+            base = os.path.join(directory, name)
+            # Like get_proofs, try adding .tex first
+            for candidate in [f"{base}.tex", base]:
+                found = lookup(candidate)
+                if found is None:
+                    sources.setdefault(os.path.normpath(candidate), None)
+                else:
+                    includes[path].append(found)
+                    pending.append(found)
+
+    # Find the aliases of proof (and of those aliases, and so on)
+    defined = [
+        (name, body, used_names(body))
+        for text in texts.values()
+        for name, body in definitions(text)
+    ]
+    aliases: Set[str] = set()
+    changed = True
+    while changed:
+        changed = False
+        for name, body, names in defined:
+            if (
+                name is not None
+                and name not in aliases
+                and (PROOF.search(body) or not names.isdisjoint(aliases))
+            ):
+                aliases.add(name)
+                changed = True
+
+    # Using anything the paper defines may change what comes after
+    # (if only by using something else it defines, and so on)
+    own_names = {name for name, _, _ in defined} | {
+        name for text in texts.values() for name in switches(text)
+    }
+    if None in own_names:
+        names_known = False
+        own_names.discard(None)
+
+    files = {}
+    for path, text in texts.items():
+        files[path] = {
+            "proof": bool(
+                path in opaque
+                or PROOF.search(text)
+                or not used_names(text).isdisjoint(aliases)
+            ),
+            "stateful": bool(
+                STATEFUL.search(text)
+                or not used_names(text).isdisjoint(own_names)
+            ),
+            "includes": includes[path],
+        }
+    main = os.path.normpath(filename)
+    return {
+        "files": files,
+        "aliases": sorted(aliases),
+        "inputs_known": inputs_known,
+        "names_known": names_known,
+        # (If the paper itself can't be read, let naive.py report that.)
+        "proof_free": main in files
+        and inputs_known
+        and not any(info["proof"] for info in files.values()),
+        "skippable": sorted(
+            path
+            for path, info in files.items()
+            if inputs_known
+            and names_known
+            and path != main
+            and not info["proof"]
+            and not info["stateful"]
+        ),
+        "sources": sources,
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def prescan_version() -> str:
+    """Hash the code that determines the summaries."""
+    with open(__file__, "rb") as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+def summary_path(summaries: str, filename: str) -> Path:
+    """Find where the summary of a paper would be saved."""
+    digest = hashlib.sha256()
+    digest.update(prescan_version().encode())
+    digest.update(filename.encode())
+    key = digest.hexdigest()
+    return Path(summaries) / key[:2] / f"{key}.json"
+
+
+def get_summary(summaries: str, filename: str) -> dict:
+    """Reuse the saved summary of a paper if it's still valid, or make one."""
+    entry_path = summary_path(summaries, filename)
+    try:
+        with entry_path.open() as fd:
+            summary = json.load(fd)
+        if all(
+            file_digest(source) == digest
+            for source, digest in summary["sources"].items()
+        ):
+            return summary
+    except (OSError, ValueError, KeyError):
+        pass
+    summary = summarize(filename)
+    entry_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = entry_path.with_suffix(f".{os.getpid()}")
+    with temp_path.open("w") as fd:
+        json.dump(summary, fd)
+    os.replace(temp_path, entry_path)
+    return summary
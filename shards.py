@@ -0,0 +1,100 @@
+"""Append-only TSV shards of extracted proofs."""
+
+# With --shards, naive.py doesn't create proofs/<yymm>/<id>/<file>.txt
+# for every .tex file. Instead, each worker appends the lines that
+# collect_raw_proofs.py would have produced from that .txt file,
+#
+#      <yymm>/<id>\t<proof>
+#
+# to proofs/shards/<yy>.<pid>.tsv, and then appends a line
+#
+#      <yymm>/<id>/<file>.txt\t<offset>\t<length>
+#
+# to proofs/shards/<yy>.<pid>.idx recording where those bytes are.
+# The index line is written only after the data is, so an interrupted
+# run leaves at worst some unindexed bytes at the end of a shard.
+# (Failures still get individual .err files.)
+#
+# With --clean, the cleaned proofs and their sentences (as cleanup.py
+# and sentize2.py would produce them from those lines) go into shards
+# of the same form in proofs/shards/clean and proofs/shards/sent.
+
+import io
+import os
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Tuple
+
+SHARD_DIR = Path("proofs") / "shards"
+
+# Kinds of output, and where their shards go
+KINDS = {
+    "raw": SHARD_DIR,
+    "clean": SHARD_DIR / "clean",
+    "sent": SHARD_DIR / "sent",
+}
+
+# This process's open (data, index) files, by kind and year
+open_shards: Dict[Tuple[str, str], Tuple[BinaryIO, BinaryIO]] = {}
+
+
+def tsv_lines(name: str, proofs: List[str]) -> bytes:
+    """
+    Format the proofs from the named .txt file as lines of a TSV file.
+
+    This matches reading back a .txt file containing the proofs,
+    one per line, and tagging each line with the paper id.
+    """
+    paper_id = "/".join(name.split("/")[:2])
+    text = io.StringIO("".join(f"{proof}\n" for proof in proofs), newline=None)
+    return "".join(f"{paper_id}\t{line.strip()}\n" for line in text).encode()
+
+
+def get_shard(kind: str, year: str) -> Tuple[BinaryIO, BinaryIO]:
+    """Open (if necessary) this process's shard for one kind and year."""
+    if (kind, year) not in open_shards:
+        KINDS[kind].mkdir(parents=True, exist_ok=True)
+        stem = f"{year}.{os.getpid()}"
+        open_shards[kind, year] = (
+            open(KINDS[kind] / f"{stem}.tsv", "ab"),
+            open(KINDS[kind] / f"{stem}.idx", "ab"),
+        )
+    return open_shards[kind, year]
+
+
+def append_lines(kind: str, name: str, data: bytes) -> str:
+    """
+    Record the lines for a .txt file (named relative to proofs/).
+
+    Returns the shard and offset, as "<shard>:<offset>".
+    """
+    data_fd, index_fd = get_shard(kind, name[:2])
+    offset = data_fd.tell()
+    data_fd.write(data)
+    data_fd.flush()
+    index_fd.write(f"{name}\t{offset}\t{len(data)}\n".encode())
+    index_fd.flush()
+    return f"{data_fd.name}:{offset}"
+
+
+def read_index(
+    prefix: str = "", kind: str = "raw"
+) -> Dict[str, Tuple[Path, int, int]]:
+    """
+    Find the shard, offset, and length for each .txt file.
+
+    Only includes files whose names (relative to proofs/) start with
+    prefix. If a file was recorded more than once, any copy may be used.
+    """
+    index: Dict[str, Tuple[Path, int, int]] = {}
+    for index_path in sorted(KINDS[kind].glob(f"{prefix[:2]}*.idx")):
+        shard = index_path.with_suffix(".tsv")
+        with index_path.open("rb") as fd:
+            for line in fd:
+                try:
+                    name, offset, length = line.decode().rsplit("\t", 2)
+                    if name.startswith(prefix) and length.endswith("\n"):
+                        index[name] = (shard, int(offset), int(length))
+                except ValueError:
+                    # A line garbled by an interrupted run
+                    continue
+    return index